@@ -0,0 +1,143 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import threading
+
+# The options of a cgroup v1 mount that are not controllers
+_V1_OPTIONS = ['rw', 'ro', 'noprefix', 'xattr', 'clone_children',
+               'cpuset_v2_mode', 'all', 'none']
+
+
+class CgroupMounts(object):
+    """
+    Where the cgroup hierarchies are mounted, from a mountinfo file. Every
+    hierarchy is a (mount point, root) pair, where root is the cgroup mounted
+    at the mount point (usually '/').
+    """
+
+    def __init__(self, mountinfo_path='/proc/self/mountinfo'):
+        # cgroup v1 controller (or name=<name>) -> (mount point, root)
+        self.v1 = {}
+        # The cgroup v2 unified hierarchy
+        self.v2 = None
+        with open(mountinfo_path, 'rb') as fp:
+            for line in fp:
+                self._add(line)
+
+    def _add(self, line):
+        # 36 35 98:0 /root /mnt/point rw,relatime shared:1 - cgroup cgroup
+        # rw,memory
+        (mount, _, fs) = line.partition(' - ')
+        mount = mount.split()
+        fs = fs.split()
+        if len(mount) < 5 or len(fs) < 3:
+            return
+        (root, mount_point) = (_unescape(mount[3]), _unescape(mount[4]))
+        if fs[0] == 'cgroup2':
+            self.v2 = self.v2 or (mount_point, root)
+        elif fs[0] == 'cgroup':
+            # The controllers are among the super block options
+            for option in fs[2].split(','):
+                if option.startswith('name=') or (
+                        '=' not in option and option not in _V1_OPTIONS):
+                    self.v1.setdefault(option, (mount_point, root))
+
+
+def _unescape(path):
+    # Spaces and the like are octal escaped in mountinfo
+    return path.decode('string_escape') if '\\' in path else path
+
+
+class ContainerCgroup(object):
+    """
+    The cgroups of a process (the init process of a container), as seen from
+    the host in /proc/<pid>/cgroup, resolved to paths under the mounts of the
+    cgroup hierarchies. Controllers in a cgroup v1 hierarchy are looked up
+    there, and the rest in the v2 unified hierarchy.
+    """
+
+    def __init__(self, pid, mounts, proc_dir='/proc'):
+        self.pid = pid
+        self.mounts = mounts
+        # controller -> cgroup, for v1
+        self.v1 = {}
+        self.v2 = None
+        with open(os.path.join(proc_dir, str(pid), 'cgroup'), 'rb') as fp:
+            for line in fp:
+                (hierarchy_id, controllers, path) = \
+                    line.rstrip('\n').split(':', 2)
+                if hierarchy_id == '0' and not controllers:
+                    self.v2 = path
+                    continue
+                for controller in controllers.split(','):
+                    self.v1[controller] = path
+
+    def version(self, controller):
+        """
+        Returns 1 or 2, the version of the hierarchy with `controller`, or
+        None if it is not mounted.
+        """
+        if controller in self.v1 and controller in self.mounts.v1:
+            return 1
+        if self.v2 is not None and self.mounts.v2:
+            return 2
+        return None
+
+    def get_path(self, controller, node=''):
+        """
+        Returns the path of `node` in the cgroup of `controller`.
+        """
+        version = self.version(controller)
+        if version == 1:
+            ((mount_point, root), path) = (self.mounts.v1[controller],
+                                           self.v1[controller])
+        elif version == 2:
+            ((mount_point, root), path) = (self.mounts.v2, self.v2)
+        else:
+            raise IOError('No cgroup for %s of process %s'
+                          % (controller, self.pid))
+        # The cgroup is relative to the root of the mount
+        relpath = os.path.relpath(path, root)
+        if relpath.startswith('..'):
+            raise IOError('The cgroup %s of process %s is not under %s'
+                          % (path, self.pid, mount_point))
+        return os.path.normpath(os.path.join(mount_point, relpath, node))
+
+
+_mounts = None
+_mounts_lock = threading.Lock()
+
+# Cgroups by container pid
+_container_cgroups = {}
+
+
+def get_cgroup_mounts():
+    """
+    Returns the CgroupMounts of the host, read once.
+    """
+    global _mounts
+    with _mounts_lock:
+        if _mounts is None:
+            _mounts = CgroupMounts()
+        return _mounts
+
+
+def get_container_cgroup(pid):
+    """
+    Returns the ContainerCgroup of the container with (host) pid `pid`,
+    resolved once and kept until `forget_container_cgroup()`.
+    """
+    pid = str(pid)
+    mounts = get_cgroup_mounts()
+    with _mounts_lock:
+        cgroup = _container_cgroups.get(pid)
+    if not cgroup:
+        cgroup = ContainerCgroup(pid, mounts)
+        with _mounts_lock:
+            _container_cgroups[pid] = cgroup
+    return cgroup
+
+
+def forget_container_cgroup(pid):
+    with _mounts_lock:
+        _container_cgroups.pop(str(pid), None)
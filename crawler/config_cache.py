@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import hashlib
+import threading
+import logging
+
+logger = logging.getLogger('crawlutils')
+
+# What the config crawler reports for the files with a cache
+# Every file with its content, only re-reading the files that changed
+CONFIG_CACHE_CONTENT = 'content'
+# The content of the files that changed, and just the hash of the rest
+CONFIG_CACHE_HASH = 'hash'
+CONFIG_CACHE_MODES = [CONFIG_CACHE_CONTENT, CONFIG_CACHE_HASH]
+
+
+class ConfigCache(object):
+    """
+    Cache of the config files read by the previous crawl of a system, so
+    that only the files whose metadata changed are read again.
+
+    Every file is mapped to its (inode, mtime, size), the sha256 of its
+    content, and the content itself.
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def read(self, fpath):
+        """
+        Returns (content, sha256, changed) for the file at `fpath`, where
+        `changed` is False if the content is the same as the last time the
+        file was read. Files are only read if their (inode, mtime, size)
+        changed, or if their size is 0 (as for files in /proc).
+        """
+        st = os.stat(fpath)
+        identity = (st.st_ino, st.st_mtime, st.st_size)
+        with self.lock:
+            cached = self.files.get(fpath)
+        if cached and cached[0] == identity and st.st_size > 0:
+            return (cached[2], cached[1], False)
+
+        with open(fpath, 'rb') as fp:
+            data = fp.read()
+        sha256 = hashlib.sha256(data).hexdigest()
+        content = data.decode('utf-8', 'ignore')
+        with self.lock:
+            self.files[fpath] = (identity, sha256, content)
+        return (content, sha256, not cached or cached[1] != sha256)
+
+    def retain(self, fpaths):
+        """
+        Forgets all the files but `fpaths`, the ones crawled last.
+        """
+        fpaths = set(fpaths)
+        with self.lock:
+            for fpath in self.files.keys():
+                if fpath not in fpaths:
+                    del self.files[fpath]
+
+
+# Caches by system: the container long id, or 'host'
+_config_caches = {}
+_config_caches_lock = threading.Lock()
+
+
+def get_config_cache(owner):
+    with _config_caches_lock:
+        cache = _config_caches.get(owner)
+        if not cache:
+            cache = ConfigCache()
+            _config_caches[owner] = cache
+        return cache
+
+
+def delete_config_cache(owner):
+    """
+    Forgets the cache of `owner`. This has to be called when a container
+    goes away.
+    """
+    with _config_caches_lock:
+        _config_caches.pop(owner, None)
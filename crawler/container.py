@@ -57,6 +57,13 @@ class Container(object):
     def get_cpu_cgroup_path(self, node='cpuacct.usage'):
         raise NotImplementedError()
 
+    def get_cgroup_version(self, controller='memory'):
+        """
+        Returns 1 or 2, whether the cgroup of `controller` is in a cgroup v1
+        hierarchy or the cgroup v2 unified one.
+        """
+        return 1
+
     def is_running(self):
         return os.path.exists('/proc/' + self.pid)
 
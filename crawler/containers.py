@@ -1,5 +1,6 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
+import os
 import logging
 
 # External dependencies that must be pip install'ed separately
@@ -12,6 +13,7 @@ import misc
 import namespace
 from dockercontainer import list_docker_containers
 from crawler_exceptions import ContainerInvalidEnvironment
+from process_table import get_process_table, FIELD_PID_NAMESPACE
 
 logger = logging.getLogger('crawlutils')
 
@@ -47,24 +49,7 @@ def list_all_containers(user_list='ALL',
 
         # Continue with all other containers not known to docker
 
-        for p in psutil.process_iter():
-            pid = (p.pid() if hasattr(p.pid, '__call__') else p.pid)
-            if pid == 1 or pid == '1':
-
-                # don't confuse the init process as a container
-
-                continue
-            if misc.process_is_crawler(pid):
-
-                # don't confuse the crawler process with a container
-
-                continue
-            curr_ns = namespace.get_pid_namespace(pid)
-            if not curr_ns:
-
-                # invalid container
-
-                continue
+        for (pid, curr_ns) in _list_pid_namespaces(container_opts):
             if curr_ns not in visited_ns and curr_ns != init_ns:
                 visited_ns.add(curr_ns)
                 yield Container(pid)
@@ -80,6 +65,43 @@ def list_all_containers(user_list='ALL',
                 yield container
 
 
+def _list_pid_namespaces(container_opts={}):
+    """
+    Yields (pid, pid namespace) for every process, but the init process and
+    the crawler itself.
+    """
+    if container_opts.get('process_table'):
+        table = get_process_table(fields=[FIELD_PID_NAMESPACE])
+        crawler = table.processes.get(os.getpid())
+        for proc in table:
+            if proc.pid == 1 or not proc.pid_namespace:
+                continue
+            if crawler and proc.cmdline == crawler.cmdline:
+                continue
+            yield (proc.pid, proc.pid_namespace)
+        return
+
+    for p in psutil.process_iter():
+        pid = (p.pid() if hasattr(p.pid, '__call__') else p.pid)
+        if pid == 1 or pid == '1':
+
+            # don't confuse the init process as a container
+
+            continue
+        if misc.process_is_crawler(pid):
+
+            # don't confuse the crawler process with a container
+
+            continue
+        curr_ns = namespace.get_pid_namespace(pid)
+        if not curr_ns:
+
+            # invalid container
+
+            continue
+        yield (pid, curr_ns)
+
+
 def get_filtered_list_of_containers(
     options=defaults.DEFAULT_CRAWL_OPTIONS,
     host_namespace=misc.get_host_ipaddr()
@@ -97,6 +119,13 @@ def get_filtered_list_of_containers(
     container_opts = {'host_namespace': host_namespace,
                       'environment': environment,
                       'long_id_to_namespace_map': _map,
+                      'docker_events': options.get(
+                          'docker_events', defaults.DEFAULT_DOCKER_EVENTS),
+                      'docker_reconcile_interval': options.get(
+                          'docker_reconcile_interval',
+                          defaults.DEFAULT_DOCKER_RECONCILE_INTERVAL),
+                      'process_table': options.get(
+                          'process_table', defaults.DEFAULT_PROCESS_TABLE),
                       }
 
     user_list = options.get('docker_containers_list', 'ALL')
@@ -0,0 +1,43 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import time
+import logging
+
+from delta_store import get_delta_store, container_owner
+
+logger = logging.getLogger('crawlutils')
+
+# The key of the CPU usage of a container in the delta store, as the list
+# of CPU times read from its cgroup
+CPU_KEY = 'cpu'
+
+
+def sample_containers(containers, read_usage, interval=0.1, store=None,
+                      per_cpu=False):
+    """
+    Takes a first sample of the CPU usage of every container in `containers`
+    without one in the delta store, with `read_usage(container, per_cpu)`
+    (which has to match the setting of their crawls), and then
+    sleeps `interval` seconds once for all of them. The CPU usage of these
+    containers can then be calculated by their crawls without each having to
+    take two samples and sleep in between.
+
+    Returns the number of containers sampled.
+    """
+    if store is None:
+        store = get_delta_store()
+    sampled = 0
+    for container in containers:
+        owner = container_owner(container)
+        if store.get(owner, CPU_KEY)[0] is not None:
+            continue
+        try:
+            store.put(owner, CPU_KEY, read_usage(container, per_cpu))
+            sampled += 1
+        except Exception as e:
+            # Their crawls take their own samples, and report the error
+            logger.debug('Could not sample the CPU usage of %s: %s'
+                         % (container.long_id, e))
+    if sampled:
+        time.sleep(interval)
+    return sampled
@@ -26,6 +26,7 @@ import copy
 import defaults
 import misc
 import crawlutils
+import emit_queue
 from crawlmodes import Modes
 
 CRAWLER_HOST = misc.get_host_ipaddr()
@@ -279,6 +280,118 @@ if __name__ == '__main__':
         default=None,
         help='Number of processes used for container crawling. Defaults '
              'to the number of cores.')
+    parser.add_argument(
+        '--numthreads',
+        dest='numthreads',
+        type=int,
+        default=None,
+        help='Number of threads used by each crawler process to crawl '
+             'containers concurrently. Defaults to 1.')
+    parser.add_argument(
+        '--containerDeadline',
+        dest='containerDeadline',
+        type=float,
+        default=None,
+        help='Seconds after which the crawl of a container is cut short '
+             'and the crawler stops waiting for it. Defaults to no deadline.')
+    parser.add_argument(
+        '--dockerEvents',
+        dest='dockerEvents',
+        action='store_true',
+        default=defaults.DEFAULT_DOCKER_EVENTS,
+        help='Keep the list of docker containers up to date by listening to '
+             'the docker events, instead of inspecting every container at '
+             'every crawl interval. Only applies to the OUTCONTAINER mode.')
+    parser.add_argument(
+        '--processTable',
+        dest='processTable',
+        action='store_true',
+        default=defaults.DEFAULT_PROCESS_TABLE,
+        help='Crawl the process, metric and connection features (and find '
+             'the containers not known to docker) from a single read of '
+             '/proc per frame, instead of querying every process for each '
+             'of them.')
+    parser.add_argument(
+        '--deltaStoreDir',
+        dest='deltaStoreDir',
+        type=str,
+        default=defaults.DEFAULT_DELTA_STORE_DIR,
+        help='Directory where the previous values of the CPU and interface '
+             'counters are saved, so that a restarted crawler keeps '
+             'calculating their rates since the values seen before, and '
+             'does not sleep to sample the CPU usage of every container '
+             'again.')
+    parser.add_argument(
+        '--deltaStoreMaxEntries',
+        dest='deltaStoreMaxEntries',
+        type=int,
+        default=defaults.DEFAULT_DELTA_STORE_MAX_ENTRIES,
+        help='Maximum number of counter values kept to calculate rates. The '
+             'least recently updated are forgotten first.')
+    parser.add_argument(
+        '--httpBatchBytes',
+        dest='httpBatchBytes',
+        type=int,
+        default=defaults.DEFAULT_HTTP_BATCH_BYTES,
+        help='Post the frames to http urls in batches of about this many '
+             'bytes, as a single request body of newline delimited frames '
+             '(csv and graphite) or features (json), instead of one request '
+             'per frame. 0 (the default) posts every frame on its own.')
+    parser.add_argument(
+        '--httpBatchSecs',
+        dest='httpBatchSecs',
+        type=float,
+        default=defaults.DEFAULT_HTTP_BATCH_SECS,
+        help='Longest time a frame waits in an http batch before the batch '
+             'is posted, even if it is not full.')
+    parser.add_argument(
+        '--emitQueueSize',
+        dest='emitQueueSize',
+        type=int,
+        default=defaults.DEFAULT_EMIT_QUEUE_SIZE,
+        help='Publish the frames from a background thread per output url, '
+             'with up to this many frames waiting for each url, so that a '
+             'crawl does not wait for its frame to be sent. 0 (the default) '
+             'publishes every frame at the end of its crawl.')
+    parser.add_argument(
+        '--emitQueuePolicy',
+        dest='emitQueuePolicy',
+        type=str,
+        choices=emit_queue.EMIT_QUEUE_POLICIES,
+        default=defaults.DEFAULT_EMIT_QUEUE_POLICY,
+        help='What to do with a frame when the emit queue of an url is full: '
+             'wait for room (block), drop it (drop_newest), drop the oldest '
+             'frame of the queue (drop_oldest), or keep it in a temporary '
+             'file (spill).')
+    parser.add_argument(
+        '--emitQueueDrainTimeout',
+        dest='emitQueueDrainTimeout',
+        type=float,
+        default=defaults.DEFAULT_EMIT_QUEUE_DRAIN_TIMEOUT,
+        help='Longest time the crawler waits for the frames left in the emit '
+             'queues to be published when it exits. The frames still '
+             'queued after that are dropped.')
+    parser.add_argument(
+        '--spoolDir',
+        dest='spoolDir',
+        type=str,
+        default=defaults.DEFAULT_SPOOL_DIR,
+        help='Directory where the frames that could not be sent to a kafka '
+             'or http url are kept, to be sent again in order once the url '
+             'is reachable, instead of being retried on the spot or lost.')
+    parser.add_argument(
+        '--spoolMaxBytes',
+        dest='spoolMaxBytes',
+        type=int,
+        default=defaults.DEFAULT_SPOOL_MAX_BYTES,
+        help='Maximum size of the spool of an url. The oldest frames are '
+             'dropped first.')
+    parser.add_argument(
+        '--spoolMaxAge',
+        dest='spoolMaxAge',
+        type=int,
+        default=defaults.DEFAULT_SPOOL_MAX_AGE,
+        help='Seconds after which the frames left in a spool are dropped.')
     parser.add_argument(
         '--extraMetadataFile',
         dest='extraMetadataFile',
@@ -315,9 +428,25 @@ if __name__ == '__main__':
         action='store_true',
         default=False,
         help='Avoids the use of the setns() syscall to crawl containers. '
-             'Some features like process will not work with this option. '
+             'The os, file, config and package features are then crawled '
+             'from the root filesystem of the container, the process, '
+             'metric and connection features from /proc on the host (its '
+             'processes are found from its cgroup.procs and NSpid), and the '
+             'interface feature from the /proc/<pid>/net/dev of its init '
+             'process. The disk and load features still need setns(). '
              'Only applies to the OUTCONTAINER mode'
     )
+    parser.add_argument(
+        '--layerDedup',
+        dest='layerDedup',
+        action='store_true',
+        default=defaults.DEFAULT_LAYER_DEDUP,
+        help='Crawls the packages, files and config files of the image of '
+             'the containers once, and then only what the writable layer of '
+             'every container changed. Only applies to the OUTCONTAINER '
+             'mode with --avoidSetns, on the aufs and overlay storage '
+             'drivers.'
+    )
 
     args = parser.parse_args()
     params = {}
@@ -406,11 +535,47 @@ if __name__ == '__main__':
                 options['docker_containers_list'] = args.crawlContainers
             if not args.numprocesses:
                 args.numprocesses = multiprocessing.cpu_count()
+            if args.numthreads:
+                options['container_crawl_threads'] = args.numthreads
+            if args.containerDeadline:
+                options['container_crawl_deadline'] = args.containerDeadline
+            if args.dockerEvents:
+                options['docker_events'] = args.dockerEvents
             if args.avoid_setns:
                 options['os']['avoid_setns'] = args.avoid_setns
                 options['config']['avoid_setns'] = args.avoid_setns
                 options['file']['avoid_setns'] = args.avoid_setns
                 options['package']['avoid_setns'] = args.avoid_setns
+                options['process']['avoid_setns'] = args.avoid_setns
+                options['metric']['avoid_setns'] = args.avoid_setns
+                options['connection']['avoid_setns'] = args.avoid_setns
+                options['interface']['avoid_setns'] = args.avoid_setns
+            if args.layerDedup:
+                options['package']['layer_dedup'] = args.layerDedup
+                options['file']['layer_dedup'] = args.layerDedup
+                options['config']['layer_dedup'] = args.layerDedup
+    if args.processTable:
+        options['process_table'] = args.processTable
+    if args.deltaStoreDir:
+        options['delta_store_dir'] = args.deltaStoreDir
+    if args.deltaStoreMaxEntries:
+        options['delta_store_max_entries'] = args.deltaStoreMaxEntries
+    if args.httpBatchBytes:
+        options['http_batch_bytes'] = args.httpBatchBytes
+    if args.httpBatchSecs:
+        options['http_batch_secs'] = args.httpBatchSecs
+    if args.emitQueueSize:
+        options['emit_queue_size'] = args.emitQueueSize
+    if args.emitQueuePolicy:
+        options['emit_queue_policy'] = args.emitQueuePolicy
+    if args.emitQueueDrainTimeout:
+        options['emit_queue_drain_timeout'] = args.emitQueueDrainTimeout
+    if args.spoolDir:
+        options['spool_dir'] = args.spoolDir
+    if args.spoolMaxBytes:
+        options['spool_max_bytes'] = args.spoolMaxBytes
+    if args.spoolMaxAge:
+        options['spool_max_age'] = args.spoolMaxAge
     if args.format:
         params['format'] = args.format
     if args.environment:
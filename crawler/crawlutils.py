@@ -16,6 +16,7 @@ import csv
 import signal
 import json
 from ctypes import CDLL
+from multiprocessing.pool import ThreadPool
 import uuid
 from mesos import snapshot_crawler_mesos_frame
 
@@ -29,10 +30,23 @@ except Exception as e:
 import psutil
 
 from emitter import Emitter
-from features_crawler import FeaturesCrawler
+from http_sink import flush_http_batches
+from emit_queue import drain_emit_queues, get_emit_queue_stats
+from frame_spool import get_frame_spool_stats
+from features_crawler import FeaturesCrawler, read_container_cpu_usage
 from containers import get_filtered_list_of_containers
 import defaults
 import misc
+import dockerutils
+from namespace import stop_namespace_workers
+from file_index import delete_file_indexes
+from config_cache import delete_config_cache
+from process_table import forget_container_process_table
+from cgroups import forget_container_cgroup
+from delta_store import (get_delta_store, load_delta_store,
+                         container_owner)
+from cpu_sampler import sample_containers
+from net_interfaces import snapshot_interface_counters
 from crawlmodes import Modes
 import plugins_manager
 
@@ -51,6 +65,34 @@ def signal_handler_exit(signum, stack):
     should_exit = True
 
 
+def _emitter_options(options):
+    """
+    Returns the Emitter arguments set by the crawl `options`.
+    """
+    spool_dir = options.get('spool_dir', defaults.DEFAULT_SPOOL_DIR)
+    if spool_dir:
+        # One spool per crawler process, as each emits its own frames
+        process_id = options.get(
+            'partition_strategy',
+            defaults.DEFAULT_PARTITION_STRATEGY)['args']['process_id']
+        spool_dir = os.path.join(spool_dir, 'spool.%d' % process_id)
+    return {
+        'http_batch_bytes': options.get('http_batch_bytes',
+                                        defaults.DEFAULT_HTTP_BATCH_BYTES),
+        'http_batch_secs': options.get('http_batch_secs',
+                                       defaults.DEFAULT_HTTP_BATCH_SECS),
+        'emit_queue_size': options.get('emit_queue_size',
+                                       defaults.DEFAULT_EMIT_QUEUE_SIZE),
+        'emit_queue_policy': options.get('emit_queue_policy',
+                                         defaults.DEFAULT_EMIT_QUEUE_POLICY),
+        'spool_dir': spool_dir,
+        'spool_max_bytes': options.get('spool_max_bytes',
+                                       defaults.DEFAULT_SPOOL_MAX_BYTES),
+        'spool_max_age': options.get('spool_max_age',
+                                     defaults.DEFAULT_SPOOL_MAX_AGE),
+    }
+
+
 def snapshot_single_frame(
     emitter,
     features=defaults.DEFAULT_FEATURES_TO_CRAWL,
@@ -58,6 +100,7 @@ def snapshot_single_frame(
     crawler=None,
     inputfile="undefined",
     ignore_exceptions=True,
+    deadline=None,
 ):
 
     # Special-casing Reading from a frame file as input here:
@@ -101,6 +144,10 @@ def snapshot_single_frame(
                 feature, defaults.DEFAULT_CRAWL_OPTIONS[feature])
             if should_exit:
                 break
+            if deadline and time.time() > deadline:
+                logger.warning('Past the crawl deadline, skipping the '
+                               'remaining features from %s' % feature)
+                break
             if feature_options is None:
                 continue
             try:
@@ -263,7 +310,10 @@ def snapshot_generic(
 ):
 
     crawler = FeaturesCrawler(feature_epoch=since_timestamp,
-                              crawl_mode=crawlmode)
+                              crawl_mode=crawlmode,
+                              process_table=options.get(
+                                  'process_table',
+                                  defaults.DEFAULT_PROCESS_TABLE))
 
     compress = options['compress']
     metadata = {
@@ -284,6 +334,7 @@ def snapshot_generic(
         urls=output_urls,
         emitter_args=metadata,
         format=format,
+        **_emitter_options(options)
     ) as emitter:
         snapshot_single_frame(emitter, features,
                               options, crawler, inputfile)
@@ -319,6 +370,7 @@ def snapshot_mesos(
         urls=output_urls,
         emitter_args=metadata,
         format=format,
+        **_emitter_options(options)
     ) as emitter:
        snapshot_crawler_mesos_frame(options['mesos_url'])
 
@@ -335,11 +387,14 @@ def snapshot_container(
     container=None,
     since='BOOT',
     since_timestamp=0,
+    deadline=None,
 ):
     crawler = FeaturesCrawler(
         feature_epoch=since_timestamp,
         crawl_mode=Modes.OUTCONTAINER,
-        container=container)
+        container=container,
+        process_table=options.get('process_table',
+                                  defaults.DEFAULT_PROCESS_TABLE))
 
     compress = options['compress']
     extra_metadata = options['metadata']['extra_metadata']
@@ -385,10 +440,164 @@ def snapshot_container(
         urls=output_urls,
         emitter_args=metadata,
         format=format,
+        **_emitter_options(options)
     ) as emitter:
 
         snapshot_single_frame(emitter, features, options,
-                              crawler, inputfile)
+                              crawler, inputfile, deadline=deadline)
+
+
+def _crawl_container(container, features, options, start_times=None,
+                     **snapshot_args):
+    """Crawls a single container and logs how long it took.
+
+    :param start_times: Dict where the start time is recorded, by container
+                        long id, for the crawls running in a thread pool.
+    """
+    start_time = time.time()
+    if start_times is not None:
+        start_times[container.long_id] = start_time
+
+    logger.info(
+        'Crawling container %s %s %s' %
+        (container.pid, container.short_id, container.namespace))
+
+    if options.get('link_container_log_files', False):
+        # This is a NOP if files are already linked (which is
+        # pretty much always).
+        try:
+            container.link_logfiles(options=options)
+        except NotImplementedError:
+            pass
+
+    # no feature crawling
+    if 'nofeatures' in features:
+        return
+
+    deadline_secs = options.get('container_crawl_deadline',
+                                defaults.DEFAULT_CONTAINER_CRAWL_DEADLINE)
+    snapshot_container(
+        features=features,
+        options=options,
+        container=container,
+        deadline=(start_time + deadline_secs if deadline_secs > 0 else None),
+        **snapshot_args
+    )
+    logger.info('Crawled container %s in %.3f seconds' %
+                (container.short_id, time.time() - start_time))
+
+
+def _reap_container_crawls(running):
+    """Removes the crawls that are done from `running`, logging their
+    exceptions.
+    """
+    for (long_id, (container, result)) in running.items():
+        if result.ready():
+            del running[long_id]
+            try:
+                result.get()
+            except Exception as e:
+                logger.exception(e)
+
+
+def _forget_container(container, options):
+    """Forgets what is kept about a container that is gone, and tears down
+    the processes attached to its namespaces.
+    """
+    stop_namespace_workers(container.pid)
+    dockerutils.invalidate_docker_container(container.long_id)
+    delete_file_indexes(
+        (options.get('file') or {}).get(
+            'index_dir', defaults.DEFAULT_FILE_INDEX_DIR),
+        container.long_id)
+    delete_config_cache(container.long_id)
+    forget_container_cgroup(container.pid)
+    forget_container_process_table(container.pid)
+    if options.get('link_container_log_files', False):
+        try:
+            container.unlink_logfiles(options)
+        except NotImplementedError:
+            pass
+
+
+def _forget_containers(containers, running, options):
+    """Forgets the `containers` that are gone, except for the ones still
+    being crawled in the pool (past their deadline), which are returned to be
+    forgotten once their crawl is done.
+    """
+    _reap_container_crawls(running)
+    still_running = []
+    for container in containers:
+        if container.long_id in running:
+            # Its crawl is still using its namespace workers and caches
+            logger.debug('Container %s is gone, but still being crawled' %
+                         container.short_id)
+            still_running.append(container)
+        else:
+            _forget_container(container, options)
+    return still_running
+
+
+def _crawl_containers_in_pool(pool, running, containers, features, options,
+                              **snapshot_args):
+    """Crawls `containers` concurrently using the threads in `pool`.
+
+    Returns when all the crawls are done, or when the ones still running are
+    past their deadline. `running` maps container long ids to the crawls not
+    finished yet, and it persists across intervals so that a container is not
+    crawled twice at the same time.
+    """
+    _reap_container_crawls(running)
+
+    start_times = {}
+    waiting = []
+    for container in containers:
+        if container.long_id in running:
+            logger.warning('Still crawling container %s, skipping it' %
+                           container.short_id)
+            continue
+        running[container.long_id] = (container, pool.apply_async(
+            _crawl_container,
+            (container, features, options, start_times),
+            snapshot_args))
+        waiting.append(container.long_id)
+
+    deadline_secs = options.get('container_crawl_deadline',
+                                defaults.DEFAULT_CONTAINER_CRAWL_DEADLINE)
+    while waiting:
+        long_id = waiting.pop(0)
+        (container, result) = running[long_id]
+        start_time = start_times.get(long_id)
+        if deadline_secs > 0 and start_time is not None:
+            result.wait(max(start_time + deadline_secs - time.time(), 0))
+        else:
+            # Not started yet, or no deadline
+            result.wait(0.1)
+        if result.ready():
+            del running[long_id]
+            # Re-raise the exceptions of the crawl
+            result.get()
+        elif (deadline_secs > 0 and start_time is not None and
+                time.time() > start_time + deadline_secs):
+            logger.warning('Crawl of container %s is past its deadline of '
+                           '%s seconds' % (container.short_id, deadline_secs))
+        else:
+            waiting.append(long_id)
+
+
+def _drain_emit_queues(options):
+    """Waits for the frames left in the emit queues to be published, up to
+    the `emit_queue_drain_timeout` option, and logs the ones dropped after
+    that.
+    """
+    timeout = options.get('emit_queue_drain_timeout',
+                          defaults.DEFAULT_EMIT_QUEUE_DRAIN_TIMEOUT)
+    if drain_emit_queues(timeout):
+        return
+    for (url, stats) in sorted(get_emit_queue_stats().iteritems()):
+        if stats['depth']:
+            logger.warning('Dropping the %d frames left in the emit queue '
+                           'for %s: %s' % (stats['depth'], url, stats))
 
 
 def get_initial_since_values(since):
@@ -470,9 +679,37 @@ def snapshot(
     libc.prctl(PR_SET_PDEATHSIG, signal.SIGHUP)
     signal.signal(signal.SIGHUP, signal_handler_exit)
 
+    # The previous values of the counters that rates are calculated from
+    delta_store_max_entries = options.get(
+        'delta_store_max_entries', defaults.DEFAULT_DELTA_STORE_MAX_ENTRIES)
+    delta_store_dir = options.get('delta_store_dir',
+                                  defaults.DEFAULT_DELTA_STORE_DIR)
+    if delta_store_dir:
+        # One file per crawler process, as each crawls its own containers
+        process_id = options.get(
+            'partition_strategy',
+            defaults.DEFAULT_PARTITION_STRATEGY)['args']['process_id']
+        delta_store = load_delta_store(
+            os.path.join(delta_store_dir, 'delta.%d' % process_id),
+            delta_store_max_entries)
+    else:
+        delta_store = get_delta_store()
+        delta_store.max_entries = delta_store_max_entries
+
     if crawlmode == Modes.OUTCONTAINER:
+        dockerutils.inspect_cache.ttl = options.get(
+            'docker_inspect_ttl', defaults.DEFAULT_DOCKER_INSPECT_TTL)
         containers = get_filtered_list_of_containers(options, namespace)
 
+        # Containers are crawled one after the other, unless there is more
+        # than one crawl thread.
+        num_threads = options.get('container_crawl_threads',
+                                  defaults.DEFAULT_CONTAINER_CRAWL_THREADS)
+        pool = ThreadPool(num_threads) if num_threads > 1 else None
+        running = {}
+        # The containers gone while they were still being crawled
+        forget_later = []
+
     # This is the main loop of the system, taking a snapshot and sleeping at
     # every iteration.
 
@@ -487,44 +724,42 @@ def snapshot(
             deleted = [c for c in containers if c not in curr_containers]
             containers = curr_containers
 
-            for container in deleted:
-                if options.get('link_container_log_files', False):
-                    try:
-                        container.unlink_logfiles(options)
-                    except NotImplementedError:
-                        pass
- 
+            forget_later = _forget_containers(deleted + forget_later,
+                                              running, options)
+
             logger.debug('Crawling %d containers' % (len(containers)))
 
-            for container in containers:
-
-                logger.info(
-                    'Crawling container %s %s %s' %
-                    (container.pid, container.short_id, container.namespace))
-
-                if options.get('link_container_log_files', False):
-                    # This is a NOP if files are already linked (which is
-                    # pretty much always).
-                    try:
-                        container.link_logfiles(options=options)
-                    except NotImplementedError:
-                        pass
-
-                # no feature crawling
-                if 'nofeatures' in features:
-                    continue
-                snapshot_container(
-                    urls=urls,
-                    snapshot_num=snapshot_num,
-                    features=features,
-                    options=options,
-                    format=format,
-                    inputfile=inputfile,
-                    container=container,
-                    since=since,
-                    since_timestamp=since_timestamp,
-                    overwrite=overwrite
-                )
+            snapshot_args = dict(
+                urls=urls,
+                snapshot_num=snapshot_num,
+                format=format,
+                inputfile=inputfile,
+                since=since,
+                since_timestamp=since_timestamp,
+                overwrite=overwrite
+            )
+            # Forget the counters of the containers that are gone
+            delta_store.retain([container_owner(c) for c in containers])
+            if 'cpu' in features.split(','):
+                # Take the first CPU samples of the new containers all at
+                # once, so that their crawls do not each sleep to take two
+                sample_containers(
+                    containers, read_container_cpu_usage,
+                    per_cpu=(options.get('cpu') or {}).get('per_cpu', False))
+            if ('interface' in features.split(',') and
+                    (options.get('interface') or {}).get('avoid_setns')):
+                # Read the interface counters of all the containers at once
+                snapshot_interface_counters([c.pid for c in containers])
+
+            if pool:
+                _crawl_containers_in_pool(pool, running, containers,
+                                          features, options, **snapshot_args)
+            else:
+                for container in containers:
+                    _crawl_container(container, features, options,
+                                     **snapshot_args)
+            logger.debug('Docker cache stats: %s' %
+                         dockerutils.get_docker_cache_stats())
 
         elif crawlmode in (Modes.INVM,
                            Modes.MOUNTPOINT,
@@ -561,6 +796,16 @@ def snapshot(
         else:
             raise RuntimeError('Unknown Mode')
 
+        if options.get('emit_queue_size'):
+            logger.debug('Emit queue stats: %s' % get_emit_queue_stats())
+        if options.get('spool_dir'):
+            logger.debug('Spool stats: %s' % get_frame_spool_stats())
+
+        try:
+            delta_store.save()
+        except (IOError, OSError) as e:
+            logger.warning('Could not save the delta store: %s' % e)
+
         if since == 'LASTSNAPSHOT':
             # Subsequent snapshots will update this value.
             since_timestamp = snapshot_time
@@ -568,6 +813,12 @@ def snapshot(
         # Frequency <= 0 means only one run.
         if frequency < 0 or should_exit:
             logger.info('Bye')
+            # Publish the frames still waiting in the emit queues and in the
+            # http batches
+            _drain_emit_queues(options)
+            flush_http_batches()
+            if crawlmode == Modes.OUTCONTAINER and pool:
+                pool.terminate()
             break
         elif frequency == 0:
             continue
@@ -4,6 +4,22 @@
 DEFAULT_ENVIRONMENT = 'cloudsight'
 DEFAULT_PLUGIN_PLACES = 'plugins'
 DEFAULT_COMPRESS = False
+DEFAULT_FRAME_SPILL_SIZE = 4 * 1024 * 1024
+DEFAULT_KAFKA_LINGER_MS = 10
+DEFAULT_KAFKA_BATCH_SIZE = 1000
+DEFAULT_KAFKA_BATCH_BYTES = 1024 * 1024
+DEFAULT_KAFKA_MAX_PENDING = 10000
+DEFAULT_HTTP_BATCH_BYTES = 0
+DEFAULT_HTTP_BATCH_SECS = 5
+DEFAULT_EMIT_QUEUE_SIZE = 0
+DEFAULT_EMIT_QUEUE_POLICY = 'drop_oldest'
+DEFAULT_EMIT_QUEUE_MAX_SPILLED = 100
+DEFAULT_EMIT_QUEUE_DRAIN_TIMEOUT = 30
+DEFAULT_SPOOL_DIR = None
+DEFAULT_SPOOL_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_SPOOL_MAX_AGE = 24 * 60 * 60
+DEFAULT_SPOOL_SEGMENT_BYTES = 4 * 1024 * 1024
+DEFAULT_SPOOL_REPLAY_INTERVAL = 10
 DEFAULT_PARTITION_STRATEGY = {'name': 'equally_by_pid',
                               'args': {'process_id': 0,
                                        'num_processes': 1}}
@@ -14,16 +30,34 @@ DEFAULT_LINK_CONTAINER_LOG_FILES = False
 DEFAULT_MOUNTPOINT = 'Undefined'
 DEFAULT_DOCKER_CONTAINERS_LIST = 'ALL'
 DEFAULT_AVOID_SETNS = False
+DEFAULT_LAYER_DEDUP = False
+DEFAULT_CONTAINER_CRAWL_THREADS = 1
+DEFAULT_CONTAINER_CRAWL_DEADLINE = 0
+DEFAULT_DOCKER_EVENTS = False
+DEFAULT_DOCKER_RECONCILE_INTERVAL = 300
+DEFAULT_DOCKER_INSPECT_TTL = 10
+DEFAULT_FILE_INDEX_DIR = '/var/lib/crawler/file_index'
+DEFAULT_WALK_THREADS = 1
+DEFAULT_CONFIG_CACHE = None
+DEFAULT_PROCESS_TABLE = False
+DEFAULT_DELTA_STORE_DIR = None
+DEFAULT_DELTA_STORE_MAX_ENTRIES = 100000
 
 DEFAULT_CRAWL_OPTIONS = {
     'os': {'avoid_setns': DEFAULT_AVOID_SETNS},
     'disk': {},
-    'package': {'avoid_setns': DEFAULT_AVOID_SETNS},
-    'process': {},
-    'metric': {},
-    'connection': {},
+    'package': {'avoid_setns': DEFAULT_AVOID_SETNS,
+                'layer_dedup': DEFAULT_LAYER_DEDUP},
+    'process': {'skip_fields': [], 'avoid_setns': DEFAULT_AVOID_SETNS},
+    'metric': {'avoid_setns': DEFAULT_AVOID_SETNS},
+    'connection': {'avoid_setns': DEFAULT_AVOID_SETNS},
     'mesos_url': 'http://localhost:9092',
     'file': {'root_dir': '/', 'avoid_setns': DEFAULT_AVOID_SETNS,
+             'incremental': False,
+             'index_dir': DEFAULT_FILE_INDEX_DIR,
+             'walk_threads': DEFAULT_WALK_THREADS,
+             'walk_sorted': False,
+             'layer_dedup': DEFAULT_LAYER_DEDUP,
              'exclude_dirs': [
                  'boot',
                  'dev',
@@ -38,6 +72,10 @@ DEFAULT_CRAWL_OPTIONS = {
              ]},
     'config': {'avoid_setns': DEFAULT_AVOID_SETNS,
                'root_dir': '/',
+               'walk_threads': DEFAULT_WALK_THREADS,
+               'walk_sorted': False,
+               'cache': DEFAULT_CONFIG_CACHE,
+               'layer_dedup': DEFAULT_LAYER_DEDUP,
                'exclude_dirs': [
                    'dev',
                    'proc',
@@ -63,7 +101,7 @@ DEFAULT_CRAWL_OPTIONS = {
                'discover_config_files': True,
                },
     'memory': {},
-    'interface': {},
+    'interface': {'avoid_setns': DEFAULT_AVOID_SETNS},
     'cpu': {},
     'load': {},
     'dockerps': {},
@@ -86,7 +124,23 @@ DEFAULT_CRAWL_OPTIONS = {
     'compress': DEFAULT_COMPRESS,
     'link_container_log_files': DEFAULT_LINK_CONTAINER_LOG_FILES,
     'mountpoint': DEFAULT_MOUNTPOINT,
-    'docker_containers_list': DEFAULT_DOCKER_CONTAINERS_LIST
+    'docker_containers_list': DEFAULT_DOCKER_CONTAINERS_LIST,
+    'container_crawl_threads': DEFAULT_CONTAINER_CRAWL_THREADS,
+    'container_crawl_deadline': DEFAULT_CONTAINER_CRAWL_DEADLINE,
+    'docker_events': DEFAULT_DOCKER_EVENTS,
+    'docker_reconcile_interval': DEFAULT_DOCKER_RECONCILE_INTERVAL,
+    'docker_inspect_ttl': DEFAULT_DOCKER_INSPECT_TTL,
+    'process_table': DEFAULT_PROCESS_TABLE,
+    'delta_store_dir': DEFAULT_DELTA_STORE_DIR,
+    'delta_store_max_entries': DEFAULT_DELTA_STORE_MAX_ENTRIES,
+    'http_batch_bytes': DEFAULT_HTTP_BATCH_BYTES,
+    'http_batch_secs': DEFAULT_HTTP_BATCH_SECS,
+    'emit_queue_size': DEFAULT_EMIT_QUEUE_SIZE,
+    'emit_queue_policy': DEFAULT_EMIT_QUEUE_POLICY,
+    'emit_queue_drain_timeout': DEFAULT_EMIT_QUEUE_DRAIN_TIMEOUT,
+    'spool_dir': DEFAULT_SPOOL_DIR,
+    'spool_max_bytes': DEFAULT_SPOOL_MAX_BYTES,
+    'spool_max_age': DEFAULT_SPOOL_MAX_AGE
 }
 
 DEFAULT_FEATURES_TO_CRAWL = 'os,cpu'
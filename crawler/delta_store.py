@@ -0,0 +1,136 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import time
+import logging
+import tempfile
+import threading
+import cPickle as pickle
+from collections import OrderedDict
+
+import defaults
+
+logger = logging.getLogger('crawlutils')
+
+# The owner of the values of the system running the crawler
+HOST_OWNER = 'host'
+
+
+def container_owner(container):
+    """
+    Returns the owner of the values of `container`. The pid changes when the
+    container is restarted, and its counters start again from 0.
+    """
+    return (container.long_id, str(container.pid))
+
+
+class DeltaStore(object):
+    """
+    The previous values of counters (CPU times, interface counters) that
+    rates are calculated from, as (value, timestamp) by (owner, key). The
+    owner is the container the value is from, so that the values of the
+    containers that are gone can be evicted all at once.
+
+    There are at most `max_entries` values, and the least recently put is
+    evicted first. The values are saved to `path`, if any, so that a
+    restarted crawler calculates its rates since the values seen before.
+    """
+
+    def __init__(self, path=None,
+                 max_entries=defaults.DEFAULT_DELTA_STORE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def load(path, max_entries=defaults.DEFAULT_DELTA_STORE_MAX_ENTRIES):
+        store = DeltaStore(path, max_entries)
+        try:
+            with open(path, 'rb') as fp:
+                entries = pickle.load(fp)
+            for (owner_key, value) in entries:
+                store.entries[owner_key] = value
+            store._evict()
+        except (IOError, OSError, EOFError, ValueError, TypeError,
+                pickle.UnpicklingError) as e:
+            logger.debug('Starting a new delta store at %s: %s' % (path, e))
+        return store
+
+    def save(self):
+        if not self.path:
+            return
+        store_dir = os.path.dirname(self.path)
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        with self._lock:
+            entries = self.entries.items()
+
+        # Write and rename, so a crash never leaves a truncated store behind
+        (fd, temp_path) = tempfile.mkstemp(prefix='.delta.', dir=store_dir)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                pickle.dump(entries, fp, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError):
+            os.remove(temp_path)
+            raise
+
+    def get(self, owner, key):
+        """
+        Returns the (value, timestamp) put last for `key` of `owner`, or
+        (None, None) if there is none.
+        """
+        with self._lock:
+            return self.entries.get((owner, key), (None, None))
+
+    def put(self, owner, key, value, timestamp=None):
+        with self._lock:
+            self.entries.pop((owner, key), None)
+            self.entries[(owner, key)] = (
+                value, timestamp if timestamp is not None else time.time())
+            self._evict()
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def retain(self, owners):
+        """
+        Forgets the values of all the owners but `owners`.
+        """
+        owners = set(owners)
+        with self._lock:
+            for (owner, key) in self.entries.keys():
+                if owner not in owners:
+                    del self.entries[(owner, key)]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+_delta_store = None
+_delta_store_lock = threading.Lock()
+
+
+def get_delta_store():
+    """
+    Returns the delta store of this process.
+    """
+    global _delta_store
+    with _delta_store_lock:
+        if _delta_store is None:
+            _delta_store = DeltaStore()
+        return _delta_store
+
+
+def load_delta_store(path,
+                     max_entries=defaults.DEFAULT_DELTA_STORE_MAX_ENTRIES):
+    """
+    Replaces the delta store of this process with the one saved at `path`,
+    which is saved there from then on.
+    """
+    global _delta_store
+    with _delta_store_lock:
+        _delta_store = DeltaStore.load(path, max_entries)
+        return _delta_store
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import logging
+from multiprocessing.pool import ThreadPool
+
+# scandir() gets the type of the entries from the directory itself (d_type),
+# instead of having to stat them.
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+logger = logging.getLogger('crawlutils')
+
+
+def walk(top, matcher=None, num_threads=1, sort=False):
+    """
+    Walks the directory hierarchy at `top` top-down, like `os.walk`, and
+    yields (dirpath, dirs, files) where `dirs` and `files` are lists of full
+    paths. The paths excluded by `matcher` (a `path_matcher.PathMatcher`,
+    with patterns relative to `top`) are left out, and excluded directories
+    are not descended into. Symlinks to directories are reported in `dirs`
+    but, like with `os.walk`, not followed.
+
+    With more than one thread, the directories are read by a thread pool,
+    ahead of the traversal. The output is the same either way, and with
+    `sort` the entries of every directory are sorted by name.
+    """
+    if num_threads <= 1:
+        for (dirpath, dirs, files) in _walk_serial(top, matcher, sort):
+            yield (dirpath, dirs, files)
+        return
+
+    pool = ThreadPool(num_threads)
+    try:
+        for (dirpath, dirs, files) in _walk_parallel(pool, num_threads, top,
+                                                     matcher, sort):
+            yield (dirpath, dirs, files)
+    finally:
+        pool.terminate()
+
+
+def _filter(matcher, state, dirpath, names, states=None):
+    """
+    Returns the full paths of the `names` in `dirpath` (whose matcher state
+    is `state`) that are not excluded, and adds the state of every one of
+    them that can still have excluded entries below it to `states`.
+    """
+    if state is None:
+        return [os.path.join(dirpath, name) for name in names]
+    paths = []
+    for name in names:
+        (excluded, child_state) = matcher.child(state, name)
+        if excluded:
+            continue
+        path = os.path.join(dirpath, name)
+        paths.append(path)
+        if child_state is not None and states is not None:
+            states[path] = child_state
+    return paths
+
+
+def _walk_serial(top, matcher, sort):
+    # Matcher states of the directories still to be walked, when not None
+    states = {}
+    if matcher:
+        states[top] = matcher.root_state()
+    for (dirpath, dirs, files) in os.walk(top):
+        if sort:
+            dirs.sort()
+            files.sort()
+        state = states.pop(dirpath, None)
+        dirs[:] = _filter(matcher, state, dirpath, dirs, states)
+        files = _filter(matcher, state, dirpath, files)
+        yield (dirpath, dirs, files)
+
+
+def _walk_parallel(pool, num_threads, top, matcher, sort):
+    # Depth-first stack of [dirpath, matcher state, pending listing]. The
+    # directories at the top of the stack are the next to be walked, so those
+    # are the ones being listed by the pool.
+    prefetch = num_threads * 4
+    stack = [[top, matcher.root_state() if matcher else None, None]]
+    while stack:
+        for entry in stack[-prefetch:]:
+            if entry[2] is None:
+                entry[2] = pool.apply_async(_list_dir, (entry[0], sort))
+        (dirpath, state, listing) = stack.pop()
+        try:
+            (dirs, links, files) = listing.get()
+        except OSError as e:
+            logger.debug('Could not list %s: %s' % (dirpath, e))
+            continue
+        states = {}
+        dirs = _filter(matcher, state, dirpath, dirs, states)
+        links = _filter(matcher, state, dirpath, links)
+        files = _filter(matcher, state, dirpath, files)
+        yield (dirpath, sorted(dirs + links) if sort else dirs + links, files)
+        stack.extend([d, states.get(d), None] for d in reversed(dirs))
+
+
+def _list_dir(dirpath, sort=False):
+    """
+    Returns the names of the directories, the symlinks to directories and the
+    rest of entries in `dirpath`.
+    """
+    dirs = []
+    links = []
+    files = []
+    if scandir:
+        for entry in scandir(dirpath):
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.name)
+            elif entry.is_symlink() and entry.is_dir():
+                links.append(entry.name)
+            else:
+                files.append(entry.name)
+    else:
+        for name in os.listdir(dirpath):
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                (links if os.path.isdir(path) else files).append(name)
+            elif os.path.isdir(path):
+                dirs.append(name)
+            else:
+                files.append(name)
+    if sort:
+        dirs.sort()
+        links.sort()
+        files.sort()
+    return (dirs, links, files)
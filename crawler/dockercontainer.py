@@ -1,9 +1,10 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 import os
-import subprocess
 import logging
 import shutil
+import threading
+import time
 
 from container import Container
 import misc
@@ -11,10 +12,15 @@ import defaults
 import json
 import glob
 from dockerutils import (exec_dockerps,
+                         exec_docker_container_ids,
+                         exec_docker_events,
                          get_docker_container_json_logs_path,
                          get_docker_container_rootfs_path,
-                         exec_dockerinspect)
+                         exec_dockerinspect,
+                         invalidate_docker_container,
+                         invalidate_docker_image)
 import plugins_manager
+from cgroups import get_cgroup_mounts, get_container_cgroup
 from crawler_exceptions import (ContainerInvalidEnvironment,
                                 ContainerNonExistent,
                                 DockerutilsNoJsonLog,
@@ -28,10 +34,16 @@ def list_docker_containers(container_opts={}):
     """
     Get the list of running Docker containers, as `DockerContainer` objects.
 
-    This is basically polling. Ideally, we should subscribe to Docker
-    events so we can keep the containers list up to date without having to
-    poll like this.
+    This is basically polling, unless `docker_events` is set in
+    `container_opts`. In that case the list is kept up to date by a
+    `DockerContainerRegistry` subscribed to the Docker events.
     """
+    if container_opts.get('docker_events', False):
+        registry = get_docker_container_registry(container_opts)
+        for c in registry.get_containers():
+            yield c
+        return
+
     for inspect in exec_dockerps():
         long_id = inspect['Id']
         try:
@@ -42,6 +54,164 @@ def list_docker_containers(container_opts={}):
             logger.exception(e)
 
 
+class DockerContainerRegistry(object):
+    """
+    Keeps the set of running Docker containers up to date, as
+    `DockerContainer` objects, by listening to the Docker events from a
+    thread. Only the containers that start (or are renamed) are inspected,
+    instead of inspecting every container at every crawl interval.
+
+    The set is reconciled with the list of running containers every
+    `reconcile_interval` seconds, and whenever the events stream breaks, in
+    case some events were missed.
+    """
+
+    # Events after which a container is (re-)inspected or dropped
+    UPDATE_EVENTS = ['start', 'restart', 'rename', 'unpause']
+    REMOVE_EVENTS = ['die', 'destroy']
+
+    # Image events after which the cached image data is dropped
+    IMAGE_EVENTS = ['tag', 'untag', 'delete', 'import', 'pull']
+
+    def __init__(self, container_opts={}, reconcile_interval=300):
+        self.container_opts = container_opts
+        self.reconcile_interval = reconcile_interval
+        # long_id -> DockerContainer, or None for the containers that are
+        # not valid in this environment (retried at every reconcile).
+        self.containers = {}
+        # long_id -> the number of the update that added it, as the events
+        # thread can add containers while the list is being reconciled.
+        self.update_nums = {}
+        self.num_updates = 0
+        self.lock = threading.Lock()
+        self.last_reconcile = None
+        self.last_event_time = None
+        self.needs_reconcile = True
+        self.thread = None
+        self.stopped = False
+
+    def start(self):
+        self.thread = threading.Thread(name='crawler-docker-events',
+                                       target=self._listen)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+
+    def get_containers(self):
+        if (self.needs_reconcile or self.last_reconcile is None or
+                time.time() - self.last_reconcile > self.reconcile_interval):
+            self.reconcile()
+        with self.lock:
+            return [c for c in self.containers.values() if c]
+
+    def reconcile(self):
+        self.needs_reconcile = False
+        self.last_reconcile = time.time()
+        with self.lock:
+            listed_after = self.num_updates
+        try:
+            long_ids = set(exec_docker_container_ids())
+        except DockerutilsException:
+            self.needs_reconcile = True
+            return
+        with self.lock:
+            known = dict(self.containers)
+            for long_id in known:
+                # Unless an event added it after the list was taken
+                if (long_id not in long_ids and
+                        self.update_nums.get(long_id, 0) <= listed_after):
+                    del self.containers[long_id]
+                    self.update_nums.pop(long_id, None)
+        for long_id in long_ids:
+            c = known.get(long_id)
+            # New, not valid before, or restarted with a different pid
+            if not c or not c.is_running():
+                self._update(long_id)
+
+    def _update(self, long_id):
+        try:
+            inspect = exec_dockerinspect(long_id)
+        except (DockerutilsException, HTTPError):
+            # It is gone already
+            self._remove(long_id)
+            return
+        c = None
+        try:
+            c = DockerContainer(long_id, inspect, self.container_opts)
+            if not c.namespace:
+                c = None
+        except ContainerInvalidEnvironment as e:
+            logger.exception(e)
+        with self.lock:
+            self.containers[long_id] = c
+            self.num_updates += 1
+            self.update_nums[long_id] = self.num_updates
+
+    def _remove(self, long_id):
+        with self.lock:
+            self.containers.pop(long_id, None)
+            self.update_nums.pop(long_id, None)
+
+    def _handle_event(self, event):
+        status = event.get('status', event.get('Action'))
+        long_id = event.get('id')
+        self.last_event_time = event.get('time', self.last_event_time)
+        if not long_id:
+            return
+        if event.get('Type') == 'image' or status in self.IMAGE_EVENTS:
+            invalidate_docker_image(long_id)
+            return
+        if event.get('Type', 'container') != 'container':
+            return
+
+        # Whatever happened, the cached inspect may be out of date
+        invalidate_docker_container(long_id)
+        if status in self.UPDATE_EVENTS:
+            logger.debug('Docker event %s for container %s' %
+                         (status, long_id))
+            self._update(long_id)
+        elif status in self.REMOVE_EVENTS:
+            logger.debug('Docker event %s for container %s' %
+                         (status, long_id))
+            self._remove(long_id)
+
+    def _listen(self):
+        while not self.stopped:
+            try:
+                for event in exec_docker_events(since=self.last_event_time):
+                    if self.stopped:
+                        return
+                    try:
+                        self._handle_event(event)
+                    except Exception as e:
+                        logger.exception(e)
+            except DockerutilsException:
+                pass
+            # Some events may have been missed while reconnecting
+            self.needs_reconcile = True
+            time.sleep(1)
+
+
+_registry = None
+
+
+def get_docker_container_registry(container_opts={}):
+    """
+    Returns the process-wide `DockerContainerRegistry`, starting it if this is
+    the first call.
+    """
+    global _registry
+    if not _registry:
+        _registry = DockerContainerRegistry(
+            container_opts,
+            container_opts.get('docker_reconcile_interval',
+                               defaults.DEFAULT_DOCKER_RECONCILE_INTERVAL))
+        _registry.start()
+    return _registry
+
+
 class DockerContainer(Container):
 
     DOCKER_LOG_FILE = "docker.log"
@@ -186,29 +356,53 @@ class DockerContainer(Container):
             if os.path.ismount(path):
                 return path
 
-        # Try getting the mount point from /proc/mounts
+        # Look for it in the mount table, read once by the crawler
+        for controller in dev.split(','):
+            (mount_point, _) = get_cgroup_mounts().v1.get(controller,
+                                                          ('', None))
+            if mount_point:
+                return mount_point
+        return ''
+
+    def _get_cgroup(self, controller):
+        """
+        Returns the cgroup of the container for `controller` as resolved
+        from /proc/<pid>/cgroup, or None if it could not be resolved.
+        """
         try:
-            # XXX don't start a process just for this
-            proc = subprocess.Popen(
-                'grep "cgroup/' +
-                dev +
-                ' " /proc/mounts | awk \'{print $2}\'',
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE)
-            return proc.stdout.read().strip()
-        except Exception as e:
-            raise e
+            cgroup = get_container_cgroup(self.pid)
+            if cgroup.version(controller):
+                return cgroup
+        except (IOError, OSError, ValueError) as e:
+            logger.debug('Could not resolve the %s cgroup of %s: %s'
+                         % (controller, self.short_id, e))
+        return None
+
+    def _get_cgroup_path(self, controller, node):
+        cgroup = self._get_cgroup(controller)
+        if cgroup:
+            try:
+                return cgroup.get_path(controller, node)
+            except IOError as e:
+                logger.debug(e)
+        # Fall back to the layout of docker with the cgroupfs driver
+        if controller == 'cpuacct':
+            # In kernels 4.x, the node is actually called 'cpu,cpuacct'
+            cgroup_dir = (self._get_cgroup_dir('cpuacct') or
+                          self._get_cgroup_dir('cpu,cpuacct'))
+        else:
+            cgroup_dir = self._get_cgroup_dir(controller)
+        return os.path.join(cgroup_dir, 'docker', self.long_id, node)
 
     def get_memory_cgroup_path(self, node='memory.stat'):
-        return os.path.join(self._get_cgroup_dir('memory'), 'docker',
-                            self.long_id, node)
+        return self._get_cgroup_path('memory', node)
 
     def get_cpu_cgroup_path(self, node='cpuacct.usage'):
-        # In kernels 4.x, the node is actually called 'cpu,cpuacct'
-        cgroup_dir = (self._get_cgroup_dir('cpuacct') or
-                      self._get_cgroup_dir('cpu,cpuacct'))
-        return os.path.join(cgroup_dir, 'docker', self.long_id, node)
+        return self._get_cgroup_path('cpuacct', node)
+
+    def get_cgroup_version(self, controller='memory'):
+        cgroup = self._get_cgroup(controller)
+        return cgroup.version(controller) if cgroup else 1
 
     def __str__(self):
         return str(self.__dict__)
@@ -1,10 +1,15 @@
 #!usr/bin/python
 # -*- coding: utf-8 -*-
 import os
+import copy
 import logging
+import threading
+import time
+from collections import OrderedDict
 import dateutil.parser as dp
 import semantic_version
 import docker
+import requests
 import misc
 
 
@@ -16,6 +21,169 @@ logger = logging.getLogger('crawlutils')
 from crawler_exceptions import (DockerutilsNoJsonLog,
                                 DockerutilsException)
 
+DOCKER_SOCKET_URL = 'unix://var/run/docker.sock'
+
+# The docker client shared by all the functions in this module, and the pid
+# of the process that created it (its connections can not be shared with
+# forked processes).
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+# The API version negotiated by the first client, reused by the next ones
+_api_version = 'auto'
+
+
+class DockerCache(object):
+    """
+    Cache of docker API results, with hit and miss counters.
+
+    Entries expire `ttl` seconds after being fetched, or never if `ttl` is
+    None, and the expired ones are dropped whenever an entry is stored. Past
+    `max_entries`, the least recently used entries are dropped. Errors are
+    not cached. Callers get a copy of the cached value, so they can modify
+    it.
+
+    A key is only fetched by one thread at a time: the other threads missing
+    it wait for that fetch, and fetch it themselves only if it failed.
+    """
+
+    def __init__(self, ttl=None, max_entries=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # The keys being fetched, with the events set once they are
+        self.fetching = {}
+
+    def _expired(self, entry, now):
+        return self.ttl is not None and now >= entry[0] + self.ttl
+
+    def get(self, key, fetch):
+        while True:
+            with self.lock:
+                entry = self.entries.pop(key, None)
+                if entry and not self._expired(entry, time.time()):
+                    self.entries[key] = entry
+                    self.hits += 1
+                    return copy.deepcopy(entry[1])
+                fetched = self.fetching.get(key)
+                if not fetched:
+                    self.misses += 1
+                    fetched = self.fetching[key] = threading.Event()
+                    break
+            fetched.wait()
+        try:
+            value = fetch()
+        except Exception:
+            with self.lock:
+                del self.fetching[key]
+            fetched.set()
+            raise
+        with self.lock:
+            del self.fetching[key]
+            now = time.time()
+            self.entries[key] = (now, value)
+            for (old_key, old_entry) in self.entries.items():
+                if self._expired(old_entry, now):
+                    del self.entries[old_key]
+            while (self.max_entries is not None and
+                   len(self.entries) > self.max_entries):
+                self.entries.popitem(last=False)
+        fetched.set()
+        return copy.deepcopy(value)
+
+    def invalidate(self, match=lambda key: True):
+        with self.lock:
+            for key in self.entries.keys():
+                if match(key):
+                    del self.entries[key]
+
+    def get_stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self.entries)}
+
+
+# Container inspects, by container id. They change when the container does,
+# so they are only kept for a few seconds (see the `docker_inspect_ttl`
+# option), unless they are invalidated earlier by the docker events or when
+# the container is gone.
+inspect_cache = DockerCache(ttl=10)
+
+# Image history and image RepoTags, by image id. These do not change while
+# the image exists, so only the least recently used ones are dropped.
+IMAGE_CACHE_MAX_ENTRIES = 256
+image_cache = DockerCache(ttl=None, max_entries=IMAGE_CACHE_MAX_ENTRIES)
+
+
+def invalidate_docker_container(long_id):
+    inspect_cache.invalidate(lambda key: key == long_id)
+
+
+def invalidate_docker_image(image_id):
+    image_cache.invalidate(lambda key: key[1] == image_id)
+
+
+def get_docker_cache_stats():
+    return {'inspect': inspect_cache.get_stats(),
+            'image': image_cache.get_stats()}
+
+
+def _new_client():
+    global _api_version
+    client = docker.Client(base_url=DOCKER_SOCKET_URL, version=_api_version)
+    version = getattr(client, 'api_version', None)
+    if isinstance(version, basestring):
+        _api_version = version
+    return client
+
+
+def _get_client():
+    """
+    Returns the docker client shared by all the calls in this process. Its
+    connections to the docker socket are kept alive, and the API version is
+    only negotiated once.
+    """
+    global _client, _client_pid
+    with _client_lock:
+        if not _client or _client_pid != os.getpid():
+            _client = _new_client()
+            _client_pid = os.getpid()
+        return _client
+
+
+def _reset_client():
+    global _client
+    with _client_lock:
+        if _client and _client_pid == os.getpid():
+            try:
+                _client.close()
+            except Exception:
+                pass
+        _client = None
+
+
+def _call_docker(method, *args, **kwargs):
+    """
+    Calls `method` of the shared docker client. If the connection to the
+    docker daemon fails, the call is retried once with a new client.
+    """
+    for attempt in [0, 1]:
+        try:
+            return getattr(_get_client(), method)(*args, **kwargs)
+        except docker.errors.APIError:
+            # The daemon is there, it's just an error response
+            raise
+        except (docker.errors.DockerException,
+                requests.exceptions.ConnectionError) as e:
+            _reset_client()
+            if attempt:
+                raise docker.errors.DockerException(str(e))
+            logger.debug('Reconnecting to the docker daemon: %s' % e)
+
 
 def exec_dockerps():
     """
@@ -24,9 +192,7 @@ def exec_dockerps():
     This call executes the `docker inspect` command every time it is invoked.
     """
     try:
-	client = docker.Client(
-	    base_url='unix://var/run/docker.sock', version='auto')
-	containers = client.containers()
+	containers = _call_docker('containers')
 	inspect_arr = []
 	for container in containers:
 	    inspect = exec_dockerinspect(container['Id'])
@@ -38,14 +204,40 @@ def exec_dockerps():
     return inspect_arr
 
 
-def exec_docker_history(long_id):
+def exec_docker_container_ids():
+    """
+    Returns the IDs of the running containers, without inspecting them.
+    """
     try:
-	client = docker.Client(base_url='unix://var/run/docker.sock',
-                               version='auto')
-	image = client.inspect_container(long_id)['Image']
-	history = client.history(image)
-	return history
+        return [container['Id'] for container in _call_docker('containers')]
     except docker.errors.DockerException as e:
+        logger.warning(str(e))
+        raise DockerutilsException('Failed to exec dockerps')
+
+
+def exec_docker_events(since=None):
+    """
+    Returns a generator of the docker events (as dicts) that happen from now
+    on, or from `since` (a UTC timestamp) on. The generator blocks waiting
+    for events and only ends if the connection to docker is lost.
+    """
+    try:
+        # The stream holds its connection for as long as it lasts, so it gets
+        # its own client.
+        client = _new_client()
+        for event in client.events(since=since, decode=True):
+            yield event
+    except (docker.errors.DockerException, IOError, ValueError) as e:
+        logger.warning(str(e))
+        raise DockerutilsException('Failed to get the docker events')
+
+
+def exec_docker_history(long_id):
+    try:
+        image = exec_dockerinspect(long_id)['Image']
+        return image_cache.get(('history', image),
+                               lambda: _call_docker('history', image))
+    except (docker.errors.DockerException, DockerutilsException) as e:
         logger.warning(str(e))
         raise DockerutilsException('Failed to exec dockerhistory')
 
@@ -63,38 +255,48 @@ def _reformat_inspect(inspect):
 
 
 def exec_dockerinspect(long_id):
+    return inspect_cache.get(long_id, lambda: _exec_dockerinspect(long_id))
+
+
+def _exec_dockerinspect(long_id):
     try:
-	client = docker.Client(
-	    base_url='unix://var/run/docker.sock', version='auto')
-	inspect = client.inspect_container(long_id)
+	inspect = _call_docker('inspect_container', long_id)
 	_reformat_inspect(inspect)
     except docker.errors.DockerException as e:
         logger.warning(str(e))
         raise DockerutilsException('Failed to exec dockerinspect')
     
     try:
-        # get the first RepoTag
-        inspect['RepoTag'] = client.inspect_image(inspect['Image'])['RepoTags'][0]
-    except (docker.errors.DockerException, KeyError, IndexError):
+        inspect['RepoTag'] = image_cache.get(
+            ('repotag', inspect['Image']),
+            lambda: _get_image_repo_tag(inspect['Image']))
+    except docker.errors.DockerException:
         inspect['RepoTag'] = ''
 
     return inspect
 
 
+def _get_image_repo_tag(image):
+    try:
+        # get the first RepoTag
+        return _call_docker('inspect_image', image)['RepoTags'][0]
+    except (KeyError, IndexError):
+        return ''
+
+
 def _get_docker_storage_driver():
     """
     We will try several steps in order to ensure that we return
-    one of the 4 types (btrfs, devicemapper, aufs, vfs).
+    one of the 6 types (btrfs, devicemapper, aufs, vfs, overlay, overlay2).
     """
     driver = None
-    all_drivers = ['btrfs', 'devicemapper', 'aufs', 'vfs']
+    all_drivers = ['btrfs', 'devicemapper', 'aufs', 'vfs', 'overlay',
+                   'overlay2']
 
     # Step 1, get it from "docker info"
 
     try:
-        client = docker.Client(
-            base_url='unix://var/run/docker.sock', version='auto')
-        driver = client.info()['Driver']
+        driver = _call_docker('info')['Driver']
     except (docker.errors.DockerException, KeyError):
         pass # try to continue with the default of 'devicemapper'
 
@@ -188,9 +390,7 @@ def _get_docker_server_version():
     """Run the `docker info` command to get server version
     """
     try:
-        client = docker.Client(
-            base_url='unix://var/run/docker.sock', version='auto')
-        return client.version()['Version']
+        return _call_docker('version')['Version']
     except (docker.errors.DockerException, KeyError) as e:
         logger.warning(str(e))
         raise DockerutilsException('Failed to get the docker version')
@@ -329,8 +529,51 @@ def get_docker_container_rootfs_path(long_id, inspect=None):
             raise DockerutilsException('Failed to get rootfs on vfs')
         rootfs_path = '/var/lib/docker/vfs/dir/' + vfs_path
 
+    elif driver in ['overlay', 'overlay2']:
+
+        if not inspect:
+            inspect = exec_dockerinspect(long_id)
+        try:
+            rootfs_path = inspect['GraphDriver']['Data']['MergedDir']
+        except (KeyError, TypeError):
+            raise DockerutilsException('Failed to get rootfs on ' + driver)
+
     else:
 
         raise DockerutilsException('Not supported docker storage driver.')
 
     return rootfs_path
+
+
+def get_docker_container_layers(long_id, inspect=None):
+    """
+    Returns (image_id, rootfs_path, upper_dir) for a container (with
+    ID=long_id): its image, its root as returned by
+    `get_docker_container_rootfs_path()`, and its writable layer in the
+    docker host file system. The writable layer only has what the container
+    added, changed or deleted on top of its image.
+
+    Only the union file system drivers (aufs and overlay) keep the writable
+    layer apart from the image, for the others this raises a
+    DockerutilsException.
+    """
+    if not inspect:
+        inspect = exec_dockerinspect(long_id)
+    rootfs_path = get_docker_container_rootfs_path(long_id, inspect)
+
+    upper_dir = None
+    if driver == 'aufs':
+        # The branch of the container is the diff with the name of its mount
+        upper_dir = rootfs_path.replace('/aufs/mnt/', '/aufs/diff/', 1)
+    elif driver in ['overlay', 'overlay2']:
+        try:
+            upper_dir = inspect['GraphDriver']['Data']['UpperDir']
+        except (KeyError, TypeError):
+            pass
+    else:
+        raise DockerutilsException('The %s storage driver has no writable '
+                                   'layer.' % driver)
+    if not upper_dir or not os.path.isdir(upper_dir):
+        raise DockerutilsException('Failed to get the writable layer on ' +
+                                   driver)
+    return (inspect['Image'], rootfs_path, upper_dir)
@@ -0,0 +1,270 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Frames published in the background, so that a crawl does not wait for its
+frame to be sent. Every url (sink) has its own bounded queue of frames and
+its own thread, so a slow or unreachable sink only delays its own frames.
+
+When the queue of a sink is full, the policy decides what happens to the
+next frame:
+- 'block': the crawl waits for the sink to take a frame;
+- 'drop_newest': the new frame is dropped;
+- 'drop_oldest': the oldest frame of the queue is dropped;
+- 'spill': the new frame is written to a temporary file instead of being
+  kept in memory, up to `max_spilled` frames over the queue size, and the
+  oldest frames are dropped after that.
+"""
+import os
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import cStringIO
+from collections import deque
+
+import defaults
+
+logger = logging.getLogger('crawlutils')
+
+EMIT_QUEUE_POLICIES = ['block', 'drop_newest', 'drop_oldest', 'spill']
+
+
+class QueuedFrame(object):
+    """
+    The contents of a frame waiting to be published to `num_sinks` sinks,
+    each of them reading it from its own file object. The frame is copied
+    from `framefile` to a temporary file if `on_disk`, or else to memory.
+    """
+
+    def __init__(self, framefile, num_sinks, on_disk=False):
+        self.num_sinks = num_sinks
+        self.data = None
+        self.path = None
+        self._lock = threading.Lock()
+        framefile.seek(0)
+        if on_disk:
+            self._write_file(framefile)
+        else:
+            self.data = framefile.read()
+
+    def _write_file(self, fp):
+        (fd, self.path) = tempfile.mkstemp(prefix='emit.')
+        with os.fdopen(fd, 'wb') as tmp:
+            shutil.copyfileobj(fp, tmp)
+
+    def open(self):
+        with self._lock:
+            if self.path:
+                return open(self.path, 'rb')
+            return cStringIO.StringIO(self.data)
+
+    def spill(self):
+        """
+        Moves the frame from memory to a temporary file.
+        """
+        with self._lock:
+            if self.path or self.data is None:
+                return
+            self._write_file(cStringIO.StringIO(self.data))
+            self.data = None
+
+    def release(self):
+        """
+        Called once by every sink done with the frame.
+        """
+        with self._lock:
+            self.num_sinks -= 1
+            if self.num_sinks > 0:
+                return
+            self.data = None
+            if self.path:
+                try:
+                    os.remove(self.path)
+                except OSError:
+                    pass
+                self.path = None
+
+
+class SinkQueue(object):
+    """
+    The frames waiting to be published to `url`. `publish(url, frame)` is
+    called from the thread of the queue for each of them.
+    """
+
+    def __init__(
+        self,
+        url,
+        max_frames=defaults.DEFAULT_EMIT_QUEUE_SIZE,
+        policy=defaults.DEFAULT_EMIT_QUEUE_POLICY,
+        max_spilled=defaults.DEFAULT_EMIT_QUEUE_MAX_SPILLED,
+    ):
+        if policy not in EMIT_QUEUE_POLICIES:
+            raise ValueError('Unknown emit queue policy %s' % policy)
+        self.url = url
+        self.max_frames = max(max_frames, 1)
+        self.policy = policy
+        self.max_spilled = max_spilled
+
+        # (publish, frame, time queued)
+        self._frames = deque()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._busy = False
+
+        self.queued = 0
+        self.published = 0
+        self.failed = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def _drop_oldest(self):
+        (_, frame, _) = self._frames.popleft()
+        frame.release()
+        self.dropped += 1
+
+    def put(self, publish, frame):
+        """
+        Queues `frame` to be published with `publish(url, frame)`, and
+        returns False if it was dropped instead.
+        """
+        with self._condition:
+            if len(self._frames) >= self.max_frames:
+                if self.policy == 'block':
+                    while len(self._frames) >= self.max_frames:
+                        self._condition.wait()
+                elif self.policy == 'drop_newest':
+                    frame.release()
+                    self.dropped += 1
+                    logger.warning('Emit queue for %s is full, dropping a '
+                                   'frame' % self.url)
+                    return False
+                elif self.policy == 'drop_oldest':
+                    self._drop_oldest()
+                    logger.warning('Emit queue for %s is full, dropping its '
+                                   'oldest frame' % self.url)
+                else:
+                    if len(self._frames) >= \
+                            self.max_frames + self.max_spilled:
+                        self._drop_oldest()
+                        logger.warning('Emit queue for %s is full, dropping '
+                                       'its oldest frame' % self.url)
+                    frame.spill()
+                    self.spilled += 1
+            self._frames.append((publish, frame, time.time()))
+            self.queued += 1
+            self.max_depth = max(self.max_depth, len(self._frames))
+            if not self._thread:
+                self._thread = threading.Thread(
+                    target=self._run, name='emit-%s' % self.url)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify_all()
+        return True
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._frames:
+                    self._busy = False
+                    self._condition.notify_all()
+                    self._condition.wait()
+                (publish, frame, queued_time) = self._frames.popleft()
+                self._busy = True
+                # Room for a blocked put()
+                self._condition.notify_all()
+            start = time.time()
+            try:
+                publish(self.url, frame)
+                failed = False
+            except Exception:
+                logger.exception('Could not emit a frame to %s' % self.url)
+                failed = True
+            finally:
+                frame.release()
+            latency = time.time() - start
+            with self._condition:
+                if failed:
+                    self.failed += 1
+                else:
+                    self.published += 1
+                self.total_wait += start - queued_time
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+
+    def drain(self, timeout=None):
+        """
+        Waits up to `timeout` seconds for the frames queued to be published,
+        and returns True if they were.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._frames or self._busy:
+                remaining = None if deadline is None else \
+                    deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def get_stats(self):
+        with self._condition:
+            done = self.published + self.failed
+            return {'depth': len(self._frames),
+                    'max_depth': self.max_depth,
+                    'queued': self.queued,
+                    'published': self.published,
+                    'failed': self.failed,
+                    'dropped': self.dropped,
+                    'spilled': self.spilled,
+                    'avg_wait': self.total_wait / done if done else 0.0,
+                    'avg_latency': (self.total_latency / done
+                                    if done else 0.0),
+                    'max_latency': self.max_latency}
+
+
+# The queues of this process, by url
+_queues = {}
+_queues_pid = None
+_queues_lock = threading.Lock()
+
+
+def get_emit_queue(url, max_frames=defaults.DEFAULT_EMIT_QUEUE_SIZE,
+                   policy=defaults.DEFAULT_EMIT_QUEUE_POLICY):
+    global _queues, _queues_pid
+    with _queues_lock:
+        if _queues_pid != os.getpid():
+            # The threads of the parent are not running in this process
+            _queues = {}
+            _queues_pid = os.getpid()
+        queue = _queues.get(url)
+        if not queue:
+            queue = SinkQueue(url, max_frames, policy)
+            _queues[url] = queue
+        return queue
+
+
+def drain_emit_queues(timeout=None):
+    """
+    Waits up to `timeout` seconds for all the frames queued in this process
+    to be published, and returns True if they were.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    with _queues_lock:
+        queues = _queues.values() if _queues_pid == os.getpid() else []
+    drained = True
+    for queue in queues:
+        remaining = None if deadline is None else \
+            max(deadline - time.time(), 0)
+        drained = queue.drain(remaining) and drained
+    return drained
+
+
+def get_emit_queue_stats():
+    with _queues_lock:
+        queues = _queues.values() if _queues_pid == os.getpid() else []
+    return dict((queue.url, queue.get_stats()) for queue in queues)
@@ -9,60 +9,61 @@ import time
 import csv
 import copy
 import sys
+import cStringIO
 from mtgraphite import MTGraphiteClient
 import json
-import multiprocessing
-import Queue
+import threading
 from crawler_exceptions import (EmitterUnsupportedFormat,
                                 EmitterUnsupportedProtocol,
                                 EmitterBadURL,
                                 EmitterEmitTimeout)
-# External dependencies that must be pip install'ed separately
-
-import kafka as kafka_python
-import pykafka
-import requests
 
 from features import (OSFeature, FileFeature, ConfigFeature, DiskFeature,
                       ProcessFeature, MetricFeature, ConnectionFeature,
                       PackageFeature, MemoryFeature, CpuFeature,
                       InterfaceFeature, LoadFeature, DockerPSFeature,
                       DockerHistoryFeature)
-from misc import NullHandler
+from kafka_producer import get_kafka_producer, forget_kafka_producer
+from http_sink import http_post, get_http_batch
+from emit_queue import QueuedFrame, get_emit_queue
+from frame_spool import get_frame_spool
+import defaults
 
 
 logger = logging.getLogger('crawlutils')
 
+_PROTOCOLS = ('stdout://', 'http://', 'file://', 'kafka://', 'mtgraphite://')
 
-def kafka_send(kurl, temp_fpath, format, topic, queue=None):
-    try:
-        kafka_python_client = kafka_python.KafkaClient(kurl)
-        kafka_python_client.ensure_topic_exists(topic)
-        kafka = pykafka.KafkaClient(hosts=kurl)
-
-        publish_topic_object = kafka.topics[topic]
-        # the default partitioner is random_partitioner
-        producer = publish_topic_object.get_producer()
-
-        if format == 'csv':
-            with open(temp_fpath, 'r') as fp:
-                text = fp.read()
-                producer.produce([text])
-        elif format == 'graphite':
-            with open(temp_fpath, 'r') as fp:
-                for line in fp.readlines():
-                    producer.produce([line])
-        else:
-            raise EmitterUnsupportedFormat('Unsupported format: %s' % format)
 
-        queue and queue.put((True, None))
-    except Exception as e:
-        if queue:
-            queue.put((False, e))
-        else:
-            raise
-    finally:
-        queue and queue.close()
+def _parse_kafka_url(url):
+    list = url[len('kafka://'):].split('/')
+
+    if len(list) == 2:
+        return list
+    raise EmitterBadURL(
+        'The kafka url provided does not seem to be valid: %s. '
+        'It should be something like this: '
+        'kafka://[ip|hostname]:[port]/[kafka_topic]. '
+        'For example: kafka://1.1.1.1:1234/metrics' % url)
+
+
+def _kafka_messages(format, frame):
+    if format == 'csv':
+        return [frame]
+    elif format == 'graphite':
+        return cStringIO.StringIO(frame).readlines()
+    raise EmitterUnsupportedFormat('Unsupported format: %s' % format)
+
+
+def send_to_kafka(kurl, topic, messages, timeout_secs):
+    # The producer is kept for the next frames, and sends the messages from
+    # its own thread
+    producer = get_kafka_producer(kurl, topic, timeout_secs)
+    try:
+        producer.send(messages).wait(timeout_secs)
+    except EmitterEmitTimeout:
+        forget_kafka_producer(kurl, topic)
+        raise
 
 
 class Emitter:
@@ -78,6 +79,7 @@ class Emitter:
     # persists across metric intervals.
 
     mtgclient = None
+    mtgclient_lock = threading.Lock()
 
     kafka_timeout_secs = 30
 
@@ -90,7 +92,15 @@ class Emitter:
         emitter_args={},
         format='csv',
         max_emit_retries=9,
-        kafka_timeout_secs=30
+        kafka_timeout_secs=30,
+        spill_size=defaults.DEFAULT_FRAME_SPILL_SIZE,
+        http_batch_bytes=defaults.DEFAULT_HTTP_BATCH_BYTES,
+        http_batch_secs=defaults.DEFAULT_HTTP_BATCH_SECS,
+        emit_queue_size=defaults.DEFAULT_EMIT_QUEUE_SIZE,
+        emit_queue_policy=defaults.DEFAULT_EMIT_QUEUE_POLICY,
+        spool_dir=defaults.DEFAULT_SPOOL_DIR,
+        spool_max_bytes=defaults.DEFAULT_SPOOL_MAX_BYTES,
+        spool_max_age=defaults.DEFAULT_SPOOL_MAX_AGE,
     ):
 
         self.urls = urls
@@ -100,19 +110,25 @@ class Emitter:
         self.max_emit_retries = max_emit_retries
         self.mtgclient = None
         self.kafka_timeout_secs = kafka_timeout_secs
+        self.spill_size = spill_size
+        self.http_batch_bytes = http_batch_bytes
+        self.http_batch_secs = http_batch_secs
+        self.emit_queue_size = emit_queue_size
+        self.emit_queue_policy = emit_queue_policy
+        self.spool_dir = spool_dir
+        self.spool_max_bytes = spool_max_bytes
+        self.spool_max_age = spool_max_age
 
     def __enter__(self):
-        (self.temp_fd, self.temp_fpath) = \
-            tempfile.mkstemp(prefix='emit.')
-        os.close(self.temp_fd)  # close temporary file descriptor
-
-        # as we open immediately
-        # need to find a better fix later
-
+        # The frame is built in memory, and only written to a temporary file
+        # if it grows over spill_size bytes (compressed).
+        self.framefile = tempfile.SpooledTemporaryFile(
+            max_size=self.spill_size, prefix='emit.')
         if self.compress:
-            self.emitfile = gzip.open(self.temp_fpath, 'wb')
+            self.emitfile = gzip.GzipFile(filename='', mode='wb',
+                                          fileobj=self.framefile)
         else:
-            self.emitfile = open(self.temp_fpath, 'wb')
+            self.emitfile = self.framefile
         self.csv_writer = csv.writer(self.emitfile, delimiter='\t',
                                      quotechar="'")
         self.begin_time = time.time()
@@ -227,133 +243,146 @@ class Emitter:
 
     def _close_file(self):
 
-        # close the output file
+        # Finish the gzip stream, the frame itself is kept until __exit__
+        # is done with it
+
+        if self.emitfile is not self.framefile:
+            self.emitfile.close()
+
+    def _read_frame(self):
+        self.framefile.seek(0)
+        return self.framefile.read()
 
-        self.emitfile.close()
+    def _read_frame_lines(self):
+        self.framefile.seek(0)
+        return self.framefile.readlines()
 
     def _publish_to_stdout(self):
         if self.format == 'json':
             raise NotImplementedError('json format is not supported')
-        with open(self.temp_fpath, 'r') as fd:
-            if self.compress:
-                print '%s' % fd.read()
-            else:
-                for line in fd.readlines():
-                    print line.strip()
-                    sys.stdout.flush()
+        if self.compress:
+            print '%s' % self._read_frame()
+        else:
+            for line in self._read_frame_lines():
+                print line.strip()
+                sys.stdout.flush()
 
-    def __make_http_post(self, url, headers, payload, max_emit_retries):
-        for attempt in range(max_emit_retries):
-            try:
-                response = requests.post(
-                    url, headers=headers, params=self.emitter_args, data=payload)
-            except requests.exceptions.ChunkedEncodingError as e:
-                logger.exception(e)
-                logger.error(
-                    "POST to %s resulted in exception (attempt %d of %d), will not re-try" %
-                    (url, attempt + 1, max_emit_retries))
-                break
-            except requests.exceptions.RequestException as e:
-                logger.exception(e)
+    def _read_uncompressed_frame_lines(self):
+        self.framefile.seek(0)
+        if self.compress:
+            return gzip.GzipFile(fileobj=self.framefile, mode='rb')
+        return self.framefile
+
+    def _json_features(self):
+        """
+        Yields the features of the frame as json objects, with the namespace
+        of the frame in all of them.
+        """
+        namespace = None
+        for feature in self._read_uncompressed_frame_lines():
+            feature_parts = feature.split()
+            if len(feature_parts) < 3:
                 logger.error(
-                    "POST to %s resulted in exception (attempt %d of %d)" %
-                    (url, attempt + 1, max_emit_retries))
-                time.sleep(2.0 ** attempt * 0.1)
+                    "Invalid feature data found. %s %d" %
+                    (feature_parts, len(feature_parts)))
                 continue
-            if response.status_code != requests.codes.ok:
-                logger.error("POST to %s resulted in status code %s: %s (attempt %d of %d)" % (
-                    url, str(response.status_code), response.text, attempt + 1, max_emit_retries))
-                time.sleep(2.0 ** attempt * 0.1)
-            else:
-                break
 
-    def _publish_to_http(self, url, max_emit_retries=5):
-        namespace = None
-        headers = {}
-        if self.compress:
-            headers['content-encoding'] = 'gzip'
-        with open(self.temp_fpath, 'rb') as framefp:
-            if self.format == 'json':
-                headers = {'content-type': 'application/json'}
-                for feature in framefp:
-                    feature_parts = feature.split()
-                    if len(feature_parts) < 3:
-                        logger.error(
-                            "Invalid feature data found. %s %d" %
-                            (feature_parts, len(feature_parts)))
-                        continue
-
-                    feature_name = feature_parts[0]
-                    feature_value = feature_parts[1].strip("\"")
-
-                    feature_data = json.loads("".join(feature_parts[2:]))
-
-                    if feature_name == "metadata":
-                        namespace = feature_data.get('namespace', None)
-                    else:
-                        feature_data['namespace'] = namespace
-                    feature_data[feature_name] = feature_value
-                    payload = json.dumps(feature_data)
-                    self.__make_http_post(
-                        url, headers, payload, max_emit_retries)
-
-            elif self.format == 'csv' or self.format == 'graphite':
-                headers = {'content-type': 'application/csv'}
-                self.__make_http_post(url, headers, framefp, max_emit_retries)
-            else:
-                raise EmitterUnsupportedFormat(
-                    'Unsupported format: %s' % self.format)
+            feature_name = feature_parts[0]
+            feature_value = feature_parts[1].strip("\"")
 
-    def _publish_to_kafka_no_retries(self, url):
+            feature_data = json.loads("".join(feature_parts[2:]))
 
-        list = url[len('kafka://'):].split('/')
-
-        if len(list) == 2:
-            kurl, topic = list
+            if feature_name == "metadata":
+                namespace = feature_data.get('namespace', None)
+            else:
+                feature_data['namespace'] = namespace
+            feature_data[feature_name] = feature_value
+            yield json.dumps(feature_data)
+
+    def _get_spool(self, url):
+        """
+        Returns the spool of `url`, or None if frames are not spooled. The
+        requests that fail are spooled, to be sent again later, instead of
+        being retried on the spot.
+        """
+        if not self.spool_dir:
+            return None
+        if url.startswith('kafka://'):
+            (kurl, topic) = _parse_kafka_url(url)
+            timeout_secs = self.kafka_timeout_secs
+
+            def send(header, body):
+                send_to_kafka(kurl, topic,
+                              _kafka_messages(header['format'], body),
+                              timeout_secs)
         else:
-            raise EmitterBadURL(
-                'The kafka url provided does not seem to be valid: %s. '
-                'It should be something like this: '
-                'kafka://[ip|hostname]:[port]/[kafka_topic]. '
-                'For example: kafka://1.1.1.1:1234/metrics' % url)
-
-        # Kafka logs too much
-        h = NullHandler()
-        logging.getLogger('kafka').addHandler(h)
-
-        queue = multiprocessing.Queue()
-        try:
-            child_process = multiprocessing.Process(
-                name='kafka-emitter', target=kafka_send, args=(
-                    kurl, self.temp_fpath, self.format, topic, queue))
-            child_process.start()
-        except OSError:
-            queue.close()
-            raise
-
-        try:
-            (result, child_exception) = queue.get(
-                timeout=self.kafka_timeout_secs)
-        except Queue.Empty:
-            child_exception = EmitterEmitTimeout()
+            def send(header, body):
+                return http_post(url, header['headers'], body, 1,
+                                 params=header.get('params'))
+        return get_frame_spool(self.spool_dir, url, send,
+                               max_bytes=self.spool_max_bytes,
+                               max_age_secs=self.spool_max_age)
+
+    def _http_post(self, url, headers, payload, max_emit_retries):
+        spool = self._get_spool(url)
+        if spool:
+            spool.submit({'headers': headers, 'params': self.emitter_args},
+                         payload)
+        else:
+            http_post(url, headers, payload, max_emit_retries,
+                      params=self.emitter_args)
 
-        child_process.join(self.kafka_timeout_secs)
+    def _publish_to_http_batch(self, url, max_emit_retries=5):
+        # The frames (or json features) posted together carry their own
+        # metadata, so the one of this frame is not sent as query params
+        if self.format == 'json':
+            content_type = 'application/x-ndjson'
+            records = [feature + '\n' for feature in self._json_features()]
+        elif self.format == 'csv' or self.format == 'graphite':
+            content_type = 'application/csv'
+            records = list(self._read_uncompressed_frame_lines())
+        else:
+            raise EmitterUnsupportedFormat(
+                'Unsupported format: %s' % self.format)
+        batch = get_http_batch(url, content_type, self.compress,
+                               self.http_batch_bytes, self.http_batch_secs,
+                               max_emit_retries, spool=self._get_spool(url))
+        batch.add(records)
 
-        if child_process.is_alive():
-            errmsg = ('Timed out waiting for process %d to exit.' %
-                      child_process.pid)
-            queue.close()
-            os.kill(child_process.pid, 9)
-            logger.error(errmsg)
-            raise EmitterEmitTimeout(errmsg)
+    def _publish_to_http(self, url, max_emit_retries=5):
+        if self.http_batch_bytes:
+            self._publish_to_http_batch(url, max_emit_retries)
+        elif self.format == 'json':
+            headers = {'content-type': 'application/json'}
+            for payload in self._json_features():
+                self._http_post(url, headers, payload, max_emit_retries)
+
+        elif self.format == 'csv' or self.format == 'graphite':
+            headers = {'content-type': 'application/csv'}
+            self._http_post(url, headers, self._read_frame(),
+                            max_emit_retries)
+        else:
+            raise EmitterUnsupportedFormat(
+                'Unsupported format: %s' % self.format)
 
-        if child_exception:
-            raise child_exception
+    def _publish_to_kafka_no_retries(self, url):
+        (kurl, topic) = _parse_kafka_url(url)
+        send_to_kafka(kurl, topic,
+                      _kafka_messages(self.format, self._read_frame()),
+                      self.kafka_timeout_secs)
 
     def _publish_to_kafka(self, url, max_emit_retries=8):
         if self.format == 'json':
             raise NotImplementedError('json format is not supported')
 
+        spool = self._get_spool(url)
+        if spool:
+            if self.format not in ['csv', 'graphite']:
+                raise EmitterUnsupportedFormat(
+                    'Unsupported format: %s' % self.format)
+            spool.submit({'format': self.format}, self._read_frame())
+            return
+
         broker_alive = False
         retries = 0
         while not broker_alive and retries <= max_emit_retries:
@@ -380,11 +409,12 @@ class Emitter:
     def _publish_to_mtgraphite(self, url):
         if self.format == 'json':
             raise NotImplementedError('json format is not supported')
-        if not Emitter.mtgclient:
-            Emitter.mtgclient = MTGraphiteClient(url)
-        with open(self.temp_fpath, 'r') as fp:
+        # Frames for several containers can be emitted concurrently.
+        with Emitter.mtgclient_lock:
+            if not Emitter.mtgclient:
+                Emitter.mtgclient = MTGraphiteClient(url)
             num_pushed_to_queue = \
-                Emitter.mtgclient.send_messages(fp.readlines())
+                Emitter.mtgclient.send_messages(self._read_frame_lines())
             logger.debug('Pushed %d messages to mtgraphite queue'
                          % num_pushed_to_queue)
 
@@ -394,7 +424,61 @@ class Emitter:
         output_path = url[len('file://'):]
         if self.compress:
             output_path += '.gz'
-        shutil.move(self.temp_fpath, output_path)
+        # Written next to the output file first, so that it never shows
+        # half written
+        (temp_fd, temp_path) = tempfile.mkstemp(
+            prefix='.emit.', dir=os.path.dirname(output_path) or '.')
+        try:
+            with os.fdopen(temp_fd, 'wb') as fp:
+                self.framefile.seek(0)
+                shutil.copyfileobj(self.framefile, fp)
+            os.rename(temp_path, output_path)
+        except:
+            os.remove(temp_path)
+            raise
+
+    def _publish(self, url):
+        logger.debug('Emitting frame to {0}'.format(url))
+        if url.startswith('stdout://'):
+            self._publish_to_stdout()
+        elif url.startswith('http://'):
+            self._publish_to_http(url, self.max_emit_retries)
+        elif url.startswith('file://'):
+            self._write_to_file(url)
+        elif url.startswith('kafka://'):
+            self._publish_to_kafka(url, self.max_emit_retries)
+        elif url.startswith('mtgraphite://'):
+            self._publish_to_mtgraphite(url)
+        else:
+            raise EmitterUnsupportedProtocol(
+                'Unsupported URL protocol {0}'.format(url))
+
+    def _publish_queued(self, url, frame):
+        # Called from the thread of the queue of the url. Every sink reads
+        # the frame from its own file object.
+        emitter = copy.copy(self)
+        emitter.framefile = frame.open()
+        try:
+            emitter._publish(url)
+        finally:
+            emitter.framefile.close()
+
+    def _queue_frame(self):
+        for url in self.urls:
+            if not url.startswith(_PROTOCOLS):
+                raise EmitterUnsupportedProtocol(
+                    'Unsupported URL protocol {0}'.format(url))
+        # A frame over spill_size is kept on disk while it is queued
+        self.framefile.seek(0, os.SEEK_END)
+        on_disk = bool(self.spill_size) and \
+            self.framefile.tell() > self.spill_size
+        if on_disk:
+            self.framefile.rollover()
+        frame = QueuedFrame(self.framefile, len(self.urls), on_disk)
+        for url in self.urls:
+            get_emit_queue(url, self.emit_queue_size,
+                           self.emit_queue_policy).put(
+                self._publish_queued, frame)
 
     def __exit__(
         self,
@@ -404,35 +488,22 @@ class Emitter:
     ):
         if exc:
             self._close_file()
-            if os.path.exists(self.temp_fpath):
-                os.remove(self.temp_fpath)
+            self.framefile.close()
             return False
         try:
             self._close_file()
-            for url in self.urls:
-                logger.debug('Emitting frame to {0}'.format(url))
-                if url.startswith('stdout://'):
-                    self._publish_to_stdout()
-                elif url.startswith('http://'):
-                    self._publish_to_http(url, self.max_emit_retries)
-                elif url.startswith('file://'):
-                    self._write_to_file(url)
-                elif url.startswith('kafka://'):
-                    self._publish_to_kafka(url, self.max_emit_retries)
-                elif url.startswith('mtgraphite://'):
-                    self._publish_to_mtgraphite(url)
-                else:
-                    if os.path.exists(self.temp_fpath):
-                        os.remove(self.temp_fpath)
-                    raise EmitterUnsupportedProtocol(
-                        'Unsupported URL protocol {0}'.format(url))
+            if self.emit_queue_size:
+                self._queue_frame()
+            else:
+                for url in self.urls:
+                    self._publish(url)
         finally:
-            if os.path.exists(self.temp_fpath):
-                os.remove(self.temp_fpath)
+            self.framefile.close()
         self.end_time = time.time()
         elapsed_time = self.end_time - self.begin_time
         logger.info(
-            'Emitted {0} features in {1} seconds'.format(
+            '{0} {1} features in {2} seconds'.format(
+                'Queued' if self.emit_queue_size else 'Emitted',
                 self.num_features,
                 elapsed_time))
         return True
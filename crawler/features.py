@@ -27,6 +27,7 @@ FileFeature = namedtuple('FileFeature', [
     'uid',
 ])
 ConfigFeature = namedtuple('ConfigFeature', ['name', 'content', 'path'])
+ConfigHashFeature = namedtuple('ConfigHashFeature', ['name', 'sha256', 'path'])
 DiskFeature = namedtuple('DiskFeature', [
     'partitionname',
     'freepct',
@@ -9,9 +9,9 @@ import codecs
 import subprocess
 import tempfile
 import shutil
-import fnmatch
 import re
 import time
+import uuid
 import cPickle as pickle
 
 # Additional modules
@@ -26,10 +26,27 @@ try:
 except ImportError:
     system_info = None
 
-from namespace import run_as_another_namespace, ALL_NAMESPACES
-from crawler_exceptions import CrawlError
+from namespace import (run_as_another_namespace, get_pid_namespace,
+                       ALL_NAMESPACES)
+from crawler_exceptions import CrawlError, DockerutilsException
 import dockerutils
-from features import (OSFeature, FileFeature, ConfigFeature, DiskFeature,
+import defaults
+from file_index import get_file_index, get_file_index_path
+import dirwalk
+from path_matcher import get_path_matcher
+from config_cache import (get_config_cache, CONFIG_CACHE_MODES,
+                          CONFIG_CACHE_HASH)
+from process_table import (get_process_table, get_container_process_table,
+                           read_cgroup_pids, list_namespace_pids, FIELD_CWD,
+                           FIELD_OPEN_FILES, FIELD_IO)
+from net_connections import get_connections
+from net_interfaces import get_interface_counters
+from delta_store import get_delta_store, container_owner, HOST_OWNER
+from cpu_sampler import CPU_KEY
+from image_layers import (read_layer_changes, crawl_layered, get_image_crawl,
+                          put_image_crawl, is_under)
+from features import (OSFeature, FileFeature, ConfigFeature,
+                      ConfigHashFeature, DiskFeature,
                       ProcessFeature, MetricFeature, ConnectionFeature,
                       PackageFeature, MemoryFeature, CpuFeature,
                       InterfaceFeature, LoadFeature, DockerPSFeature,
@@ -41,6 +58,29 @@ from package_utils import get_rpm_packages, get_dpkg_packages
 
 logger = logging.getLogger('crawlutils')
 
+# Where the package managers keep their databases, relative to the root
+_PACKAGE_DB_DIRS = ['var/lib/dpkg', 'var/lib/rpm', 'usr/lib/sysimage/rpm']
+
+
+def read_container_cpu_usage(container, per_cpu=False):
+    """
+    Returns the CPU time used by `container` in nanoseconds, as a list with
+    the time of every CPU if `per_cpu`, or else with the total.
+    """
+    if container.get_cgroup_version('cpuacct') != 2:
+        stat_file_name = ('cpuacct.usage_percpu' if per_cpu else
+                          'cpuacct.usage')
+        with open(container.get_cpu_cgroup_path(stat_file_name), 'r') as f:
+            return f.readline().strip().split(' ')
+
+    # There is only the total in cgroup v2, in microseconds
+    with open(container.get_cpu_cgroup_path('cpu.stat'), 'r') as f:
+        for line in f:
+            (key, _, value) = line.strip().partition(' ')
+            if key == 'usage_usec':
+                return [int(value) * 1000]
+    raise CrawlError('No usage_usec in cpu.stat')
+
 
 class FeaturesCrawler:
 
@@ -60,6 +100,7 @@ class FeaturesCrawler:
         crawl_mode=Modes.INVM,
         vm=None,
         container=None,
+        process_table=False,
     ):
 
         # Some quick sanity checks
@@ -83,23 +124,62 @@ class FeaturesCrawler:
         self.container = container
         self.vm = vm
 
-    """
-    To calculate rates like packets sent per second, we need to
-    store the last measurement. We store it in this dictionary.
-    """
-    _cached_values = {}
+        # Whether the process, metric and connection features are crawled
+        # from a snapshot of /proc, taken once for all the features of this
+        # frame, instead of querying psutil for each of them.
+        self.process_table = process_table
+        self.frame_id = uuid.uuid4().hex
+
+        # (image_id, rootfs_dir, changes) of the container, read once for
+        # all the features of this frame crawled with layer_dedup
+        self._container_layers = None
+
+    # FeaturesCrawler objects are pickled when sent to the namespace workers.
+    # The default config file heuristic is a staticmethod, which can not be
+    # pickled by reference, so it is restored on the other side instead.
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if state.get('is_config_file') is FeaturesCrawler._is_config_file:
+            del state['is_config_file']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'is_config_file' not in state:
+            self.is_config_file = FeaturesCrawler._is_config_file
+
+    def _get_container_layers(self):
+        """
+        Returns (image_id, rootfs_dir, changes) for the container, where
+        `changes` are the LayerChanges of its writable layer, or None if its
+        storage driver does not keep that layer apart from the image.
+        """
+        if self._container_layers is None:
+            try:
+                (image_id, rootfs_dir, upper_dir) = \
+                    dockerutils.get_docker_container_layers(
+                        self.container.long_id)
+                self._container_layers = (
+                    image_id, rootfs_dir,
+                    read_layer_changes(upper_dir, rootfs_dir))
+            except DockerutilsException as e:
+                logger.debug('Crawling all of the root of %s: %s' %
+                             (self.container.long_id, e))
+                self._container_layers = False
+        return self._container_layers or None
+
+    def _delta_owner(self):
+        if self.crawl_mode == Modes.OUTCONTAINER:
+            return container_owner(self.container)
+        return HOST_OWNER
 
-    # FIXME Clean the old values!
-    @staticmethod
-    def _cache_put_value(key, value):
-        FeaturesCrawler._cached_values[key] = (value, time.time())
+    def _cache_put_value(self, key, value, timestamp=None):
+        get_delta_store().put(self._delta_owner(), key, value,
+                              timestamp or time.time())
 
-    @staticmethod
-    def _cache_get_value(key):
-        if key in FeaturesCrawler._cached_values:
-            return FeaturesCrawler._cached_values[key]
-        else:
-            return (None, None)
+    def _cache_get_value(self, key):
+        return get_delta_store().get(self._delta_owner(), key)
 
     # crawl the OS information
     # mountpoint only used for out-of-band crawling
@@ -202,9 +282,32 @@ class FeaturesCrawler:
         exclude_dirs=['/proc', '/mnt', '/dev', '/tmp'],
         root_dir_alias=None,
         avoid_setns=False,
+        incremental=False,
+        index_dir=defaults.DEFAULT_FILE_INDEX_DIR,
+        walk_threads=1,
+        walk_sorted=False,
+        layer_dedup=False,
     ):
 
-        if avoid_setns and self.crawl_mode == Modes.OUTCONTAINER:
+        if incremental:
+            # Only the files added, changed, or deleted since the previous
+            # crawl are reported. Containers are crawled from the host.
+            owner = 'host'
+            if self.crawl_mode == Modes.OUTCONTAINER:
+                owner = self.container.long_id
+                if avoid_setns:
+                    rootfs_dir = dockerutils.get_docker_container_rootfs_path(
+                        self.container.long_id)
+                else:
+                    rootfs_dir = '/proc/%s/root' % self.container.pid
+                if root_dir_alias is None:
+                    root_dir_alias = root_dir
+                root_dir = misc.join_abs_paths(rootfs_dir, root_dir)
+            for (key, feature) in self._crawl_files_incremental(
+                    root_dir, exclude_dirs, root_dir_alias,
+                    get_file_index_path(index_dir, owner, root_dir)):
+                yield (key, feature)
+        elif avoid_setns and self.crawl_mode == Modes.OUTCONTAINER:
             # Handle this special case first (avoiding setns() for the
             # OUTCONTAINER mode).
             rootfs_dir = dockerutils.get_docker_container_rootfs_path(
@@ -215,13 +318,25 @@ class FeaturesCrawler:
                     raise ValueError('crawl_files with avoidsetns only takes'
                                      'absolute paths in the exclude_dirs arg.')
 
-            exclude_dirs = [misc.join_abs_paths(rootfs_dir, d)
-                            for d in exclude_dirs]
+            # The exclude patterns are relative to the crawled root_dir
+            exclude_dirs = [os.path.relpath(d, root_dir) for d in exclude_dirs
+                            if (d.rstrip('/') + '/').startswith(
+                                root_dir.rstrip('/') + '/')]
+
+            layers = self._get_container_layers() if layer_dedup else None
+            if layers:
+                for (_, feature) in self._crawl_files_layered(
+                        layers, root_dir, exclude_dirs, walk_threads,
+                        walk_sorted):
+                    yield (feature.path, feature)
+                return
 
             for (key, feature) in self._crawl_files(
                     root_dir=misc.join_abs_paths(rootfs_dir, root_dir),
                     exclude_dirs=exclude_dirs,
-                    root_dir_alias=root_dir):
+                    root_dir_alias=root_dir,
+                    walk_threads=walk_threads,
+                    walk_sorted=walk_sorted):
                 yield (key, feature)
         else:
             for (key, feature) in self._crawl_wrapper(
@@ -229,7 +344,9 @@ class FeaturesCrawler:
                     ['mnt'],
                     root_dir,
                     exclude_dirs,
-                    root_dir_alias):
+                    root_dir_alias,
+                    walk_threads,
+                    walk_sorted):
                 yield (key, feature)
 
     def _crawl_files(
@@ -237,6 +354,8 @@ class FeaturesCrawler:
         root_dir='/',
         exclude_dirs=['proc', 'mnt', 'dev', 'tmp'],
         root_dir_alias=None,
+        walk_threads=1,
+        walk_sorted=False,
     ):
 
         root_dir = str(root_dir)
@@ -248,10 +367,7 @@ class FeaturesCrawler:
             assert os.path.isdir(root_dir)
             if root_dir_alias is None:
                 root_dir_alias = root_dir
-            exclude_dirs = [os.path.join(root_dir, d) for d in
-                            exclude_dirs]
-            exclude_regex = r'|'.join([fnmatch.translate(d)
-                                       for d in exclude_dirs]) or r'$.'
+            matcher = get_path_matcher(exclude_dirs)
 
             # walk the directory hierarchy starting at 'root_dir' in BFS
             # order
@@ -261,15 +377,11 @@ class FeaturesCrawler:
             if feature and (feature.ctime > accessed_since or
                             feature.atime > accessed_since):
                 yield (feature.path, feature)
-            for (root_dirpath, dirs, files) in os.walk(root_dir):
-                dirs[:] = [os.path.join(root_dirpath, d) for d in
-                           dirs]
-                dirs[:] = [d for d in dirs
-                           if not re.match(exclude_regex, d)]
-                files = [os.path.join(root_dirpath, f) for f in
-                         files]
-                files = [f for f in files
-                         if not re.match(exclude_regex, f)]
+            for (root_dirpath, dirs, files) in dirwalk.walk(
+                    root_dir,
+                    matcher,
+                    walk_threads,
+                    walk_sorted):
                 for fpath in files:
                     feature = self._crawl_file(root_dir, fpath,
                                                root_dir_alias)
@@ -283,6 +395,115 @@ class FeaturesCrawler:
                                     feature.atime > accessed_since):
                         yield (feature.path, feature)
 
+    def _crawl_files_layered(
+        self,
+        layers,
+        root_dir,
+        exclude_dirs,
+        walk_threads=1,
+        walk_sorted=False,
+    ):
+        """
+        Crawls the files under `root_dir` of the container with the `layers`
+        returned by `_get_container_layers()`, reusing the crawl of another
+        container of the same image for the files none of them changed. The
+        `exclude_dirs` are relative to `root_dir`.
+        """
+
+        (image_id, rootfs_dir, changes) = layers
+        crawl_root = misc.join_abs_paths(rootfs_dir, root_dir)
+        # root_dir relative to the root of the container
+        base = root_dir.strip('/')
+        matcher = get_path_matcher(exclude_dirs)
+
+        def is_excluded(relpath):
+            return matcher.is_excluded(relpath[len(base):].lstrip('/'))
+
+        def crawl_entry(relpath):
+            fpath = os.path.join(rootfs_dir, relpath)
+            try:
+                lstat = os.lstat(fpath)
+            except OSError:
+                # Deleted
+                return None
+            feature = self._crawl_file(crawl_root, fpath, root_dir, lstat)
+            if (feature.ctime > self.feature_epoch or
+                    feature.atime > self.feature_epoch):
+                return feature
+            return None
+
+        def crawl_tree(relpath, exclude_dirs):
+            for (key, feature) in self._crawl_files(
+                    root_dir=os.path.join(rootfs_dir, relpath),
+                    exclude_dirs=exclude_dirs,
+                    root_dir_alias='/' + relpath,
+                    walk_threads=walk_threads,
+                    walk_sorted=walk_sorted):
+                yield (key.lstrip('/'), feature)
+
+        def crawl_all():
+            return crawl_tree(base, exclude_dirs)
+
+        def crawl_changed(all_changes):
+            if all_changes.in_subtrees(base):
+                for item in crawl_all():
+                    yield item
+                return
+            for relpath in sorted(all_changes.paths):
+                if (not is_under(relpath, base) or
+                        all_changes.in_subtrees(relpath) or
+                        is_excluded(relpath)):
+                    continue
+                feature = crawl_entry(relpath)
+                if feature:
+                    yield (relpath, feature)
+            for relpath in all_changes.top_subtrees():
+                if not is_under(relpath, base) or is_excluded(relpath):
+                    continue
+                fpath = os.path.join(rootfs_dir, relpath)
+                if os.path.isdir(fpath) and not os.path.islink(fpath):
+                    for (path, feature) in crawl_tree(relpath, []):
+                        if not is_excluded(path):
+                            yield (path, feature)
+                else:
+                    feature = crawl_entry(relpath)
+                    if feature:
+                        yield (relpath, feature)
+
+        key = (image_id, 'file', root_dir, tuple(exclude_dirs),
+               self.feature_epoch)
+        return crawl_layered(key, changes, crawl_all, crawl_changed)
+
+    def _crawl_files_incremental(
+        self,
+        root_dir,
+        exclude_dirs,
+        root_dir_alias,
+        index_path,
+    ):
+        """
+        Crawls the files under `root_dir` that were added or changed since
+        the previous crawl with the same `index_path`, and the ones that were
+        deleted (reported with type 'deleted'). The first crawl reports all
+        the files, regardless of the feature epoch.
+        """
+
+        root_dir = str(root_dir)
+        logger.debug('crawl_files_incremental: %s' % (locals()))
+        assert os.path.isdir(root_dir)
+        if root_dir_alias is None:
+            root_dir_alias = root_dir
+        matcher = get_path_matcher(exclude_dirs)
+
+        index = get_file_index(index_path)
+        for (fpath, lstat) in index.walk(root_dir, matcher):
+            if lstat:
+                feature = self._crawl_file(root_dir, fpath, root_dir_alias,
+                                           lstat)
+            else:
+                feature = self._deleted_file(root_dir, fpath, root_dir_alias)
+            yield (feature.path, feature)
+
     def _filetype(self, fpath, fperm):
         modebit = fperm[0]
         ftype = {
@@ -342,8 +563,10 @@ class FeaturesCrawler:
         root_dir,
         fpath,
         root_dir_alias,
+        lstat=None,
     ):
-        lstat = os.lstat(fpath)
+        if lstat is None:
+            lstat = os.lstat(fpath)
         fmode = lstat.st_mode
         fperm = self._fileperm(fmode)
         ftype = self._filetype(fpath, fperm)
@@ -359,17 +582,8 @@ class FeaturesCrawler:
                              % fpath, exc_info=True)
         fgroup = lstat.st_gid
         fuser = lstat.st_uid
-
-        # This replaces `/<root_dir>/a/b/c` with `/<root_dir_alias>/a/b/c`
-
-        frelpath = os.path.join(root_dir_alias,
-                                os.path.relpath(fpath, root_dir))
-
-        # This converts something like `/.` to `/`
-
-        frelpath = os.path.normpath(frelpath)
-
-        (_, fname) = os.path.split(frelpath)
+        (fname, frelpath) = self._file_relpath(root_dir, fpath,
+                                               root_dir_alias)
         return FileFeature(
             lstat.st_atime,
             lstat.st_ctime,
@@ -384,6 +598,28 @@ class FeaturesCrawler:
             fuser,
         )
 
+    def _file_relpath(self, root_dir, fpath, root_dir_alias):
+
+        # This replaces `/<root_dir>/a/b/c` with `/<root_dir_alias>/a/b/c`
+
+        frelpath = os.path.join(root_dir_alias,
+                                os.path.relpath(fpath, root_dir))
+
+        # This converts something like `/.` to `/`
+
+        frelpath = os.path.normpath(frelpath)
+
+        (_, fname) = os.path.split(frelpath)
+        return (fname, frelpath)
+
+    # a file that is not there anymore
+
+    def _deleted_file(self, root_dir, fpath, root_dir_alias):
+        (fname, frelpath) = self._file_relpath(root_dir, fpath,
+                                               root_dir_alias)
+        return FileFeature(None, None, None, None, None, None, fname,
+                           frelpath, None, 'deleted', None)
+
     # default config file discovery heuristic
 
     @staticmethod
@@ -413,19 +649,49 @@ class FeaturesCrawler:
         root_dir_alias=None,
         known_config_files=[],
         discover_config_files=False,
-        avoid_setns=False
+        avoid_setns=False,
+        walk_threads=1,
+        walk_sorted=False,
+        cache=None,
+        layer_dedup=False,
     ):
+        if cache and cache not in CONFIG_CACHE_MODES:
+            raise ValueError('Unknown config cache mode: %s' % cache)
+        owner = 'host'
+        if self.crawl_mode == Modes.OUTCONTAINER:
+            owner = self.container.long_id
         if avoid_setns and self.crawl_mode == Modes.OUTCONTAINER:
             # Handle this special case first (avoiding setns() for the
             # OUTCONTAINER mode).
             root_dir = dockerutils.get_docker_container_rootfs_path(
                 self.container.long_id)
+
+            # The config cache already avoids reading the files again
+            layers = None
+            if layer_dedup and not cache:
+                layers = self._get_container_layers()
+            if layers:
+                for (key, feature) in self._crawl_config_files_layered(
+                        layers,
+                        exclude_dirs,
+                        root_dir_alias,
+                        known_config_files,
+                        discover_config_files,
+                        walk_threads,
+                        walk_sorted):
+                    yield (key, feature)
+                return
+
             for (key, feature) in self._crawl_config_files(
                     root_dir,
                     exclude_dirs,
                     root_dir_alias,
                     known_config_files,
-                    discover_config_files):
+                    discover_config_files,
+                    walk_threads,
+                    walk_sorted,
+                    cache,
+                    owner):
                 yield (key, feature)
         else:
             for (key, feature) in self._crawl_wrapper(
@@ -435,7 +701,11 @@ class FeaturesCrawler:
                     exclude_dirs,
                     root_dir_alias,
                     known_config_files,
-                    discover_config_files):
+                    discover_config_files,
+                    walk_threads,
+                    walk_sorted,
+                    cache,
+                    owner):
                 yield (key, feature)
 
     def _crawl_config_files(
@@ -445,7 +715,17 @@ class FeaturesCrawler:
         root_dir_alias=None,
         known_config_files=[],
         discover_config_files=False,
+        walk_threads=1,
+        walk_sorted=False,
+        cache=None,
+        cache_owner='host',
     ):
+        """
+        With a `cache` mode, the files read by the previous crawl of
+        `cache_owner` are only read again if they changed. In the 'hash' mode
+        the files that did not change are reported as a ConfigHashFeature,
+        without their content.
+        """
 
         saved_args = locals()
         logger.debug('Crawling config files: %s' % (saved_args))
@@ -455,14 +735,10 @@ class FeaturesCrawler:
         
         if root_dir_alias is None:
             root_dir_alias = root_dir
-        exclude_dirs = [os.path.join(root_dir, d) for d in
-                        exclude_dirs]
-        exclude_regex = r'|'.join([fnmatch.translate(d) for d in
-                                   exclude_dirs]) or r'$.'
+        matcher = get_path_matcher(exclude_dirs)
         known_config_files[:] = [os.path.join(root_dir, f) for f in
-                                 known_config_files]
-        known_config_files[:] = [f for f in known_config_files
-                                 if not re.match(exclude_regex, f)]
+                                 known_config_files
+                                 if not matcher.is_excluded(f)]
         config_file_set = set()
         for fpath in known_config_files:
             if os.path.exists(fpath):
@@ -476,15 +752,11 @@ class FeaturesCrawler:
             # Walk the directory hierarchy starting at 'root_dir' in BFS
             # order looking for config files.
 
-            for (root_dirpath, dirs, files) in os.walk(root_dir):
-                dirs[:] = [os.path.join(root_dirpath, d) for d in
-                           dirs]
-                dirs[:] = [d for d in dirs
-                           if not re.match(exclude_regex, d)]
-                files = [os.path.join(root_dirpath, f) for f in
-                         files]
-                files = [f for f in files
-                         if not re.match(exclude_regex, f)]
+            for (root_dirpath, dirs, files) in dirwalk.walk(
+                    root_dir,
+                    matcher,
+                    walk_threads,
+                    walk_sorted):
                 for fpath in files:
                     if os.path.exists(fpath) \
                             and self.is_config_file(fpath):
@@ -493,10 +765,25 @@ class FeaturesCrawler:
                                 or lstat.st_ctime > accessed_since:
                             config_file_set.add(fpath)
 
+        if walk_sorted:
+            config_file_set = sorted(config_file_set)
+        config_cache = get_config_cache(cache_owner) if cache else None
         for fpath in config_file_set:
             (_, fname) = os.path.split(fpath)
             frelpath = fpath.replace(root_dir, root_dir_alias,
                                      1)  # root_dir relative path
+            if config_cache:
+                try:
+                    (content, sha256, changed) = config_cache.read(fpath)
+                except (IOError, OSError) as e:
+                    logger.debug('Could not read %s: %s' % (fpath, e))
+                    continue
+                if cache == CONFIG_CACHE_HASH and not changed:
+                    yield (frelpath, ConfigHashFeature(fname, sha256,
+                                                       frelpath))
+                else:
+                    yield (frelpath, ConfigFeature(fname, content, frelpath))
+                continue
             with codecs.open(filename=fpath, mode='r',
                              encoding='utf-8', errors='ignore') as \
                     config_file:
@@ -506,6 +793,83 @@ class FeaturesCrawler:
                 yield (frelpath, ConfigFeature(fname,
                                                config_file.read(),
                                                frelpath))
+        if config_cache:
+            config_cache.retain(config_file_set)
+
+    def _crawl_config_files_layered(
+        self,
+        layers,
+        exclude_dirs=['proc', 'mnt', 'dev', 'tmp'],
+        root_dir_alias=None,
+        known_config_files=[],
+        discover_config_files=False,
+        walk_threads=1,
+        walk_sorted=False,
+    ):
+        """
+        Crawls the config files of the container with the `layers` returned
+        by `_get_container_layers()`, reusing the crawl of another container
+        of the same image for the files none of them changed.
+        """
+
+        (image_id, rootfs_dir, changes) = layers
+        if root_dir_alias is None:
+            root_dir_alias = rootfs_dir
+        known = set(f.strip('/') for f in known_config_files)
+        matcher = get_path_matcher(exclude_dirs)
+
+        def crawl_tree(relpath, known_config_files, discover_config_files):
+            for (key, feature) in self._crawl_config_files(
+                    os.path.join(rootfs_dir, relpath) if relpath
+                    else rootfs_dir,
+                    exclude_dirs if not relpath else [],
+                    '/' + relpath,
+                    known_config_files,
+                    discover_config_files,
+                    walk_threads,
+                    walk_sorted):
+                path = key.lstrip('/')
+                if not relpath or not matcher.is_excluded(path):
+                    yield (path, feature)
+
+        def crawl_all():
+            return crawl_tree('', list(known_config_files),
+                              discover_config_files)
+
+        def is_config_file(relpath):
+            return relpath in known or (
+                discover_config_files and
+                self.is_config_file(os.path.join(rootfs_dir, relpath)))
+
+        def crawl_changed(all_changes):
+            if all_changes.in_subtrees(''):
+                for item in crawl_all():
+                    yield item
+                return
+            paths = [path for path in sorted(all_changes.paths)
+                     if path and not all_changes.in_subtrees(path) and
+                     is_config_file(path)]
+            for relpath in all_changes.top_subtrees():
+                fpath = os.path.join(rootfs_dir, relpath)
+                if os.path.isdir(fpath) and not os.path.islink(fpath):
+                    for item in crawl_tree(
+                            relpath,
+                            [os.path.relpath(f, relpath) for f in known
+                             if is_under(f, relpath)],
+                            discover_config_files):
+                        yield item
+                elif is_config_file(relpath):
+                    paths.append(relpath)
+            for item in crawl_tree('', paths, False):
+                yield item
+
+        key = (image_id, 'config', tuple(exclude_dirs), tuple(known),
+               discover_config_files, self.feature_epoch)
+        for (relpath, feature) in crawl_layered(key, changes, crawl_all,
+                                                crawl_changed):
+            # The kept features can be of a container with another root
+            path = os.path.join(root_dir_alias, relpath)
+            yield (path, feature._replace(path=path))
 
     # crawl disk partition information
 
@@ -534,16 +898,77 @@ class FeaturesCrawler:
 
     # crawl process metadata
 
-    def crawl_processes(self):
-        for (key, feature) in self._crawl_wrapper(
-                self._crawl_processes, ALL_NAMESPACES):
-            yield (key, feature)
+    def crawl_processes(self, skip_fields=[], avoid_setns=False):
+        if avoid_setns and self.crawl_mode == Modes.OUTCONTAINER:
+            # Handle this special case first (avoiding setns() for the
+            # OUTCONTAINER mode).
+            for (key, feature) in self._process_table_features(
+                    self._get_container_process_table(
+                        self._process_table_fields(skip_fields))):
+                yield (key, feature)
+        else:
+            for (key, feature) in self._crawl_wrapper(
+                    self._crawl_processes, ALL_NAMESPACES, skip_fields):
+                yield (key, feature)
 
-    def _crawl_processes(self):
+    def _process_table_fields(self, skip_fields):
+        return [field for field in [FIELD_CWD, FIELD_OPEN_FILES]
+                if field not in skip_fields]
+
+    def _process_table_features(self, table):
+        for p in table:
+            feature_key = '{0}/{1}'.format(p.name, p.pid)
+            yield (feature_key, ProcessFeature(
+                str(' '.join(p.cmdline)),
+                p.create_time,
+                p.cwd or 'unknown',
+                p.name,
+                p.open_files or [],
+                p.pid,
+                p.ppid,
+                p.num_threads,
+                p.username,
+            ))
+
+    def _get_container_process_table(self, fields):
+        """
+        Returns the snapshot of the processes of the container, read from
+        the host /proc. The processes are found in the cgroup of the
+        container or, if it has no cgroup, by their pid namespace.
+        """
+        def list_pids():
+            try:
+                return read_cgroup_pids(os.path.dirname(
+                    self.container.get_memory_cgroup_path('cgroup.procs')))
+            except (NotImplementedError, IOError, OSError) as e:
+                logger.debug('Could not read the cgroup of container %s: %s'
+                             % (self.container.long_id, e))
+            pid_namespace = get_pid_namespace(self.container.pid)
+            if not pid_namespace:
+                raise CrawlError('Container %s is not running'
+                                 % self.container.long_id)
+            return list_namespace_pids(pid_namespace)
+
+        return get_container_process_table(self.container.pid,
+                                           self.frame_id, list_pids, fields)
+
+    def _crawl_processes(self, skip_fields=[]):
+        """
+        `skip_fields` can have 'cwd' and 'open_files', which are then
+        reported as 'unknown' and [].
+        """
 
         created_since = 0
         logger.debug('Crawling Processes: since={0}'.format(created_since))
 
+        if self.process_table:
+            for (key, feature) in self._process_table_features(
+                    get_process_table(
+                        self.frame_id,
+                        self._process_table_fields(skip_fields))):
+                yield (key, feature)
+            return
+
         list = psutil.process_iter()
 
         for p in list:
@@ -559,7 +984,8 @@ class FeaturesCrawler:
                 pid = (p.pid() if hasattr(p.pid, '__call__') else p.pid)
                 status = (p.status() if hasattr(p.status, '__call__'
                                                 ) else p.status)
-                if status == psutil.STATUS_ZOMBIE:
+                if (status == psutil.STATUS_ZOMBIE or
+                        FIELD_CWD in skip_fields):
                     cwd = 'unknown'  # invalid
                 else:
                     try:
@@ -588,8 +1014,9 @@ class FeaturesCrawler:
                     username = 'unknown'
 
                 openfiles = []
-                for f in p.get_open_files():
-                    openfiles.append(f.path)
+                if FIELD_OPEN_FILES not in skip_fields:
+                    for f in p.get_open_files():
+                        openfiles.append(f.path)
                 openfiles.sort()
                 feature_key = '{0}/{1}'.format(name, pid)
                 yield (feature_key, ProcessFeature(
@@ -605,10 +1032,36 @@ class FeaturesCrawler:
                 ))
 
     # crawl network connection metadata
-    def crawl_connections(self):
-        for (key, feature) in self._crawl_wrapper(
-                self._crawl_connections, ALL_NAMESPACES):
-            yield (key, feature)
+    def crawl_connections(self, avoid_setns=False):
+        if avoid_setns and self.crawl_mode == Modes.OUTCONTAINER:
+            # Handle this special case first (avoiding setns() for the
+            # OUTCONTAINER mode).
+            for (key, feature) in self._connection_table_features(
+                    self._get_container_process_table([])):
+                yield (key, feature)
+        else:
+            for (key, feature) in self._crawl_wrapper(
+                    self._crawl_connections, ALL_NAMESPACES):
+                yield (key, feature)
+
+    def _connection_table_features(self, table, created_since=0):
+        processes = dict((p.host_pid, p) for p in table
+                         if p.status != psutil.STATUS_ZOMBIE and
+                         p.create_time > created_since)
+        for (host_pid, c) in get_connections(sorted(processes)):
+            p = processes[host_pid]
+            (localipaddr, localport) = c.laddr
+            (remoteipaddr, remoteport) = c.raddr or (None, None)
+            feature_key = '{0}/{1}/{2}'.format(p.pid, localipaddr, localport)
+            yield (feature_key, ConnectionFeature(
+                localipaddr,
+                localport,
+                p.name,
+                p.pid,
+                remoteipaddr,
+                remoteport,
+                str(c.status),
+            ))
 
     def _crawl_connections(self):
 
@@ -617,6 +1070,12 @@ class FeaturesCrawler:
         created_since = 0
         logger.debug('Crawling Connections: since={0}'.format(created_since))
 
+        if self.process_table:
+            for (key, feature) in self._connection_table_features(
+                    get_process_table(self.frame_id), created_since):
+                yield (key, feature)
+            return
+
         list = psutil.process_iter()
 
         for p in list:
@@ -634,53 +1093,87 @@ class FeaturesCrawler:
 
             if create_time <= created_since:
                 continue
-            try:
-                for c in p.get_connections():
-                    try:
-                        (localipaddr, localport) = c.laddr[:]
-                    except:
+            for (key, feature) in self._crawl_process_connections(p, pid,
+                                                                  name):
+                yield (key, feature)
 
-                        # Older version of psutil uses local_address instead of
-                        # laddr.
+    def _crawl_process_connections(self, p, pid, name):
+        try:
+            for c in p.get_connections():
+                try:
+                    (localipaddr, localport) = c.laddr[:]
+                except:
 
-                        (localipaddr, localport) = c.local_address[:]
-                    try:
-                        if c.raddr:
-                            (remoteipaddr, remoteport) = c.raddr[:]
-                        else:
-                            (remoteipaddr, remoteport) = (None, None)
-                    except:
-
-                        # Older version of psutil uses remote_address instead
-                        # of raddr.
-
-                        if c.remote_address:
-                            (remoteipaddr, remoteport) = \
-                                c.remote_address[:]
-                        else:
-                            (remoteipaddr, remoteport) = (None, None)
-                    feature_key = '{0}/{1}/{2}'.format(pid,
-                                                       localipaddr, localport)
-                    yield (feature_key, ConnectionFeature(
-                        localipaddr,
-                        localport,
-                        name,
-                        pid,
-                        remoteipaddr,
-                        remoteport,
-                        str(c.status),
-                    ))
-            except Exception as e:
-                logger.error('Error crawling connection for process %s'
-                             % pid, exc_info=True)
-                raise CrawlError(e)
+                    # Older version of psutil uses local_address instead of
+                    # laddr.
+
+                    (localipaddr, localport) = c.local_address[:]
+                try:
+                    if c.raddr:
+                        (remoteipaddr, remoteport) = c.raddr[:]
+                    else:
+                        (remoteipaddr, remoteport) = (None, None)
+                except:
+
+                    # Older version of psutil uses remote_address instead
+                    # of raddr.
+
+                    if c.remote_address:
+                        (remoteipaddr, remoteport) = \
+                            c.remote_address[:]
+                    else:
+                        (remoteipaddr, remoteport) = (None, None)
+                feature_key = '{0}/{1}/{2}'.format(pid,
+                                                   localipaddr, localport)
+                yield (feature_key, ConnectionFeature(
+                    localipaddr,
+                    localport,
+                    name,
+                    pid,
+                    remoteipaddr,
+                    remoteport,
+                    str(c.status),
+                ))
+        except psutil.NoSuchProcess:
+            # Gone since the processes were listed
+            pass
+        except Exception as e:
+            logger.error('Error crawling connection for process %s'
+                         % pid, exc_info=True)
+            raise CrawlError(e)
 
     # crawl performance metric data
 
-    def crawl_metrics(self):
-        for (key, feature) in self._crawl_wrapper(
-                self._crawl_metrics, ALL_NAMESPACES):
-            yield (key, feature)
+    def crawl_metrics(self, avoid_setns=False):
+        if avoid_setns and self.crawl_mode == Modes.OUTCONTAINER:
+            # Handle this special case first (avoiding setns() for the
+            # OUTCONTAINER mode).
+            for (key, feature) in self._metric_table_features(
+                    self._get_container_process_table([FIELD_IO])):
+                yield (key, feature)
+        else:
+            for (key, feature) in self._crawl_wrapper(
+                    self._crawl_metrics, ALL_NAMESPACES):
+                yield (key, feature)
+
+    def _metric_table_features(self, table, created_since=0):
+        for p in table:
+            if (p.status == psutil.STATUS_ZOMBIE or
+                    p.create_time <= created_since):
+                continue
+            feature_key = '{0}/{1}'.format(p.name, p.pid)
+            yield (feature_key, MetricFeature(
+                round(p.cpu_percent, 2),
+                round(p.memory_percent or 0.0, 2),
+                p.name,
+                p.pid,
+                p.read_bytes,
+                p.rss,
+                str(p.status),
+                p.username,
+                p.vms,
+                p.write_bytes,
+            ))
 
     def _crawl_metrics(self):
 
@@ -688,6 +1181,14 @@ class FeaturesCrawler:
 
         created_since = 0
         logger.debug('Crawling Metrics')
+
+        if self.process_table:
+            for (key, feature) in self._metric_table_features(
+                    get_process_table(self.frame_id, [FIELD_IO]),
+                    created_since):
+                yield (key, feature)
+            return
+
         for p in psutil.process_iter():
             create_time = (
                 p.create_time() if hasattr(
@@ -745,7 +1246,8 @@ class FeaturesCrawler:
 
     # crawl Linux package database
 
-    def crawl_packages(self, dbpath=None, root_dir='/', avoid_setns=False):
+    def crawl_packages(self, dbpath=None, root_dir='/', avoid_setns=False,
+                       layer_dedup=False):
 
         if not (avoid_setns and self.crawl_mode == Modes.OUTCONTAINER):
             try:
@@ -769,9 +1271,37 @@ class FeaturesCrawler:
 
         root_dir = dockerutils.get_docker_container_rootfs_path(
             self.container.long_id)
-        for (key, feature) in self._crawl_packages(dbpath, root_dir):
+        layers = self._get_container_layers() if layer_dedup else None
+        if layers:
+            crawl = self._crawl_packages_layered(layers, dbpath)
+        else:
+            crawl = self._crawl_packages(dbpath, root_dir)
+        for (key, feature) in crawl:
             yield (key, feature)
 
+    def _crawl_packages_layered(self, layers, dbpath=None):
+        """
+        Crawls the packages of the container with the `layers` returned by
+        `_get_container_layers()`, reusing the packages of another container
+        of the same image if none of them changed the package databases.
+        """
+
+        (image_id, rootfs_dir, changes) = layers
+        db_dirs = [dbpath.strip('/')] if dbpath else _PACKAGE_DB_DIRS
+
+        def changed_packages(changes):
+            return any(changes.covers(db_dir) for db_dir in db_dirs)
+
+        key = (image_id, 'package', dbpath, self.feature_epoch)
+        kept = get_image_crawl(key)
+        if kept and not changed_packages(changes.union(kept[1])):
+            return kept[0]
+        packages = list(self._crawl_packages(dbpath, rootfs_dir))
+        if not kept or (changed_packages(kept[1]) and
+                        not changed_packages(changes)):
+            put_image_crawl(key, packages, changes)
+        return packages
+
     def _crawl_packages(self, dbpath=None, root_dir='/'):
 
         # package attributes: ["installed", "name", "size", "version"]
@@ -883,22 +1413,31 @@ class FeaturesCrawler:
         elif self.crawl_mode == Modes.OUTCONTAINER:
 
             used = buffered = cached = free = 'unknown'
+            if self.container.get_cgroup_version('memory') == 2:
+                (cache_key, buffered_key, limit_node, used_node) = (
+                    'file', 'active_file', 'memory.max', 'memory.current')
+            else:
+                (cache_key, buffered_key, limit_node, used_node) = (
+                    'total_cache', 'total_active_file',
+                    'memory.limit_in_bytes', 'memory.usage_in_bytes')
             try:
                 with open(self.container.get_memory_cgroup_path('memory.stat'
                                                                 ), 'r') as f:
                     for line in f:
                         (key, value) = line.strip().split(' ')
-                        if key == 'total_cache':
+                        if key == cache_key:
                             cached = int(value)
-                        if key == 'total_active_file':
+                        if key == buffered_key:
                             buffered = int(value)
 
                 with open(self.container.get_memory_cgroup_path(
-                        'memory.limit_in_bytes'), 'r') as f:
-                    limit = int(f.readline().strip())
+                        limit_node), 'r') as f:
+                    limit = f.readline().strip()
+                    # There is no limit in cgroup v2 if it is 'max'
+                    limit = float('inf') if limit == 'max' else int(limit)
 
                 with open(self.container.get_memory_cgroup_path(
-                        'memory.usage_in_bytes'), 'r') as f:
+                        used_node), 'r') as f:
                     used = int(f.readline().strip())
 
                 host_free = psutil.virtual_memory().free
@@ -921,13 +1460,26 @@ class FeaturesCrawler:
 
         yield (feature_key, feature_attributes)
 
-    def _save_container_cpu_times(self, container_long_id, times):
-        cache_key = container_long_id
-        self._cache_put_value(cache_key, times)
 
-    def _get_prev_container_cpu_times(self, container_long_id):
-        cache_key = container_long_id
-        return self._cache_get_value(cache_key)
+    def _read_container_cpu_user_system(self):
+        """
+        Returns the user and system CPU time of the container, in USER_HZ
+        (cgroup v1) or microseconds (cgroup v2).
+        """
+        cpu_user_system = {}
+        if self.container.get_cgroup_version('cpuacct') == 2:
+            (path, pattern) = (self.container.get_cpu_cgroup_path('cpu.stat'),
+                               r"(system|user)_usec\s+(\d+)")
+        else:
+            (path, pattern) = (
+                self.container.get_cpu_cgroup_path('cpuacct.stat'),
+                r"(system|user)\s+(\d+)")
+        with open(path, 'r') as f:
+            for line in f:
+                m = re.search(pattern, line)
+                if m:
+                    cpu_user_system[m.group(1)] = float(m.group(2))
+        return cpu_user_system
 
     def crawl_cpu(self, per_cpu=False):
 
@@ -971,16 +1523,10 @@ class FeaturesCrawler:
 
         if self.crawl_mode == Modes.OUTCONTAINER:
 
-            if per_cpu:
-                stat_file_name = 'cpuacct.usage_percpu'
-            else:
-                stat_file_name = 'cpuacct.usage'
-
             container = self.container
 
             try:
-                (cpu_usage_t1, prev_time) = \
-                    self._get_prev_container_cpu_times(container.long_id)
+                (cpu_usage_t1, prev_time) = self._cache_get_value(CPU_KEY)
 
                 if cpu_usage_t1:
                     logger.debug('Using previous cpu times for container %s'
@@ -993,29 +1539,18 @@ class FeaturesCrawler:
                         'so we will be sleeping for 100 milliseconds' %
                         container.long_id)
 
-                    with open(container.get_cpu_cgroup_path(stat_file_name),
-                              'r') as f:
-                        cpu_usage_t1 = f.readline().strip().split(' ')
+                    cpu_usage_t1 = read_container_cpu_usage(container,
+                                                            per_cpu)
                     interval = 0.1  # sleep for 100ms
                     time.sleep(interval)
 
-                with open(container.get_cpu_cgroup_path(stat_file_name),
-                          'r') as f:
-                    cpu_usage_t2 = f.readline().strip().split(' ')
+                cpu_usage_t2 = read_container_cpu_usage(container, per_cpu)
 
                 # Store the cpu times for the next crawl
 
-                self._save_container_cpu_times(container.long_id,
-                                               cpu_usage_t2)
+                self._cache_put_value(CPU_KEY, cpu_usage_t2)
 
-                cpu_user_system = {}
-                path = container.get_cpu_cgroup_path('cpuacct.stat')
-                with open(path, 'r') as f:
-                    for line in f:
-                        m = re.search(r"(system|user)\s+(\d+)", line)
-                        if m:
-                            cpu_user_system[m.group(1)] = \
-                                float(m.group(2))
+                cpu_user_system = self._read_container_cpu_user_system()
             except Exception as e:
                 logger.error('Error crawling cpu information',
                              exc_info=True)
@@ -1063,24 +1598,31 @@ class FeaturesCrawler:
                 )
                 yield (feature_key, feature_attributes)
 
-    def crawl_interface(self):
-        _mode = self.crawl_mode
-        for (ifname, curr_count) in self._crawl_wrapper(
-                self._crawl_interface_counters,
-                ['net']):
+    def crawl_interface(self, avoid_setns=False):
+        timestamp = None
+        if avoid_setns and self.crawl_mode == Modes.OUTCONTAINER:
+            # Handle this special case first (avoiding setns() for the
+            # OUTCONTAINER mode).
+            try:
+                (counters, timestamp) = get_interface_counters(
+                    self.container.pid)
+            except (IOError, OSError) as e:
+                logger.error('Error crawling interfaces', exc_info=True)
+                raise CrawlError(e)
+            interfaces = sorted(counters.iteritems())
+        else:
+            interfaces = self._crawl_wrapper(self._crawl_interface_counters,
+                                             ['net'])
+
+        for (ifname, curr_count) in interfaces:
             feature_key = '{0}-{1}'.format('interface', ifname)
-            if _mode == Modes.OUTCONTAINER:
-                cache_key = '{0}-{1}-{2}'.format(self.container.long_id,
-                                                 self.container.pid,
-                                                 feature_key)
-            else:
-                cache_key = '{0}-{1}'.format('INVM', feature_key)
+            now = timestamp or time.time()
 
-            (prev_count, prev_time) = self._cache_get_value(cache_key)
-            self._cache_put_value(cache_key, curr_count)
+            (prev_count, prev_time) = self._cache_get_value(feature_key)
+            self._cache_put_value(feature_key, curr_count, now)
 
             if prev_count and prev_time:
-                d = time.time() - prev_time
+                d = now - prev_time
                 diff = [(a - b) / d for (a, b) in zip(curr_count,
                                                       prev_count)]
             else:
@@ -0,0 +1,169 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import stat
+import logging
+import hashlib
+import tempfile
+import threading
+import time
+import glob
+import cPickle as pickle
+
+logger = logging.getLogger('crawlutils')
+
+
+class FileIndex(object):
+    """
+    Persistent index of the files found under a crawled root directory, used
+    to only report the files added, changed or deleted since the last crawl.
+
+    Every path is mapped to its (inode, size, mtime, ctime, mode), and every
+    directory to its mtime and list of entries. The list of entries of a
+    directory whose mtime did not change is reused instead of reading the
+    directory again. Directory mtimes do not change when the files inside
+    them are modified, so every entry is still lstat()'ed.
+    """
+
+    def __init__(self, path=None):
+        # Where the index is saved, or None to keep it in memory only
+        self.path = path
+        self.files = {}
+        self.dirs = {}
+        self.last_walk_time = 0
+
+    @staticmethod
+    def load(path):
+        index = FileIndex(path)
+        try:
+            with open(path, 'rb') as fp:
+                (index.files, index.dirs, index.last_walk_time) = \
+                    pickle.load(fp)
+        except (IOError, OSError, EOFError, ValueError, TypeError,
+                pickle.UnpicklingError) as e:
+            logger.debug('Starting a new file index at %s: %s' % (path, e))
+        return index
+
+    def save(self):
+        if not self.path:
+            return
+        index_dir = os.path.dirname(self.path)
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+
+        # Write and rename, so a crash never leaves a truncated index behind
+        (fd, temp_path) = tempfile.mkstemp(prefix='.index.', dir=index_dir)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                pickle.dump((self.files, self.dirs, self.last_walk_time), fp,
+                            pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError):
+            os.remove(temp_path)
+            raise
+
+    def walk(self, root_dir, matcher=None):
+        """
+        Walks the directory hierarchy at `root_dir` and yields (path, lstat)
+        for every path added or changed since the previous walk, and
+        (path, None) for every path deleted since then. Paths excluded by
+        `matcher` (a `path_matcher.PathMatcher`, with patterns relative to
+        `root_dir`) are skipped, and so are their subtrees.
+
+        The index is only updated (and saved) once the walk completes.
+        """
+        walk_time = time.time()
+        files = {}
+        dirs = {}
+
+        try:
+            root_lstat = os.lstat(root_dir)
+        except OSError:
+            root_lstat = None
+        root_state = matcher.root_state() if matcher else None
+        pending = [(root_dir, root_lstat, root_state)] if root_lstat else []
+        while pending:
+            (fpath, lstat, state) = pending.pop()
+            entry = (lstat.st_ino, lstat.st_size, lstat.st_mtime,
+                     lstat.st_ctime, lstat.st_mode)
+            files[fpath] = entry
+            if self.files.get(fpath) != entry:
+                yield (fpath, lstat)
+
+            if not stat.S_ISDIR(lstat.st_mode):
+                continue
+
+            # Only trust the mtime of a directory if it was modified some
+            # time before the previous walk started, as directories
+            # modified within the mtime granularity of the previous listing
+            # could have changed after it.
+            previous = self.dirs.get(fpath)
+            if (previous and previous[0] == lstat.st_mtime and
+                    lstat.st_mtime < self.last_walk_time - 1):
+                names = previous[1]
+            else:
+                try:
+                    names = os.listdir(fpath)
+                except OSError as e:
+                    logger.debug('Could not list %s: %s' % (fpath, e))
+                    continue
+            dirs[fpath] = (lstat.st_mtime, names)
+
+            for name in names:
+                (excluded, child_state) = (matcher.child(state, name)
+                                           if state else (False, None))
+                if excluded:
+                    continue
+                path = os.path.join(fpath, name)
+                try:
+                    pending.append((path, os.lstat(path), child_state))
+                except OSError:
+                    # Gone since the directory was listed
+                    pass
+
+        for fpath in self.files:
+            if fpath not in files:
+                yield (fpath, None)
+
+        self.files = files
+        self.dirs = dirs
+        self.last_walk_time = walk_time
+        self.save()
+
+
+# Indexes already loaded by this process, by path
+_file_indexes = {}
+_file_indexes_lock = threading.Lock()
+
+
+def get_file_index_path(index_dir, owner, root_dir):
+    """
+    Returns the path of the index for the crawl of `root_dir` in the system
+    identified by `owner` (the container long id, or 'host').
+    """
+    return os.path.join(index_dir, '%s.%s.idx' % (
+        owner, hashlib.sha1(root_dir).hexdigest()[:16]))
+
+
+def get_file_index(path):
+    with _file_indexes_lock:
+        index = _file_indexes.get(path)
+        if not index:
+            index = FileIndex.load(path)
+            _file_indexes[path] = index
+        return index
+
+
+def delete_file_indexes(index_dir, owner):
+    """
+    Deletes all the indexes of `owner`. This has to be called when a
+    container goes away.
+    """
+    with _file_indexes_lock:
+        for path in glob.glob(os.path.join(index_dir, '%s.*.idx' % owner)):
+            _file_indexes.pop(path, None)
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.debug('Could not delete the file index %s: %s'
+                             % (path, e))
@@ -0,0 +1,392 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+A durable spool on disk of the requests (http posts, kafka frames) that
+could not be sent to a sink, replayed in order from a background thread once
+the sink is reachable again.
+
+The spool of a sink is a directory of segment files, named after their
+sequence number. Records are appended to the last segment, and a new one is
+started when it is over `segment_bytes`. Every record is
+
+    crc32 (4 bytes) | header length (4 bytes) | body length (4 bytes)
+    | header (json) | body (zlib compressed if the header says so)
+
+A `cursor` file keeps the segment and offset of the next record to replay.
+Segments are deleted once replayed, and the oldest ones are dropped when the
+spool is over `max_bytes`, or when they are over `max_age_secs` old.
+"""
+import os
+import re
+import json
+import time
+import zlib
+import struct
+import logging
+import threading
+
+import defaults
+
+logger = logging.getLogger('crawlutils')
+
+_RECORD_HEADER = '>III'
+_RECORD_HEADER_SIZE = struct.calcsize(_RECORD_HEADER)
+_SEGMENT_SUFFIX = '.seg'
+_CURSOR = 'cursor'
+
+
+def _crc(header, body):
+    return zlib.crc32(header + body) & 0xffffffff
+
+
+class FrameSpool(object):
+    """
+    The spool at `path` of the records for a sink, which `send(header, body)`
+    sends. `send` returns False, or raises, if the sink could not take the
+    record.
+    """
+
+    def __init__(
+        self,
+        path,
+        send,
+        max_bytes=defaults.DEFAULT_SPOOL_MAX_BYTES,
+        max_age_secs=defaults.DEFAULT_SPOOL_MAX_AGE,
+        segment_bytes=defaults.DEFAULT_SPOOL_SEGMENT_BYTES,
+        compress=True,
+        replay_interval=defaults.DEFAULT_SPOOL_REPLAY_INTERVAL,
+    ):
+        self.path = path
+        self.send = send
+        self.max_bytes = max_bytes
+        self.max_age_secs = max_age_secs
+        self.segment_bytes = segment_bytes
+        self.compress = compress
+        self.replay_interval = replay_interval
+
+        self.spooled = 0
+        self.replayed = 0
+        self.dropped = 0
+
+        # Held while the records are replayed, one at a time and in order
+        self._replay_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._segments = self._list_segments()
+        self._cursor = self._read_cursor()
+        self._truncate_last_segment()
+
+    def _list_segments(self):
+        numbers = []
+        for name in os.listdir(self.path):
+            if name.endswith(_SEGMENT_SUFFIX):
+                try:
+                    numbers.append(int(name[:-len(_SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+        return sorted(numbers)
+
+    def _segment_path(self, number):
+        return os.path.join(self.path, '%020d%s' % (number, _SEGMENT_SUFFIX))
+
+    def _read_cursor(self):
+        try:
+            with open(os.path.join(self.path, _CURSOR)) as fp:
+                (number, offset) = fp.read().split()
+                return (int(number), int(offset))
+        except (IOError, ValueError):
+            return (self._segments[0], 0) if self._segments else (0, 0)
+
+    def _write_cursor(self):
+        tmp_path = os.path.join(self.path, '.' + _CURSOR)
+        with open(tmp_path, 'w') as fp:
+            fp.write('%d %d' % self._cursor)
+        os.rename(tmp_path, os.path.join(self.path, _CURSOR))
+
+    def _truncate_last_segment(self):
+        # A record cut by a crash while it was appended is dropped
+        if not self._segments:
+            return
+        path = self._segment_path(self._segments[-1])
+        with open(path, 'rb') as fp:
+            for _ in self._read_records(fp, 0):
+                pass
+            end = fp.tell()
+        if end != os.path.getsize(path):
+            logger.warning('Dropping a partial record at the end of %s' %
+                           path)
+            with open(path, 'r+b') as fp:
+                fp.truncate(end)
+
+    def _read_records(self, fp, offset):
+        """
+        Yields (offset after, header, body) of the records from `offset`,
+        and stops at the first partial or corrupted one, with `fp` at its
+        start.
+        """
+        fp.seek(offset)
+        while True:
+            data = fp.read(_RECORD_HEADER_SIZE)
+            if len(data) < _RECORD_HEADER_SIZE:
+                fp.seek(offset)
+                return
+            (crc, header_size, body_size) = struct.unpack(_RECORD_HEADER,
+                                                          data)
+            header = fp.read(header_size)
+            body = fp.read(body_size)
+            if len(header) < header_size or len(body) < body_size or \
+                    _crc(header, body) != crc:
+                fp.seek(offset)
+                return
+            offset = fp.tell()
+            header = json.loads(header)
+            if header.pop('_compressed', False):
+                body = zlib.decompress(body)
+            yield (offset, header, body)
+
+    def _skip_corrupted(self, number, offset):
+        """
+        Drops the corrupted record at `offset` of the segment `number`, and
+        returns the offset of the next record, or the end of the segment if
+        the lengths of the record can not be trusted either.
+        """
+        path = self._segment_path(number)
+        size = os.path.getsize(path)
+        with open(path, 'rb') as fp:
+            fp.seek(offset)
+            data = fp.read(_RECORD_HEADER_SIZE)
+        next_offset = size
+        if len(data) == _RECORD_HEADER_SIZE:
+            (_, header_size, body_size) = struct.unpack(_RECORD_HEADER, data)
+            end = offset + _RECORD_HEADER_SIZE + header_size + body_size
+            if end <= size:
+                next_offset = end
+        self.dropped += 1
+        logger.warning('Dropping %d bytes of a corrupted record at offset %d '
+                       'of %s' % (next_offset - offset, offset, path))
+        return next_offset
+
+    def _size(self):
+        total = 0
+        for number in self._segments:
+            try:
+                total += os.path.getsize(self._segment_path(number))
+            except OSError:
+                pass
+        return total
+
+    def _delete_segment(self, number, dropped=False):
+        path = self._segment_path(number)
+        if dropped:
+            with open(path, 'rb') as fp:
+                offset = self._cursor[1] if self._cursor[0] == number else 0
+                num_records = sum(1 for _ in self._read_records(fp, offset))
+            self.dropped += num_records
+            logger.warning('Dropping %d spooled records of %s' %
+                           (num_records, path))
+        os.remove(path)
+        self._segments.remove(number)
+        if self._segments and self._cursor[0] <= number:
+            self._cursor = (self._segments[0], 0)
+            self._write_cursor()
+
+    def _enforce_caps(self):
+        # Called with the lock held. The segment being appended to is kept.
+        now = time.time()
+        while len(self._segments) > 1:
+            oldest = self._segments[0]
+            too_old = (self.max_age_secs and now - os.path.getmtime(
+                self._segment_path(oldest)) > self.max_age_secs)
+            if not too_old and self._size() <= self.max_bytes:
+                break
+            self._delete_segment(oldest, dropped=True)
+
+    def _pending(self):
+        # Called with the lock held
+        if not self._segments:
+            return False
+        last = self._segments[-1]
+        try:
+            return (self._cursor[0] < last or self._cursor[1] <
+                    os.path.getsize(self._segment_path(last)))
+        except OSError:
+            return False
+
+    def pending(self):
+        """
+        Returns True if there are records waiting to be replayed.
+        """
+        with self._lock:
+            return self._pending()
+
+    def append(self, header, body):
+        """
+        Appends a record to the spool, to be replayed by the replayer.
+        """
+        header = dict(header)
+        if self.compress:
+            body = zlib.compress(body)
+            header['_compressed'] = True
+        header = json.dumps(header)
+        record = struct.pack(_RECORD_HEADER, _crc(header, body),
+                             len(header), len(body)) + header + body
+        with self._lock:
+            if not self._segments or os.path.getsize(
+                    self._segment_path(self._segments[-1])) >= \
+                    self.segment_bytes:
+                number = self._segments[-1] + 1 if self._segments else 0
+                self._segments.append(number)
+                if len(self._segments) == 1:
+                    self._cursor = (number, 0)
+                    self._write_cursor()
+            with open(self._segment_path(self._segments[-1]), 'ab') as fp:
+                fp.write(record)
+                fp.flush()
+                os.fsync(fp.fileno())
+            self.spooled += 1
+            self._enforce_caps()
+            self._start_replayer()
+
+    def submit(self, header, body):
+        """
+        Sends a record, unless older ones are waiting to be replayed, and
+        spools it if it was not sent. Returns True if it was sent.
+        """
+        if not self.pending():
+            try:
+                if self.send(header, body) is not False:
+                    return True
+            except Exception as e:
+                logger.debug('Could not send to the sink of %s: %s' %
+                             (self.path, e))
+        logger.warning('Spooling a record to %s' % self.path)
+        self.append(header, body)
+        return False
+
+    def replay(self):
+        """
+        Sends the spooled records in order, until the sink fails to take one
+        of them. Returns the number of records sent.
+        """
+        replayed = 0
+        with self._replay_lock:
+            while True:
+                with self._lock:
+                    self._enforce_caps()
+                    if not self._segments:
+                        return replayed
+                    (number, offset) = self._cursor
+                    if number not in self._segments:
+                        (number, offset) = (self._segments[0], 0)
+                    path = self._segment_path(number)
+                    with open(path, 'rb') as fp:
+                        record = next(self._read_records(fp, offset), None)
+                    if record is None and offset < os.path.getsize(path):
+                        self._cursor = (number,
+                                        self._skip_corrupted(number, offset))
+                        self._write_cursor()
+                        continue
+                    elif record is None and number == self._segments[-1]:
+                        # All replayed, the spool starts over
+                        for number in self._segments:
+                            os.remove(self._segment_path(number))
+                        self._segments = []
+                        self._cursor = (0, 0)
+                        self._write_cursor()
+                        return replayed
+                    elif record is None:
+                        self._delete_segment(number)
+                        continue
+                (next_offset, header, body) = record
+                try:
+                    if self.send(header, body) is False:
+                        return replayed
+                except Exception as e:
+                    logger.debug('Could not replay to the sink of %s: %s' %
+                                 (self.path, e))
+                    return replayed
+                with self._lock:
+                    self._cursor = (number, next_offset)
+                    self._write_cursor()
+                    self.replayed += 1
+                replayed += 1
+
+    def _start_replayer(self):
+        # Called with the lock held
+        if not self._thread:
+            self._thread = threading.Thread(
+                target=self._run, name='spool-%s' % self.path)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            # Gives the sink some time to recover first
+            self._wakeup.wait(self.replay_interval)
+            self._wakeup.clear()
+            try:
+                replayed = self.replay()
+            except Exception:
+                logger.exception('Could not replay the spool at %s' %
+                                 self.path)
+                replayed = 0
+            if replayed:
+                logger.info('Replayed %d spooled records from %s' %
+                            (replayed, self.path))
+            with self._lock:
+                if not self._pending():
+                    # Started again by the next append
+                    self._thread = None
+                    return
+
+    def get_stats(self):
+        with self._lock:
+            return {'spooled': self.spooled, 'replayed': self.replayed,
+                    'dropped': self.dropped, 'segments': len(self._segments),
+                    'bytes': self._size()}
+
+
+# The spools of this process, by path
+_spools = {}
+_spools_pid = None
+_spools_lock = threading.Lock()
+
+
+def spool_path(spool_dir, url):
+    """
+    Returns the path of the spool of `url` under `spool_dir`.
+    """
+    return os.path.join(spool_dir, re.sub(r'[^A-Za-z0-9.-]', '_', url))
+
+
+def get_frame_spool(spool_dir, url, send, **kwargs):
+    """
+    Returns the spool of `url` under `spool_dir`, creating it with `send`
+    and `kwargs` the first time. The records left by a previous run are
+    replayed.
+    """
+    global _spools, _spools_pid
+    path = spool_path(spool_dir, url)
+    with _spools_lock:
+        if _spools_pid != os.getpid():
+            _spools = {}
+            _spools_pid = os.getpid()
+        spool = _spools.get(path)
+        if not spool:
+            spool = FrameSpool(path, send, **kwargs)
+            _spools[path] = spool
+            with spool._lock:
+                if spool._pending():
+                    # Left by a previous run
+                    spool._wakeup.set()
+                    spool._start_replayer()
+        return spool
+
+
+def get_frame_spool_stats():
+    with _spools_lock:
+        spools = _spools.values() if _spools_pid == os.getpid() else []
+    return dict((spool.path, spool.get_stats()) for spool in spools)
@@ -0,0 +1,231 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Posts frames over http. The process keeps a session, so that the connections
+to the servers are reused from one request to the next.
+
+Frames can also be batched: the records (lines) of the frames sent to a url
+are then posted together, in one request body, once they are more than
+`batch_bytes` or the first of them is `batch_secs` old. The body is
+compressed once for the whole batch.
+"""
+import os
+import gzip
+import time
+import logging
+import threading
+import cStringIO
+
+# External dependencies that must be pip install'ed separately
+
+import requests
+
+logger = logging.getLogger('crawlutils')
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """
+    Returns the requests.Session of this process. A forked process does not
+    share the connections of its parent.
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = requests.Session()
+            _session_pid = os.getpid()
+        return _session
+
+
+def http_post(url, headers, payload, max_retries, params=None):
+    """
+    Posts `payload` to `url`, trying again up to `max_retries` times, and
+    returns True if the server took it.
+    """
+    session = get_http_session()
+    for attempt in range(max_retries):
+        try:
+            response = session.post(
+                url, headers=headers, params=params, data=payload)
+        except requests.exceptions.ChunkedEncodingError as e:
+            logger.exception(e)
+            logger.error(
+                "POST to %s resulted in exception (attempt %d of %d), will "
+                "not re-try" % (url, attempt + 1, max_retries))
+            break
+        except requests.exceptions.RequestException as e:
+            logger.exception(e)
+            logger.error(
+                "POST to %s resulted in exception (attempt %d of %d)" %
+                (url, attempt + 1, max_retries))
+            time.sleep(2.0 ** attempt * 0.1)
+            continue
+        if response.status_code != requests.codes.ok:
+            logger.error(
+                "POST to %s resulted in status code %s: %s (attempt %d of "
+                "%d)" % (url, str(response.status_code), response.text,
+                         attempt + 1, max_retries))
+            time.sleep(2.0 ** attempt * 0.1)
+        else:
+            return True
+    return False
+
+
+def gzip_compress(data):
+    buf = cStringIO.StringIO()
+    with gzip.GzipFile(filename='', mode='wb', fileobj=buf) as fp:
+        fp.write(data)
+    return buf.getvalue()
+
+
+class HttpBatch(object):
+    """
+    The records waiting to be posted to `url` together, as a body of
+    `content_type`.
+    """
+
+    def __init__(
+        self,
+        url,
+        content_type,
+        compress=False,
+        batch_bytes=1024 * 1024,
+        batch_secs=5,
+        max_retries=5,
+        spool=None,
+    ):
+        self.url = url
+        self.content_type = content_type
+        self.compress = compress
+        self.batch_bytes = batch_bytes
+        self.batch_secs = batch_secs
+        self.max_retries = max_retries
+        self.spool = spool
+
+        self._records = []
+        self._num_bytes = 0
+        self._first_time = None
+        self._lock = threading.Lock()
+        # Held while posting, so that the batches are posted in order
+        self._post_lock = threading.Lock()
+
+    def add(self, records):
+        """
+        Adds `records` (strings ending with a newline) to the batch, and
+        posts it if it is full.
+        """
+        with self._lock:
+            first = not self._records
+            if first:
+                self._first_time = time.time()
+            self._records.extend(records)
+            self._num_bytes += sum(len(record) for record in records)
+            full = self._num_bytes >= self.batch_bytes
+        if full:
+            self.flush()
+        elif first:
+            with _batches_condition:
+                # The flusher may have to wake up earlier for it
+                _batches_condition.notify()
+
+    def due_time(self):
+        """
+        Returns the time the batch has to be posted by, or None if it is
+        empty.
+        """
+        with self._lock:
+            if not self._records:
+                return None
+            return self._first_time + self.batch_secs
+
+    def flush(self):
+        """
+        Posts the records of the batch, and returns True if there were none
+        or the server took them.
+        """
+        with self._post_lock:
+            with self._lock:
+                records = self._records
+                self._records = []
+                self._num_bytes = 0
+            if not records:
+                return True
+            body = ''.join(records)
+            headers = {'content-type': self.content_type}
+            if self.compress:
+                headers['content-encoding'] = 'gzip'
+                body = gzip_compress(body)
+            logger.debug('Posting %d records (%d bytes) to %s' %
+                         (len(records), len(body), self.url))
+            if self.spool:
+                return self.spool.submit({'headers': headers}, body)
+            return http_post(self.url, headers, body, self.max_retries)
+
+
+# The batches of this process, by (url, content type, compress)
+_batches = {}
+_batches_pid = None
+_batches_condition = threading.Condition()
+_flusher = None
+
+
+def _flush_due_batches():
+    """
+    Posts the batches when their time is due, for the ones that do not fill
+    up.
+    """
+    while True:
+        with _batches_condition:
+            now = time.time()
+            due = []
+            next_time = None
+            for batch in _batches.values():
+                due_time = batch.due_time()
+                if due_time is None:
+                    continue
+                if due_time <= now:
+                    due.append(batch)
+                elif next_time is None or due_time < next_time:
+                    next_time = due_time
+            if not due:
+                _batches_condition.wait(
+                    None if next_time is None else next_time - now)
+                continue
+        for batch in due:
+            batch.flush()
+
+
+def get_http_batch(url, content_type, compress, batch_bytes, batch_secs,
+                   max_retries, spool=None):
+    global _batches, _batches_pid, _flusher
+    with _batches_condition:
+        if _batches_pid != os.getpid():
+            _batches = {}
+            _batches_pid = os.getpid()
+            _flusher = None
+        key = (url, content_type, compress)
+        batch = _batches.get(key)
+        if not batch:
+            batch = HttpBatch(url, content_type, compress, batch_bytes,
+                              batch_secs, max_retries, spool)
+            _batches[key] = batch
+        if not _flusher:
+            _flusher = threading.Thread(target=_flush_due_batches,
+                                        name='http-batch-flusher')
+            _flusher.daemon = True
+            _flusher.start()
+        return batch
+
+
+def flush_http_batches():
+    """
+    Posts the records of all the batches of this process, like before it
+    exits.
+    """
+    with _batches_condition:
+        batches = _batches.values() if _batches_pid == os.getpid() else []
+    for batch in batches:
+        batch.flush()
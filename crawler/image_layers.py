@@ -0,0 +1,239 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Crawls of container roots that share the work done for their image. The root
+of a container is its image with its writable (upper) layer on top, so the
+crawl of one container of an image is kept, and the crawls of the other
+containers of that image only look again at the paths changed by their
+writable layer, or by the one of the container of the kept crawl.
+"""
+import os
+import stat
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger('crawlutils')
+
+# aufs deletes an entry with a .wh.<name> file next to it, and hides all the
+# image entries of a directory with a .wh..wh..opq file. The other names
+# starting with .wh..wh. are its own, like the .wh..wh.plnk directory.
+_AUFS_WHITEOUT = '.wh.'
+_AUFS_OPAQUE = '.wh..wh..opq'
+_AUFS_META = '.wh..wh.'
+
+# Kept crawls, by key (image id and crawl arguments), with their size. The
+# least recently used ones are dropped when there are more than
+# _MAX_IMAGE_CRAWLS of them, or when they are over _MAX_IMAGE_CRAWL_BYTES.
+_MAX_IMAGE_CRAWLS = 16
+_MAX_IMAGE_CRAWL_BYTES = 64 * 1024 * 1024
+_image_crawls = OrderedDict()
+_image_crawls_bytes = 0
+_image_crawls_lock = threading.Lock()
+
+
+def _join(reldir, name):
+    return os.path.join(reldir, name) if reldir else name
+
+
+def is_under(relpath, reldir):
+    """
+    Returns True if `relpath` is `reldir` or is under it.
+    """
+    return (not reldir or relpath == reldir or
+            relpath.startswith(reldir + '/'))
+
+
+class LayerChanges(object):
+    """
+    What a writable layer changed, as paths relative to the root without a
+    leading '/': `paths` are the entries it added or changed, and `subtrees`
+    the entries whose whole subtree can differ from the image (the ones it
+    deleted, and the directories it replaced). An empty path is the root.
+    """
+
+    def __init__(self, paths=(), subtrees=()):
+        self.paths = set(paths)
+        self.subtrees = set(subtrees)
+
+    @property
+    def count(self):
+        return len(self.paths) + len(self.subtrees)
+
+    def union(self, other):
+        return LayerChanges(self.paths | other.paths,
+                            self.subtrees | other.subtrees)
+
+    def in_subtrees(self, relpath):
+        if '' in self.subtrees:
+            return True
+        # Checks the path and its parent directories
+        parts = relpath.split('/')
+        for depth in xrange(1, len(parts) + 1):
+            if '/'.join(parts[:depth]) in self.subtrees:
+                return True
+        return False
+
+    def covers(self, relpath):
+        """
+        Returns True if the entry at `relpath` can differ from the image.
+        """
+        return relpath in self.paths or self.in_subtrees(relpath)
+
+    def top_subtrees(self):
+        """
+        Returns the sorted `subtrees` that are not under another one.
+        """
+        tops = []
+        for subtree in sorted(self.subtrees):
+            if not any(is_under(subtree, top) for top in tops):
+                tops.append(subtree)
+        return tops
+
+
+def _is_overlay_whiteout(path):
+    try:
+        lstat = os.lstat(path)
+    except OSError:
+        # Deleted since, so crawled again like a deleted entry
+        return True
+    return stat.S_ISCHR(lstat.st_mode) and lstat.st_rdev == 0
+
+
+def read_layer_changes(upper_dir, rootfs_dir):
+    """
+    Returns the LayerChanges of the writable layer at `upper_dir` of the
+    root at `rootfs_dir`, with the whiteouts of aufs or overlay.
+
+    A directory of the layer that shows nothing else than the entries of the
+    layer in the root is taken as replaced. That is the case of the opaque
+    directories, and if it is not, nothing of the image is visible in it
+    anyway.
+    """
+    changes = LayerChanges()
+    for (dirpath, dirs, files) in os.walk(upper_dir):
+        reldir = os.path.relpath(dirpath, upper_dir)
+        if reldir == '.':
+            reldir = ''
+        changes.paths.add(reldir)
+        visible = set()
+        for name in dirs + files:
+            relpath = _join(reldir, name)
+            if name == _AUFS_OPAQUE:
+                changes.subtrees.add(reldir)
+            elif name.startswith(_AUFS_META):
+                continue
+            elif name.startswith(_AUFS_WHITEOUT):
+                changes.subtrees.add(_join(reldir,
+                                           name[len(_AUFS_WHITEOUT):]))
+            elif _is_overlay_whiteout(os.path.join(dirpath, name)):
+                changes.subtrees.add(relpath)
+            else:
+                changes.paths.add(relpath)
+                visible.add(name)
+        if reldir not in changes.subtrees:
+            try:
+                if set(os.listdir(os.path.join(rootfs_dir, reldir))) == \
+                        visible:
+                    changes.subtrees.add(reldir)
+            except OSError:
+                # Deleted since
+                changes.subtrees.add(reldir)
+        if reldir in changes.subtrees:
+            # All of it is crawled again anyway
+            dirs[:] = []
+        else:
+            dirs[:] = [name for name in dirs
+                       if not name.startswith(_AUFS_WHITEOUT)]
+    return changes
+
+
+def _approximate_size(value):
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, (tuple, list, set)):
+        return sum(_approximate_size(v) for v in value) + 8
+    if isinstance(value, dict):
+        return sum(_approximate_size(k) + _approximate_size(v)
+                   for (k, v) in value.iteritems()) + 8
+    return 8
+
+
+def get_image_crawl(key):
+    """
+    Returns the (items, changes) kept for `key` by `put_image_crawl()`, or
+    None.
+    """
+    with _image_crawls_lock:
+        crawl = _image_crawls.pop(key, None)
+        if crawl is None:
+            return None
+        _image_crawls[key] = crawl
+        return crawl[:2]
+
+
+def put_image_crawl(key, items, changes):
+    global _image_crawls_bytes
+    size = (_approximate_size(items) + _approximate_size(changes.paths) +
+            _approximate_size(changes.subtrees))
+    with _image_crawls_lock:
+        old = _image_crawls.pop(key, None)
+        if old is not None:
+            _image_crawls_bytes -= old[2]
+        if size > _MAX_IMAGE_CRAWL_BYTES:
+            logger.debug('Not keeping the crawl of %s, of %d bytes' %
+                         (key, size))
+            return
+        _image_crawls[key] = (items, changes, size)
+        _image_crawls_bytes += size
+        while (len(_image_crawls) > _MAX_IMAGE_CRAWLS or
+               _image_crawls_bytes > _MAX_IMAGE_CRAWL_BYTES):
+            (_, (_, _, dropped_size)) = _image_crawls.popitem(last=False)
+            _image_crawls_bytes -= dropped_size
+
+
+def forget_image_crawls():
+    """
+    Drops all the kept crawls.
+    """
+    global _image_crawls_bytes
+    with _image_crawls_lock:
+        _image_crawls.clear()
+        _image_crawls_bytes = 0
+
+
+def crawl_layered(key, changes, crawl_all, crawl_changed):
+    """
+    Yields the (relpath, item) of the crawl of the root of a container with
+    the LayerChanges `changes`, where `relpath` is the path the `item` was
+    crawled from, relative to the root.
+
+    `crawl_all()` crawls the whole root, and `crawl_changed(changes)` only
+    the `paths` and `subtrees` of `changes`. The first crawl for `key` (the
+    image and the crawl arguments) is a full one, and it is kept so that the
+    next ones only crawl what changed. The crawl of the container with the
+    fewest changes is the one kept.
+    """
+    kept = get_image_crawl(key)
+    if kept is None:
+        items = []
+        for item in crawl_all():
+            items.append(item)
+            yield item
+        put_image_crawl(key, items, changes)
+        return
+
+    (kept_items, kept_changes) = kept
+    logger.debug('Reusing the crawl of %s, but for %d changes' %
+                 (key, kept_changes.count + changes.count))
+    all_changes = changes.union(kept_changes)
+    items = []
+    for (relpath, item) in kept_items:
+        if not all_changes.covers(relpath):
+            items.append((relpath, item))
+            yield (relpath, item)
+    for item in crawl_changed(all_changes):
+        items.append(item)
+        yield item
+    if changes.count < kept_changes.count:
+        put_image_crawl(key, items, changes)
@@ -0,0 +1,255 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+A kafka producer per topic, kept by the process for all the frames emitted to
+it, instead of connecting again for every frame. The frames are produced from
+a background thread, in batches.
+"""
+import os
+import time
+import logging
+import threading
+from collections import deque
+
+# External dependencies that must be pip install'ed separately
+
+import kafka as kafka_python
+import pykafka
+
+import defaults
+from crawler_exceptions import EmitterEmitTimeout
+from misc import NullHandler
+
+logger = logging.getLogger('crawlutils')
+
+# Kafka logs too much
+logging.getLogger('kafka').addHandler(NullHandler())
+
+
+class KafkaDelivery(object):
+    """
+    The delivery of the messages of one `KafkaProducer.send()`. The
+    `callback`, if any, is called with None once they are produced, or with
+    the exception that kept them from being produced.
+    """
+
+    def __init__(self, num_bytes, callback=None):
+        self.num_bytes = num_bytes
+        self.callback = callback
+        self.exception = None
+        self._done = threading.Event()
+
+    def done(self, exception=None):
+        self.exception = exception
+        self._done.set()
+        if self.callback:
+            try:
+                self.callback(exception)
+            except Exception:
+                logger.exception('Kafka delivery callback failed')
+
+    def wait(self, timeout):
+        """
+        Waits up to `timeout` seconds for the messages to be produced, and
+        raises the exception that kept them from being produced, or an
+        EmitterEmitTimeout.
+        """
+        if not self._done.wait(timeout):
+            raise EmitterEmitTimeout('Timed out waiting for kafka after %s '
+                                     'seconds.' % timeout)
+        if self.exception:
+            raise self.exception
+
+
+class KafkaProducer(object):
+    """
+    Produces messages to the kafka `topic` at `kurl` from a background
+    thread, over a connection kept for all of them (and opened again after
+    an error).
+
+    The messages sent while the thread is busy are produced together, in
+    batches of up to `batch_size` messages or `batch_bytes` bytes. A batch
+    waits up to `linger_ms` for more messages. At most `max_pending`
+    messages wait to be produced, the deliveries of the ones sent above that
+    fail right away.
+    """
+
+    def __init__(
+        self,
+        kurl,
+        topic,
+        timeout_secs=30,
+        linger_ms=defaults.DEFAULT_KAFKA_LINGER_MS,
+        batch_size=defaults.DEFAULT_KAFKA_BATCH_SIZE,
+        batch_bytes=defaults.DEFAULT_KAFKA_BATCH_BYTES,
+        max_pending=defaults.DEFAULT_KAFKA_MAX_PENDING,
+    ):
+        self.kurl = kurl
+        self.topic = topic
+        self.timeout_secs = timeout_secs
+        self.linger_ms = linger_ms
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.max_pending = max_pending
+
+        self._producer = None
+        # (messages, delivery) waiting to be produced
+        self._pending = deque()
+        self._num_pending = 0
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+    def send(self, messages, callback=None):
+        """
+        Queues `messages` (a list of strings) to be produced together, and
+        returns their KafkaDelivery.
+        """
+        delivery = KafkaDelivery(sum(len(m) for m in messages), callback)
+        with self._condition:
+            if self._closed:
+                delivery.done(EmitterEmitTimeout('The kafka producer for %s '
+                                                 'is closed.' % self.kurl))
+                return delivery
+            if self._num_pending + len(messages) > self.max_pending:
+                delivery.done(EmitterEmitTimeout(
+                    'Too many messages waiting for kafka at %s.' % self.kurl))
+                return delivery
+            self._pending.append((messages, delivery))
+            self._num_pending += len(messages)
+            if not self._thread:
+                self._thread = threading.Thread(
+                    target=self._run, name='kafka-producer-%s' % self.topic)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+        return delivery
+
+    def close(self, timeout=None):
+        """
+        Produces the messages already sent, and stops the thread.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread
+        if thread:
+            thread.join(timeout)
+
+    def _batch_full(self):
+        num_bytes = sum(d.num_bytes for (_, d) in self._pending)
+        return (self._num_pending >= self.batch_size or
+                num_bytes >= self.batch_bytes)
+
+    def _next_batch(self):
+        # Called with the condition held
+        while not self._pending and not self._closed:
+            self._condition.wait()
+        deadline = time.time() + self.linger_ms / 1000.0
+        while not self._closed and not self._batch_full():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self._condition.wait(remaining)
+        batch = []
+        (num_messages, num_bytes) = (0, 0)
+        while self._pending:
+            (messages, delivery) = self._pending[0]
+            # The messages of a send() are produced together, even above
+            # the batch limits
+            if batch and (num_messages + len(messages) > self.batch_size or
+                          num_bytes + delivery.num_bytes > self.batch_bytes):
+                break
+            self._pending.popleft()
+            self._num_pending -= len(messages)
+            batch.append((messages, delivery))
+            num_messages += len(messages)
+            num_bytes += delivery.num_bytes
+        return batch
+
+    def _run(self):
+        while True:
+            with self._condition:
+                batch = self._next_batch()
+                if not batch:
+                    # Closed, and nothing left
+                    self._thread = None
+                    return
+            messages = []
+            for (batch_messages, _) in batch:
+                messages.extend(batch_messages)
+            try:
+                self._get_producer().produce(messages)
+                exception = None
+            except Exception as e:
+                logger.debug('Could not produce %d messages to %s: %s' %
+                             (len(messages), self.kurl, e))
+                # Connect again for the next batch
+                self._producer = None
+                exception = e
+            for (_, delivery) in batch:
+                delivery.done(exception)
+
+    def _get_producer(self):
+        if self._producer is None:
+            kafka_python_client = kafka_python.KafkaClient(
+                self.kurl, timeout=self.timeout_secs)
+            try:
+                kafka_python_client.ensure_topic_exists(
+                    self.topic, timeout=self.timeout_secs)
+            finally:
+                kafka_python_client.close()
+            kafka = pykafka.KafkaClient(
+                hosts=self.kurl,
+                socket_timeout_ms=int(self.timeout_secs * 1000))
+            # the default partitioner is random_partitioner
+            self._producer = kafka.topics[self.topic].get_producer()
+        return self._producer
+
+
+# The producers of this process, by (kurl, topic). A forked process can not
+# use the ones of its parent, whose threads are not running in it.
+_producers = {}
+_producers_pid = None
+_producers_lock = threading.Lock()
+
+
+def get_kafka_producer(kurl, topic, timeout_secs=30):
+    global _producers, _producers_pid
+    with _producers_lock:
+        if _producers_pid != os.getpid():
+            _producers = {}
+            _producers_pid = os.getpid()
+        producer = _producers.get((kurl, topic))
+        if not producer:
+            producer = KafkaProducer(kurl, topic, timeout_secs)
+            _producers[(kurl, topic)] = producer
+        return producer
+
+
+def forget_kafka_producer(kurl, topic):
+    """
+    Drops the producer of `topic` at `kurl`, like after it timed out, so that
+    the next frames are sent with a new one. The thread of the old one stops
+    after the batch it is producing.
+    """
+    with _producers_lock:
+        producer = None
+        if _producers_pid == os.getpid():
+            producer = _producers.pop((kurl, topic), None)
+    if producer:
+        producer.close(timeout=0)
+
+
+def close_kafka_producers(timeout=None):
+    """
+    Closes all the producers of this process, producing the messages they
+    were sent first.
+    """
+    global _producers
+    with _producers_lock:
+        producers = _producers.values() if _producers_pid == os.getpid() \
+            else []
+        _producers = {}
+    for producer in producers:
+        producer.close(timeout)
@@ -2,12 +2,13 @@
 # -*- coding: utf-8 -*-
 import os
 import multiprocessing
-import Queue
 import logging
 import sys
 import types
 import signal
+import threading
 import ctypes
+import copy_reg
 import cPickle as pickle
 import misc
 from crawler_exceptions import (CrawlTimeoutError,
@@ -26,6 +27,12 @@ except Exception as e:
 ALL_NAMESPACES = 'user pid uts ipc net mnt'.split()
 IN_CONTAINER_TIMEOUT = 30
 
+# Results of functions returning a generator are streamed back from the
+# namespace workers in chunks of at most this many items or (approximately)
+# bytes.
+STREAM_CHUNK_ITEMS = 1000
+STREAM_CHUNK_BYTES = 2 ** 20
+
 
 def get_errno_msg():
     try:
@@ -52,166 +59,315 @@ def get_pid_namespace(pid):
         return None
 
 
-class ProcessContext:
+def _reduce_method(method):
+    """Bound methods are not picklable by default. Pickle them by reference
+    to their instance (or class) so they can be sent to a namespace worker.
+    """
+    if method.im_self is None:
+        return (getattr, (method.im_class, method.im_func.__name__))
+    return (getattr, (method.im_self, method.im_func.__name__))
 
-    def __init__(self, pid, namespaces):
-        self.namespaces = namespaces
-        self.pid = pid
+copy_reg.pickle(types.MethodType, _reduce_method)
+
+
+class NamespaceWorker(object):
 
-    def attach(self):
-        # Just to be sure log rotation does not happen in the container
+    """A long-lived process attached to the namespaces of a container.
 
-        logging.disable(logging.CRITICAL)
+    The worker is forked once per container (and set of namespaces) and then
+    serves any number of function calls sent over a pipe, instead of forking
+    a new process for every feature at every crawl interval. The crawler
+    process itself never leaves its own namespaces: the setns() calls happen
+    in the forked child.
+
+    If the function returns a generator, its items are streamed back in
+    chunks as they are produced and `run` returns a generator as well. The
+    worker blocks on the pipe until the crawler reads the previous chunk, so
+    memory stays bounded on both sides.
+    """
+
+    def __init__(self, pid, namespaces):
+        self.pid = str(pid)
+        self.namespaces = list(namespaces)
+        self.process = None
+        self.server_pid = None
+        self.conn = None
+        self.streaming = False
+
+    def start(self):
+        (self.conn, child_conn) = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            name='crawler-ns-%s' % self.pid,
+            target=_namespace_worker_main,
+            args=(child_conn, self.conn, self.pid, self.namespaces))
+        # Daemonic, so the crawler does not wait for workers when exiting.
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+        # The worker replies with the pid of the process serving the requests
+        # once it is attached to the namespaces.
         try:
-            self.host_ns_fds = {}
-            self.container_ns_fds = {}
-            self.host_cwd = os.getcwd()
-            open_process_namespaces('self', self.host_ns_fds,
-                                    self.namespaces)
-            open_process_namespaces(self.pid, self.container_ns_fds,
-                                    self.namespaces)
-        except Exception as e:
-            logging.disable(logging.NOTSET)
-            logger.exception(e)
+            (_, self.server_pid) = self._get_reply()
+        except Exception:
+            self.stop()
             raise
 
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def run(self, function, *args, **kwargs):
+        if self.streaming:
+            # The previous stream was abandoned half way, and the rest of it
+            # is still in the pipe. Start from scratch.
+            logger.debug('Restarting the namespace worker of pid=%s'
+                         % self.pid)
+            self.stop()
+            self.start()
         try:
-            attach_to_process_namespaces(self.container_ns_fds,
-                                         self.namespaces)
-        except Exception as e:
-            logging.disable(logging.NOTSET)
-            error_msg = (
-                'Could not attach to the pid=%s container mnt namespace. '
-                'Exception: %s' % (self.pid, e))
-            logger.error(error_msg)
-            self.detach()
+            self.conn.send((function, args, kwargs))
+        except (IOError, EOFError) as e:
+            self.stop()
+            raise CrawlError('Namespace worker for pid=%s is gone: %s' %
+                             (self.pid, e))
+        (kind, result) = self._get_reply()
+        if kind == 'result':
+            return result
+        self.streaming = True
+        return self._stream(kind, result)
+
+    def _stream(self, kind, chunk):
+        conn = self.conn
+        try:
+            while kind == 'chunk':
+                for item in _decode_chunk(chunk):
+                    yield item
+                if conn is not self.conn:
+                    raise CrawlError('The namespace worker of pid=%s was '
+                                     'restarted while streaming' % self.pid)
+                (kind, chunk) = self._get_reply()
+        except GeneratorExit:
+            # Unless the worker was already restarted by a later call
+            if conn is self.conn:
+                self.stop()
             raise
-
-    def detach(self):
+        finally:
+            if conn is self.conn:
+                self.streaming = False
+
+    def _get_reply(self):
+        if not self.conn.poll(IN_CONTAINER_TIMEOUT):
+            errmsg = ('Timed out waiting for the namespace worker of pid=%s.'
+                      % self.pid)
+            logger.error(errmsg)
+            self.stop()
+            raise CrawlTimeoutError(errmsg)
         try:
-            # Re-attach to the process original namespaces before attaching the
-            # first time to self.pid namespaces.
-            attach_to_process_namespaces(self.host_ns_fds,
-                                         self.namespaces)
-        except Exception as e:
-            logging.disable(logging.NOTSET)
-            logger.error('Could not move back to the host: %s' % e)
-            # XXX can't recover from this one. But it would be better to
-            # bubble up the error.
-            sys.exit(1)
-
-        # We are now in host context
-        os.chdir(self.host_cwd)
-
-        logging.disable(logging.NOTSET)
-        close_process_namespaces(self.container_ns_fds,
-                                 self.namespaces)
-        close_process_namespaces(self.host_ns_fds, self.namespaces)
+            (kind, result) = self.conn.recv()
+        except (IOError, EOFError) as e:
+            self.stop()
+            raise CrawlError('Namespace worker for pid=%s died: %s' %
+                             (self.pid, e))
+        if kind == 'error':
+            raise result
+        return (kind, result)
+
+    def stop(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+        if self.process and self.process.is_alive():
+            # The server is only reaped by its parent, so while the parent is
+            # alive its pid can not have been reused.
+            for pid in [self.server_pid, self.process.pid]:
+                try:
+                    pid and os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+        if self.process:
+            self.process.join(IN_CONTAINER_TIMEOUT)
+            self.process = None
+        self.streaming = False
+
+
+def _namespace_worker_main(conn, parent_conn, pid, namespaces):
+    """
+    Entry point of a namespace worker. Attaches to the namespaces of `pid`
+    and forks the process that serves the requests, as a setns() on the pid
+    namespace only applies to the children of the caller.
+    """
+
+    # Only the crawler side of the pipe should be left open, so that the
+    # server sees an EOF when the crawler goes away.
+    parent_conn.close()
 
+    # Die if the parent dies
+    PR_SET_PDEATHSIG = 1
+    get_libc().prctl(PR_SET_PDEATHSIG, signal.SIGKILL)
 
-def run_as_another_namespace(
-    pid,
-    namespaces,
-    function,
-    *args,
-    **kwargs
-):
-    hack_to_pre_load_modules()
+    # Just to be sure log rotation does not happen in the container
+    logging.disable(logging.CRITICAL)
 
-    context = ProcessContext(pid, namespaces)
-    context.attach()
     try:
-        queue = multiprocessing.Queue(2 ** 15)
-    except OSError:
-        # try again with a smaller queue
-        queue = multiprocessing.Queue(2 ** 14)
+        attach_to_namespaces(pid, namespaces)
+    except Exception as e:
+        _send_reply(conn, ('error', e))
+        conn.close()
+        sys.exit(1)
 
-    child_process = multiprocessing.Process(
-        name='crawler-%s' %
-        pid, target=function_wrapper, args=(
-            queue, function, args), kwargs=kwargs)
-    child_process.start()
+    server_pid = os.fork()
+    if server_pid == 0:
+        get_libc().prctl(PR_SET_PDEATHSIG, signal.SIGKILL)
+        try:
+            _serve_requests(conn)
+        finally:
+            os._exit(0)
 
-    child_exception = None
-    try:
-        (result, child_exception) = queue.get(timeout=IN_CONTAINER_TIMEOUT)
-    except Queue.Empty:
-        child_exception = CrawlTimeoutError()
-    except Exception:
-        result = None
+    _send_reply(conn, ('result', server_pid))
+    conn.close()
+    os.waitpid(server_pid, 0)
 
-    if child_exception:
-        result = None
 
-    child_process.join(IN_CONTAINER_TIMEOUT)
+def _serve_requests(conn):
+    while True:
+        try:
+            request = conn.recv()
+        except (IOError, EOFError):
+            break
+        if request is None:
+            break
+        (function, args, kwargs) = request
+        try:
+            result = function(*args, **kwargs)
 
-    # The join failed and the process might still be alive
+            # if res is a generator (i.e. function uses yield), stream the
+            # items as they are produced
 
-    if child_process.is_alive():
-        errmsg = ('Timed out waiting for process %d to exit.' %
-                  child_process.pid)
-        queue.close()
-        os.kill(child_process.pid, 9)
-        context.detach()
-        logger.error(errmsg)
-        raise CrawlTimeoutError(errmsg)
+            if isinstance(result, types.GeneratorType):
+                for chunk in _encode_chunks(result):
+                    conn.send(('chunk', chunk))
+                reply = ('end', None)
+            else:
+                reply = ('result', result)
+        except Exception as e:
+            reply = ('error', e)
+        _send_reply(conn, reply)
 
-    context.detach()
 
-    if result is None:
-        if child_exception:
-            raise child_exception
-        raise CrawlError('Unknown crawl error.')
-    return result
+def _send_reply(conn, reply):
+    try:
+        conn.send(reply)
+    except (pickle.PicklingError, TypeError) as e:
+        conn.send(('error', CrawlError('Could not send the crawl result: %s'
+                                       % e)))
+
+
+def _encode_chunks(items):
+    """
+    Groups the items produced by a generator into chunks of bounded size.
+
+    The crawl functions yield (key, feature) tuples where the feature is a
+    namedtuple. Those are encoded as plain tuples of values plus an index into
+    a table of namedtuple classes, so that each class is pickled once per
+    chunk instead of once per feature.
+    """
+    (classes, rows, size) = ([], [], 0)
+    for item in items:
+        if (isinstance(item, tuple) and len(item) == 2 and
+                hasattr(item[1], '_make')):
+            feature_class = type(item[1])
+            if feature_class not in classes:
+                classes.append(feature_class)
+            values = tuple(item[1])
+            rows.append((classes.index(feature_class), item[0], values))
+        else:
+            values = item
+            rows.append((-1, None, item))
+        size += _approximate_size(values)
+        if len(rows) >= STREAM_CHUNK_ITEMS or size >= STREAM_CHUNK_BYTES:
+            yield (classes, rows)
+            (classes, rows, size) = ([], [], 0)
+    if rows:
+        yield (classes, rows)
+
+
+def _decode_chunk(chunk):
+    (classes, rows) = chunk
+    for (index, key, values) in rows:
+        if index < 0:
+            yield values
+        else:
+            yield (key, classes[index]._make(values))
+
+
+def _approximate_size(value):
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum(_approximate_size(v) for v in value) + 8
+    return 8
+
+
+# Containers can be crawled from several threads, but a container is only
+# crawled by one thread at a time, so only the registry needs a lock.
+_namespace_workers = {}
+_namespace_workers_lock = threading.Lock()
+
+
+def get_namespace_worker(pid, namespaces):
+    """
+    Returns the worker attached to the `namespaces` of `pid`, starting one
+    if there is none (or if the previous one died).
+    """
+    key = (str(pid), tuple(namespaces))
+    with _namespace_workers_lock:
+        worker = _namespace_workers.get(key)
+    if worker and worker.is_alive():
+        return worker
+    if worker:
+        worker.stop()
+    worker = NamespaceWorker(pid, namespaces)
+    worker.start()
+    with _namespace_workers_lock:
+        _namespace_workers[key] = worker
+    return worker
+
+
+def stop_namespace_workers(pid=None):
+    """
+    Stops the workers attached to the namespaces of `pid`, or all of them if
+    `pid` is None. This has to be called when a container goes away.
+    """
+    with _namespace_workers_lock:
+        workers = [_namespace_workers.pop(key)
+                   for key in _namespace_workers.keys()
+                   if pid is None or key[0] == str(pid)]
+    for worker in workers:
+        worker.stop()
 
 
-def function_wrapper(
-    queue,
+def run_as_another_namespace(
+    pid,
+    namespaces,
     function,
     *args,
     **kwargs
 ):
+    worker = get_namespace_worker(pid, namespaces)
+    return worker.run(function, *args, **kwargs)
 
-    # Die if the parent dies
-    PR_SET_PDEATHSIG = 1
-    get_libc().prctl(PR_SET_PDEATHSIG, signal.SIGHUP)
-
-    def signal_handler_sighup(*args):
-        logger.warning('Crawler parent process died, so exiting... Bye!')
-        queue.close()
-        exit(1)
-
-    signal.signal(signal.SIGHUP, signal_handler_sighup)
 
-    result = None
+def attach_to_namespaces(pid, namespaces):
+    """
+    Moves the calling process into the `namespaces` of `pid`. There is no
+    way back, so this is only meant to be called from a forked process.
+    """
+    namespace_fd = {}
     try:
-        args = args[0]
-        result = function(*args)
-
-        # if res is a generator (i.e. function uses yield)
-
-        if isinstance(result, types.GeneratorType):
-            result = list(result)
-        queue.put((result, None))
-        queue.close()
-        sys.exit(0)
-    except Exception as e:
-        queue.put((None, e))
-        queue.close()
-        sys.exit(1)
-
-
-def hack_to_pre_load_modules():
-    queue = multiprocessing.Queue()
-
-    def foo(queue):
-        queue.put('dummy')
-        pass
-
-    p = multiprocessing.Process(target=foo, args=(queue, ))
-    p.start()
-    queue.get()
-    p.join()
+        open_process_namespaces(str(pid), namespace_fd, namespaces)
+        attach_to_process_namespaces(namespace_fd, namespaces)
+    finally:
+        close_process_namespaces(namespace_fd, namespace_fd.keys())
 
 
 def open_process_namespaces(pid, namespace_fd, namespaces):
@@ -0,0 +1,143 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import socket
+import struct
+import logging
+from collections import namedtuple
+
+import psutil
+
+logger = logging.getLogger('crawlutils')
+
+# laddr and raddr are (ip, port), and raddr is () when not connected, as
+# with psutil.
+Connection = namedtuple('Connection', ['inode', 'laddr', 'raddr', 'status'])
+
+# The tables in /proc/<pid>/net with the internet sockets
+_TABLES = [('tcp', socket.AF_INET), ('tcp6', socket.AF_INET6),
+           ('udp', socket.AF_INET), ('udp6', socket.AF_INET6)]
+
+_TCP_STATUSES = {
+    '01': psutil.CONN_ESTABLISHED,
+    '02': psutil.CONN_SYN_SENT,
+    '03': psutil.CONN_SYN_RECV,
+    '04': psutil.CONN_FIN_WAIT1,
+    '05': psutil.CONN_FIN_WAIT2,
+    '06': psutil.CONN_TIME_WAIT,
+    '07': psutil.CONN_CLOSE,
+    '08': psutil.CONN_CLOSE_WAIT,
+    '09': psutil.CONN_LAST_ACK,
+    '0A': psutil.CONN_LISTEN,
+    '0B': psutil.CONN_CLOSING,
+}
+
+
+def _decode_address(address, family):
+    (ip, port) = address.split(':')
+    port = int(port, 16)
+    # The address is stored as 32 bit words in host byte order
+    if family == socket.AF_INET:
+        ip = socket.inet_ntop(family, struct.pack('=I', int(ip, 16)))
+    else:
+        ip = socket.inet_ntop(family, struct.pack(
+            '=4I', *[int(ip[i:i + 8], 16) for i in range(0, 32, 8)]))
+    return (ip, port)
+
+
+def read_sockets(pid, proc_dir='/proc'):
+    """
+    Returns the internet sockets of the network namespace of `pid`, as a
+    dict of inode to Connection.
+    """
+    sockets = {}
+    for (name, family) in _TABLES:
+        path = os.path.join(proc_dir, str(pid), 'net', name)
+        try:
+            with open(path, 'rb') as fp:
+                lines = fp.readlines()[1:]
+        except IOError as e:
+            # No IPv6 in the kernel
+            logger.debug('Could not read %s: %s' % (path, e))
+            continue
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 10:
+                continue
+            inode = int(fields[9])
+            if not inode:
+                # Orphaned, as in TIME_WAIT
+                continue
+            laddr = _decode_address(fields[1], family)
+            raddr = _decode_address(fields[2], family)
+            if not raddr[1]:
+                raddr = ()
+            status = (_TCP_STATUSES.get(fields[3], psutil.CONN_NONE)
+                      if name.startswith('tcp') else psutil.CONN_NONE)
+            sockets[inode] = Connection(inode, laddr, raddr, status)
+    return sockets
+
+
+def _socket_inodes(pid, proc_dir):
+    fd_dir = os.path.join(proc_dir, str(pid), 'fd')
+    inodes = []
+    for fd in os.listdir(fd_dir):
+        try:
+            link = os.readlink(os.path.join(fd_dir, fd))
+        except OSError:
+            continue
+        if link.startswith('socket:['):
+            inodes.append(int(link[8:-1]))
+    return inodes
+
+
+def get_connections(pids, proc_dir='/proc'):
+    """
+    Yields (pid, Connection) for the internet sockets open by the processes
+    `pids`. The sockets of every network namespace are read once, and matched
+    to the processes by their inode.
+    """
+    # Network namespace -> pids in it, in the order given
+    namespaces = {}
+    order = []
+    for pid in pids:
+        try:
+            net_ns = os.stat(os.path.join(proc_dir, str(pid),
+                                          'ns/net')).st_ino
+        except OSError:
+            # Gone, or not ours to see
+            continue
+        if net_ns not in namespaces:
+            namespaces[net_ns] = []
+            order.append(net_ns)
+        namespaces[net_ns].append(pid)
+
+    for net_ns in order:
+        ns_pids = namespaces[net_ns]
+        # Socket inode -> pids with it open
+        owners = {}
+        for pid in ns_pids:
+            try:
+                inodes = _socket_inodes(pid, proc_dir)
+            except OSError:
+                continue
+            for inode in inodes:
+                owners.setdefault(inode, []).append(pid)
+        if not owners:
+            continue
+
+        sockets = {}
+        for pid in ns_pids:
+            sockets = read_sockets(pid, proc_dir)
+            if sockets:
+                break
+
+        connections = {}
+        for (inode, pids_with_socket) in owners.iteritems():
+            connection = sockets.get(inode)
+            if connection:
+                for pid in pids_with_socket:
+                    connections.setdefault(pid, []).append(connection)
+        for pid in ns_pids:
+            for connection in connections.get(pid, []):
+                yield (pid, connection)
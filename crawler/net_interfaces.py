@@ -0,0 +1,76 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger('crawlutils')
+
+
+def read_net_dev(pid, proc_dir='/proc'):
+    """
+    Returns the counters of the network interfaces in the network namespace
+    of `pid`, from /proc/<pid>/net/dev, as a dict of interface name to
+    [bytes_sent, bytes_recv, packets_sent, packets_recv, errout, errin] (the
+    order of psutil and of the interface feature).
+    """
+    counters = {}
+    with open(os.path.join(proc_dir, str(pid), 'net', 'dev'), 'rb') as fp:
+        # The first two lines are headers
+        for line in fp.readlines()[2:]:
+            (ifname, _, fields) = line.partition(':')
+            fields = fields.split()
+            if len(fields) < 11:
+                continue
+            # Received bytes, packets and errors, then 5 other received
+            # counters, then sent bytes, packets and errors
+            counters[ifname.strip()] = [int(fields[8]), int(fields[0]),
+                                        int(fields[9]), int(fields[1]),
+                                        int(fields[10]), int(fields[2])]
+    return counters
+
+
+# (counters, timestamp) by pid, read by the last snapshot and not used yet
+_snapshot = {}
+_snapshot_lock = threading.Lock()
+
+
+def snapshot_interface_counters(pids, proc_dir='/proc'):
+    """
+    Reads the interface counters of the network namespaces of all `pids` (of
+    the containers about to be crawled) in one pass, reading every network
+    namespace once, and keeps them for `get_interface_counters()`.
+    """
+    global _snapshot
+    # Network namespace -> (counters, timestamp)
+    namespaces = {}
+    snapshot = {}
+    for pid in pids:
+        try:
+            net_ns = os.stat(os.path.join(proc_dir, str(pid),
+                                          'ns/net')).st_ino
+            if net_ns not in namespaces:
+                namespaces[net_ns] = (read_net_dev(pid, proc_dir),
+                                      time.time())
+        except (IOError, OSError) as e:
+            # Gone, and its crawl will tell
+            logger.debug('Could not read the interfaces of process %s: %s'
+                         % (pid, e))
+            continue
+        snapshot[str(pid)] = namespaces[net_ns]
+    with _snapshot_lock:
+        _snapshot = snapshot
+
+
+def get_interface_counters(pid, proc_dir='/proc'):
+    """
+    Returns (counters, timestamp), the interface counters of the network
+    namespace of `pid` (as returned by `read_net_dev()`) and when they were
+    read. They are taken from the last snapshot if it has them, or read now.
+    """
+    with _snapshot_lock:
+        counters = _snapshot.pop(str(pid), None)
+    if counters:
+        return counters
+    return (read_net_dev(pid, proc_dir), time.time())
@@ -3,13 +3,86 @@ import subprocess
 import logging
 import tempfile
 import shutil
+import struct
+import sqlite3
+import itertools
+import threading
+from collections import OrderedDict
 
 from misc import subprocess_run
 from features import PackageFeature
+import rpmdb
 
 logger = logging.getLogger('crawlutils')
 
 
+# The dpkg states of the packages not listed by dpkg-query -W
+_DPKG_NOT_INSTALLED = ['not-installed']
+
+# Most package databases parsed kept at once, for the containers of the
+# same image to share them
+_MAX_PACKAGE_DATABASES = 256
+
+# Database file identity -> its packages, least recently used first
+_package_databases = OrderedDict()
+_package_databases_lock = threading.Lock()
+
+
+def _file_identity(path):
+    st = os.stat(path)
+    return (st.st_ino, st.st_mtime, st.st_size)
+
+
+def _cached_packages(path, parse):
+    """
+    Returns the packages of the database file at `path`, parsed with
+    `parse(path)` unless a file with the same (inode, mtime, size) was
+    parsed already.
+    """
+    key = (parse.__name__,) + _file_identity(path)
+    with _package_databases_lock:
+        packages = _package_databases.pop(key, None)
+        if packages is not None:
+            _package_databases[key] = packages
+            return packages
+    packages = list(parse(path))
+    with _package_databases_lock:
+        _package_databases[key] = packages
+        while len(_package_databases) > _MAX_PACKAGE_DATABASES:
+            _package_databases.popitem(last=False)
+    return packages
+
+
+def parse_dpkg_status(fp):
+    """
+    Parses a dpkg status file, and yields (name, version, architecture,
+    installed size) for every package in it, as dpkg-query -W does. The
+    file is read one line at a time.
+    """
+    fields = {}
+    for line in itertools.chain(fp, ['\n']):
+        line = line.rstrip('\n')
+        if not line:
+            # The end of a package
+            if ('Package' in fields and
+                    fields.get('Status', '').split(' ')[-1] not in
+                    _DPKG_NOT_INSTALLED):
+                yield (fields['Package'], fields.get('Version', ''),
+                       fields.get('Architecture', ''),
+                       fields.get('Installed-Size', ''))
+            fields = {}
+        elif not line[0].isspace():
+            # Continuation lines (of the descriptions mostly) are skipped
+            (name, _, value) = line.partition(':')
+            fields[name] = value.strip()
+
+
+def _read_dpkg_status(path):
+    with open(path, 'rb') as fp:
+        for package in parse_dpkg_status(fp):
+            yield package
+
+
 def get_dpkg_packages(
         root_dir='/',
         dbpath='var/lib/dpkg',
@@ -27,24 +100,22 @@ def get_dpkg_packages(
 
     dbpath = os.path.join(root_dir, dbpath)
 
-    output = subprocess_run(['dpkg-query', '-W',
-                             '--admindir={0}'.format(dbpath),
-                             '-f=${Package}|${Version}'
-                             '|${Architecture}|${Installed-Size}\n'],
-                             shell=False)
-    dpkglist = output.strip('\n')
-    if dpkglist:
-        for dpkginfo in dpkglist.split('\n'):
-            (name, version, architecture, size) = dpkginfo.split(r'|')
+    packages = _cached_packages(os.path.join(dbpath, 'status'),
+                                _read_dpkg_status)
+    for (name, version, architecture, size) in packages:
 
-            # dpkg does not provide any installtime field
-            # feature_key = '{0}/{1}'.format(name, version) -->
-            # changed to below per Suriya's request
+        # dpkg does not provide any installtime field
+        # feature_key = '{0}/{1}'.format(name, version) -->
+        # changed to below per Suriya's request
 
-            feature_key = '{0}'.format(name, version)
-            yield (feature_key, PackageFeature(None, name,
-                                               size, version,
-                                               architecture))
+        feature_key = '{0}'.format(name, version)
+        yield (feature_key, PackageFeature(None, name,
+                                           size, version,
+                                           architecture))
+
+
+def _read_rpm_packages(path):
+    return rpmdb.read_packages(path)
 
 
 def get_rpm_packages(
@@ -63,12 +134,57 @@ def get_rpm_packages(
 
     # update for a different route
 
+    packages_file = rpmdb.find_packages_file(os.path.join(root_dir, dbpath))
+    if not packages_file and dbpath == 'var/lib/rpm':
+        # Where newer rpm versions keep it, /var/lib/rpm being a symlink
+        # relative to the root of the host
+        packages_file = rpmdb.find_packages_file(
+            os.path.join(root_dir, 'usr/lib/sysimage/rpm'))
     dbpath = os.path.join(root_dir, dbpath)
 
+    rpmlist = None
+    if packages_file:
+        try:
+            rpmlist = _cached_packages(packages_file, _read_rpm_packages)
+        except (IOError, OSError, ValueError, struct.error,
+                sqlite3.Error) as e:
+            logger.warning('Could not read the rpm database %s, querying '
+                           'rpm instead: %s' % (packages_file, e))
+
+    if rpmlist is None:
+        rpmlist = _query_rpm_packages(dbpath, reload_needed)
+
+    for (installtime, name, version, architecture, size) in rpmlist:
+        """
+        if int(installtime) <= installed_since: --> this
+        barfs for sth like: 1376416422. Consider try: xxx
+        except ValueError: pass
+        """
+
+        if installtime <= installed_since:
+            continue
+        """
+        feature_key = '{0}/{1}'.format(name, version) -->
+        changed to below per Suriya's request
+        """
+
+        feature_key = '{0}'.format(name, version)
+        yield (feature_key,
+               PackageFeature(installtime,
+                              name, size, version, architecture))
+
+
+def _query_rpm_packages(dbpath, reload_needed=False):
+    """
+    Returns the packages of the rpm database at `dbpath` as listed by rpm,
+    which needs a copy of the database (dumped and reloaded, with
+    `reload_needed`) if it was created by a different version of Berkeley
+    DB. Only used for the databases that can not be read directly.
+    """
     try:
         if reload_needed:
             reloaded_db_dir = tempfile.mkdtemp()
-            _rpm_reload_db(root_dir, dbpath, reloaded_db_dir)
+            _rpm_reload_db(dbpath=dbpath, reloaded_db_dir=reloaded_db_dir)
             dbpath = reloaded_db_dir
 
         output = subprocess_run(['rpm',
@@ -88,27 +204,8 @@ def get_rpm_packages(
             logger.debug('Deleting directory: %s' % (reloaded_db_dir))
             shutil.rmtree(reloaded_db_dir)
 
-    if rpmlist:
-        for rpminfo in rpmlist.split('\n'):
-            (installtime, name, version, architecture, size) = \
-                rpminfo.split(r'|')
-            """
-            if int(installtime) <= installed_since: --> this
-            barfs for sth like: 1376416422. Consider try: xxx
-            except ValueError: pass
-            """
-
-            if installtime <= installed_since:
-                continue
-            """
-            feature_key = '{0}/{1}'.format(name, version) -->
-            changed to below per Suriya's request
-            """
-
-            feature_key = '{0}'.format(name, version)
-            yield (feature_key,
-                   PackageFeature(installtime,
-                                  name, size, version, architecture))
+    return [rpminfo.split(r'|') for rpminfo in rpmlist.split('\n')
+            if rpminfo]
 
 
 def _rpm_reload_db(
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import re
+import fnmatch
+import threading
+
+
+class _Node(object):
+    __slots__ = ('literals', 'globs', 'anydepth', 'is_anydepth', 'terminal')
+
+    def __init__(self):
+        self.literals = {}
+        self.globs = []
+        # The node after a `**` component, which matches zero or more
+        # components.
+        self.anydepth = None
+        self.is_anydepth = False
+        self.terminal = False
+
+
+class PathMatcher(object):
+    """
+    Matches paths against a list of exclude patterns, compiled into a trie of
+    path components.
+
+    Patterns are relative to the root of the crawl (a leading '/' is
+    ignored). Each component is matched literally, or as a glob (see
+    `fnmatch`) if it has wildcards. Wildcards never match a '/', but a `**`
+    component matches any number of components, so `**/*.pyc` matches at any
+    depth. Whatever is under an excluded directory is excluded as well.
+
+    Walkers get the state of the root with `root_state()`, and then the state
+    of every entry from the state of its parent directory with `child()`.
+    Below the directories that can not match any pattern the state is None,
+    and there is nothing left to check.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.root = _Node()
+        for pattern in self.patterns:
+            self._add(pattern)
+
+    def _add(self, pattern):
+        parts = [part for part in pattern.split('/') if part not in ['', '.']]
+        # `a/**` is the same as `a`, as subtrees of matches are excluded
+        while parts and parts[-1] == '**':
+            parts.pop()
+        if not parts:
+            return
+        node = self.root
+        for part in parts:
+            if part == '**':
+                if not node.anydepth:
+                    node.anydepth = _Node()
+                    node.anydepth.is_anydepth = True
+                node = node.anydepth
+            elif re.search(r'[*?[]', part):
+                regex = fnmatch.translate(part)
+                for (_regex, compiled, child) in node.globs:
+                    if _regex == regex:
+                        break
+                else:
+                    child = _Node()
+                    node.globs.append((regex, re.compile(regex), child))
+                node = child
+            else:
+                node = node.literals.setdefault(part, _Node())
+        node.terminal = True
+
+    def _closure(self, nodes):
+        pending = list(nodes)
+        while pending:
+            node = pending.pop()
+            if node.anydepth and node.anydepth not in nodes:
+                nodes.add(node.anydepth)
+                pending.append(node.anydepth)
+        return nodes
+
+    def root_state(self):
+        state = self._closure(set([self.root]))
+        if len(state) == 1 and not (self.root.literals or self.root.globs):
+            return None
+        return frozenset(state)
+
+    def child(self, state, name):
+        """
+        Returns (excluded, state) for the entry `name` of a directory in
+        `state`.
+        """
+        if state is None:
+            return (False, None)
+        nodes = set()
+        for node in state:
+            child = node.literals.get(name)
+            if child:
+                nodes.add(child)
+            for (_, compiled, child) in node.globs:
+                if compiled.match(name):
+                    nodes.add(child)
+            if node.is_anydepth:
+                nodes.add(node)
+        if not nodes:
+            return (False, None)
+        nodes = self._closure(nodes)
+        if any(node.terminal for node in nodes):
+            return (True, None)
+        return (False, frozenset(nodes))
+
+    def is_excluded(self, relpath):
+        """
+        Returns True if `relpath` (relative to the root of the crawl), or any
+        of its parent directories, matches a pattern.
+        """
+        state = self.root_state()
+        for name in relpath.split('/'):
+            if state is None:
+                return False
+            if name in ['', '.']:
+                continue
+            (excluded, state) = self.child(state, name)
+            if excluded:
+                return True
+        return False
+
+
+# Compiled matchers, by list of patterns. The same options are used for
+# every container and every crawl interval.
+_path_matchers = {}
+_path_matchers_lock = threading.Lock()
+
+
+def get_path_matcher(patterns):
+    key = tuple(patterns)
+    with _path_matchers_lock:
+        matcher = _path_matchers.get(key)
+        if not matcher:
+            matcher = PathMatcher(patterns)
+            _path_matchers[key] = matcher
+        return matcher
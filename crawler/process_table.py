@@ -0,0 +1,341 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import pwd
+import time
+import logging
+import threading
+
+import psutil
+
+logger = logging.getLogger('crawlutils')
+
+# Groups of fields that are only read if some feature needs them
+FIELD_CWD = 'cwd'
+FIELD_OPEN_FILES = 'open_files'
+FIELD_IO = 'io'
+FIELD_PID_NAMESPACE = 'pid_namespace'
+OPTIONAL_FIELDS = [FIELD_CWD, FIELD_OPEN_FILES, FIELD_IO, FIELD_PID_NAMESPACE]
+
+# The states in /proc/<pid>/stat, as reported by psutil
+_STATUSES = {
+    'R': psutil.STATUS_RUNNING,
+    'S': psutil.STATUS_SLEEPING,
+    'D': psutil.STATUS_DISK_SLEEP,
+    'T': psutil.STATUS_STOPPED,
+    't': psutil.STATUS_TRACING_STOP,
+    'Z': psutil.STATUS_ZOMBIE,
+    'X': psutil.STATUS_DEAD,
+    'x': psutil.STATUS_DEAD,
+    'W': psutil.STATUS_WAKING,
+}
+
+_CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+class ProcessInfo(object):
+    """
+    What the process table knows about a process. The optional fields are
+    None until read.
+    """
+
+    __slots__ = ('pid', 'host_pid', 'ppid', 'name', 'cmdline', 'status',
+                 'create_time',
+                 'num_threads', 'uid', 'username', 'cpu_time', 'cpu_percent',
+                 'rss', 'vms', 'memory_percent', 'cwd', 'open_files',
+                 'read_bytes', 'write_bytes', 'pid_namespace')
+
+    def __init__(self, pid):
+        for field in self.__slots__:
+            setattr(self, field, None)
+        self.pid = pid
+        # The pid in the pid namespace of the crawler, which is not the same
+        # as `pid` for containers crawled from the host
+        self.host_pid = pid
+
+
+class ProcessTable(object):
+    """
+    Snapshot of all the processes in `proc_dir`. Every /proc/<pid> file is
+    read at most once, and only the optional fields asked for are read.
+
+    With `pids`, only those processes are read, and they are reported with
+    the pids of their own pid namespace (from NSpid in their status). This
+    is how the processes of a container are crawled from the host, without
+    entering its namespaces. The user names are then looked up in
+    `passwd_path`, the passwd file of the container.
+    """
+
+    def __init__(self, proc_dir='/proc', previous_cpu_times={}, pids=None,
+                 passwd_path=None):
+        self.proc_dir = proc_dir
+        self.timestamp = time.time()
+        self.fields = set()
+        self.processes = {}
+        # (pid, create_time) -> (cpu_time, timestamp), to calculate the CPU
+        # usage since the previous snapshot
+        self.cpu_times = {}
+        self._scan(previous_cpu_times, pids, passwd_path)
+
+    def _path(self, pid, name):
+        return os.path.join(self.proc_dir, str(pid), name)
+
+    def _read(self, pid, name):
+        with open(self._path(pid, name), 'rb') as fp:
+            return fp.read()
+
+    def _scan(self, previous_cpu_times, pids, passwd_path):
+        boot_time = _boot_time(self.proc_dir)
+        mem_total = _mem_total(self.proc_dir)
+        users = _read_passwd(passwd_path) if passwd_path else {}
+        translate = pids is not None
+        if pids is None:
+            pids = [int(name) for name in os.listdir(self.proc_dir)
+                    if name.isdigit()]
+        for pid in pids:
+            try:
+                proc = self._read_process(pid, boot_time, users, translate)
+            except (IOError, OSError):
+                # Gone since it was listed
+                continue
+            if not proc:
+                continue
+            key = (pid, proc.create_time)
+            self.cpu_times[key] = (proc.cpu_time, self.timestamp)
+            previous = previous_cpu_times.get(key)
+            proc.cpu_percent = 0.0
+            if previous and self.timestamp > previous[1]:
+                proc.cpu_percent = ((proc.cpu_time - previous[0]) /
+                                    (self.timestamp - previous[1]) * 100)
+            if mem_total:
+                proc.memory_percent = proc.rss * 100.0 / mem_total
+            self.processes[proc.pid] = proc
+
+        if translate:
+            # The parents outside of the pid namespace (of the init process
+            # of a container) are seen as pid 0, as in the container
+            pids = dict((proc.host_pid, proc.pid)
+                        for proc in self.processes.values())
+            for proc in self.processes.values():
+                proc.ppid = pids.get(proc.ppid, 0)
+
+    def _read_process(self, pid, boot_time, users, translate=False):
+        proc = ProcessInfo(pid)
+        stat = self._read(pid, 'stat')
+        # The name is between parenthesis, and can have spaces and
+        # parenthesis itself
+        proc.name = stat[stat.find('(') + 1:stat.rfind(')')]
+        fields = stat[stat.rfind(')') + 2:].split()
+        proc.status = _STATUSES.get(fields[0], fields[0])
+        proc.ppid = int(fields[1])
+        proc.cpu_time = (int(fields[11]) + int(fields[12])) / \
+            float(_CLOCK_TICKS)
+        proc.num_threads = int(fields[17])
+        proc.create_time = boot_time + int(fields[19]) / float(_CLOCK_TICKS)
+        proc.vms = int(fields[20])
+        proc.rss = int(fields[21]) * _PAGE_SIZE
+
+        proc.cmdline = [arg for arg in
+                        self._read(pid, 'cmdline').split('\0') if arg]
+        # The name is truncated to 15 characters, so take it from the
+        # command line if it is longer
+        if len(proc.name) >= 15 and proc.cmdline:
+            name = os.path.basename(proc.cmdline[0])
+            if name.startswith(proc.name):
+                proc.name = name
+
+        for line in self._read(pid, 'status').splitlines():
+            if line.startswith('Tgid:') and int(line.split()[1]) != pid:
+                # A thread, from the tasks of a cgroup
+                return None
+            elif line.startswith('Uid:'):
+                proc.uid = int(line.split()[1])
+            elif line.startswith('NSpid:') and translate:
+                proc.pid = int(line.split()[-1])
+        if proc.uid not in users:
+            users[proc.uid] = str(proc.uid)
+            # The users of the system running the crawler
+            if not translate:
+                try:
+                    users[proc.uid] = pwd.getpwuid(proc.uid).pw_name
+                except KeyError:
+                    pass
+        proc.username = users[proc.uid]
+        return proc
+
+    def ensure(self, fields):
+        """
+        Reads the optional `fields` of every process, if not read already.
+        """
+        for field in fields:
+            if field in self.fields:
+                continue
+            reader = getattr(self, '_read_' + field)
+            for proc in self.processes.values():
+                try:
+                    reader(proc)
+                except (IOError, OSError) as e:
+                    logger.debug('Could not read the %s of process %s: %s'
+                                 % (field, proc.pid, e))
+            self.fields.add(field)
+
+    def _read_cwd(self, proc):
+        proc.cwd = 'unknown'
+        if proc.status != psutil.STATUS_ZOMBIE:
+            proc.cwd = os.readlink(self._path(proc.host_pid, 'cwd'))
+
+    def _read_open_files(self, proc):
+        proc.open_files = []
+        fd_dir = self._path(proc.host_pid, 'fd')
+        # The paths are relative to the root of the process
+        root_dir = self._path(proc.host_pid, 'root')
+        for fd in os.listdir(fd_dir):
+            try:
+                path = os.readlink(os.path.join(fd_dir, fd))
+            except OSError:
+                continue
+            if (path.startswith('/') and
+                    os.path.isfile(os.path.join(root_dir, path[1:]))):
+                proc.open_files.append(path)
+        proc.open_files.sort()
+
+    def _read_io(self, proc):
+        for line in self._read(proc.host_pid, 'io').splitlines():
+            (name, _, value) = line.partition(':')
+            if name == 'read_bytes':
+                proc.read_bytes = int(value)
+            elif name == 'write_bytes':
+                proc.write_bytes = int(value)
+
+    def _read_pid_namespace(self, proc):
+        proc.pid_namespace = os.stat(
+            self._path(proc.host_pid, 'ns/pid')).st_ino
+
+    def __iter__(self):
+        return iter(sorted(self.processes.values(), key=lambda p: p.pid))
+
+
+def _boot_time(proc_dir):
+    with open(os.path.join(proc_dir, 'stat'), 'rb') as fp:
+        for line in fp:
+            if line.startswith('btime'):
+                return float(line.split()[1])
+    return 0.0
+
+
+def _read_passwd(path):
+    users = {}
+    try:
+        with open(path, 'rb') as fp:
+            for line in fp:
+                fields = line.split(':')
+                if len(fields) > 2 and fields[2].isdigit():
+                    users.setdefault(int(fields[2]), fields[0])
+    except IOError as e:
+        logger.debug('Could not read %s: %s' % (path, e))
+    return users
+
+
+def read_cgroup_pids(cgroup_dir):
+    """
+    Returns the pids of the processes in `cgroup_dir`, from its cgroup.procs,
+    or its tasks (which also has the threads) if there is no cgroup.procs.
+    """
+    for name in ['cgroup.procs', 'tasks']:
+        path = os.path.join(cgroup_dir, name)
+        if os.path.exists(path):
+            with open(path, 'rb') as fp:
+                return sorted(set(int(line) for line in fp if line.strip()))
+    raise IOError('No cgroup.procs or tasks in %s' % cgroup_dir)
+
+
+def list_namespace_pids(pid_namespace, proc_dir='/proc'):
+    """
+    Returns the pids of the processes in the pid namespace with inode
+    `pid_namespace`.
+    """
+    pids = []
+    for name in os.listdir(proc_dir):
+        if not name.isdigit():
+            continue
+        try:
+            if os.stat(os.path.join(proc_dir, name, 'ns/pid')).st_ino == \
+                    pid_namespace:
+                pids.append(int(name))
+        except OSError:
+            pass
+    return sorted(pids)
+
+
+def _mem_total(proc_dir):
+    try:
+        with open(os.path.join(proc_dir, 'meminfo'), 'rb') as fp:
+            for line in fp:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return 0
+
+
+# The last snapshot taken by this process, and the CPU times seen by it
+_process_table = None
+_process_table_key = None
+_process_table_lock = threading.Lock()
+
+
+def get_process_table(key=None, fields=[], proc_dir='/proc'):
+    """
+    Returns a snapshot of the processes with the optional `fields` read.
+
+    Snapshots with the same `key` (the crawl of a frame) are shared, so that
+    all the features of a frame use the same snapshot. A new snapshot is
+    taken every time if `key` is None.
+    """
+    global _process_table, _process_table_key
+    with _process_table_lock:
+        table = _process_table
+        if (key is None or table is None or _process_table_key != key or
+                table.proc_dir != proc_dir):
+            table = ProcessTable(proc_dir,
+                                 _process_table.cpu_times
+                                 if _process_table else {})
+            _process_table = table
+            _process_table_key = key
+        table.ensure(fields)
+        return table
+
+
+# The last snapshot of every container crawled from the host, by the pid
+# of the container, as (key, table)
+_container_tables = {}
+_container_tables_lock = threading.Lock()
+
+
+def get_container_process_table(container_pid, key, list_pids, fields=[],
+                                proc_dir='/proc'):
+    """
+    Returns a snapshot of the processes of the container with (host) pid
+    `container_pid`, taken from the host. `list_pids` is called to get the
+    host pids of the processes in the container when a new snapshot is
+    needed, which is when `key` changes.
+    """
+    with _container_tables_lock:
+        (table_key, table) = _container_tables.get(container_pid,
+                                                   (None, None))
+    if table is None or table_key != key:
+        table = ProcessTable(
+            proc_dir, table.cpu_times if table else {},
+            pids=list_pids(),
+            passwd_path=os.path.join(proc_dir, str(container_pid),
+                                     'root/etc/passwd'))
+        with _container_tables_lock:
+            _container_tables[container_pid] = (key, table)
+    table.ensure(fields)
+    return table
+
+
+def forget_container_process_table(container_pid):
+    with _container_tables_lock:
+        _container_tables.pop(container_pid, None)
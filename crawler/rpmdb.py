@@ -0,0 +1,223 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Reads the packages of an rpm database without rpm, straight from the header
+blobs in its Packages table: a Berkeley DB hash file (Packages), an sqlite
+database (rpmdb.sqlite) or an ndb file (Packages.db). The files are only
+read, and never copied or converted.
+"""
+import os
+import struct
+import logging
+import sqlite3
+
+logger = logging.getLogger('crawlutils')
+
+# The header tags of the package features
+RPMTAG_NAME = 1000
+RPMTAG_VERSION = 1001
+RPMTAG_RELEASE = 1002
+RPMTAG_INSTALLTIME = 1008
+RPMTAG_SIZE = 1009
+RPMTAG_ARCH = 1022
+RPMTAG_LONGSIZE = 5009
+_TAGS = set([RPMTAG_NAME, RPMTAG_VERSION, RPMTAG_RELEASE,
+             RPMTAG_INSTALLTIME, RPMTAG_SIZE, RPMTAG_ARCH, RPMTAG_LONGSIZE])
+
+# The header data types
+_INT16_TYPE = 3
+_INT32_TYPE = 4
+_INT64_TYPE = 5
+_STRING_TYPE = 6
+_STRING_ARRAY_TYPE = 8
+_I18NSTRING_TYPE = 9
+_INT_FORMATS = {_INT16_TYPE: '>H', _INT32_TYPE: '>I', _INT64_TYPE: '>Q'}
+
+# What rpm -q prints for the tags a package does not have
+_NONE = '(none)'
+
+# Berkeley DB hash files
+_BDB_HASH_MAGIC = 0x061561
+_BDB_PAGE_HEADER_SIZE = 26
+_BDB_HASH_PAGES = [2, 13]  # P_HASH_UNSORTED, P_HASH
+_BDB_KEYDATA = 1
+_BDB_OFFPAGE = 3
+
+# ndb files
+_NDB_HEADER_MAGIC = struct.unpack('<I', 'RpmP')[0]
+_NDB_SLOT_MAGIC = struct.unpack('<I', 'Slot')[0]
+_NDB_BLOB_MAGIC = struct.unpack('<I', 'BlbS')[0]
+_NDB_SLOTS_PER_PAGE = 4096 / 16
+_NDB_BLOCK_SIZE = 16
+
+
+def read_header(blob):
+    """
+    Returns the tags of the package features in the header `blob`, as a dict
+    of tag to value (a string or an integer).
+    """
+    (index_length, data_length) = struct.unpack('>II', blob[:8])
+    data_start = 8 + index_length * 16
+    if data_start + data_length > len(blob):
+        raise ValueError('Truncated rpm header')
+    tags = {}
+    for index in xrange(index_length):
+        (tag, data_type, offset, count) = struct.unpack(
+            '>iIiI', blob[8 + index * 16:8 + index * 16 + 16])
+        if tag not in _TAGS or offset < 0 or offset >= data_length:
+            continue
+        offset += data_start
+        if data_type in _INT_FORMATS and count:
+            tags[tag] = struct.unpack_from(_INT_FORMATS[data_type], blob,
+                                           offset)[0]
+        elif data_type in [_STRING_TYPE, _STRING_ARRAY_TYPE,
+                           _I18NSTRING_TYPE]:
+            # The first string, null terminated
+            tags[tag] = blob[offset:blob.index('\0', offset)]
+    return tags
+
+
+def read_bdb_blobs(path):
+    """
+    Yields the header blobs of a Berkeley DB hash Packages file, read one
+    page at a time.
+    """
+    with open(path, 'rb') as fp:
+        meta = fp.read(512)
+        for byte_order in ['<', '>']:
+            if struct.unpack_from(byte_order + 'I', meta, 12)[0] == \
+                    _BDB_HASH_MAGIC:
+                break
+        else:
+            raise ValueError('%s is not a Berkeley DB hash file' % path)
+        page_size = struct.unpack_from(byte_order + 'I', meta, 20)[0]
+        num_pages = os.fstat(fp.fileno()).st_size / page_size
+
+        def read_page(page_number):
+            fp.seek(page_number * page_size)
+            return fp.read(page_size)
+
+        def read_overflow(page_number, length):
+            # The data is in a chain of overflow pages
+            data = []
+            while page_number and length > 0:
+                page = read_page(page_number)
+                (next_page, _, used) = struct.unpack_from(
+                    byte_order + 'IHH', page, 16)
+                data.append(page[_BDB_PAGE_HEADER_SIZE:
+                                 _BDB_PAGE_HEADER_SIZE + used])
+                length -= used
+                page_number = next_page
+            return ''.join(data)
+
+        for page_number in xrange(1, num_pages):
+            page = read_page(page_number)
+            if len(page) < page_size or \
+                    ord(page[25]) not in _BDB_HASH_PAGES:
+                continue
+            entries = struct.unpack_from(byte_order + 'H', page, 20)[0]
+            offsets = struct.unpack_from(byte_order + '%dH' % entries, page,
+                                         _BDB_PAGE_HEADER_SIZE)
+            # The items are stored from the end of the page backwards, so
+            # every item ends where the one before starts
+            ends = (page_size,) + offsets[:-1]
+            for index in xrange(0, entries - 1, 2):
+                (key_offset, data_offset) = offsets[index:index + 2]
+                key = page[key_offset:ends[index]]
+                if len(key) != 5 or ord(key[0]) != _BDB_KEYDATA or \
+                        not struct.unpack(byte_order + 'I', key[1:])[0]:
+                    # Not a package, like the record 0 with the number of
+                    # the next one
+                    continue
+                data_type = ord(page[data_offset])
+                if data_type == _BDB_KEYDATA:
+                    yield page[data_offset + 1:ends[index + 1]]
+                elif data_type == _BDB_OFFPAGE:
+                    (overflow_page, length) = struct.unpack_from(
+                        byte_order + 'II', page, data_offset + 4)
+                    yield read_overflow(overflow_page, length)
+
+
+def read_sqlite_blobs(path):
+    """
+    Yields the header blobs of an rpmdb.sqlite database.
+    """
+    connection = sqlite3.connect(path)
+    try:
+        for (blob,) in connection.execute(
+                'SELECT blob FROM Packages ORDER BY hnum'):
+            yield str(blob)
+    finally:
+        connection.close()
+
+
+def read_ndb_blobs(path):
+    """
+    Yields the header blobs of an ndb Packages.db file.
+    """
+    with open(path, 'rb') as fp:
+        (magic, version, _, num_slot_pages) = struct.unpack(
+            '<IIII', fp.read(16))
+        if magic != _NDB_HEADER_MAGIC or version != 0:
+            raise ValueError('%s is not an ndb file' % path)
+        # The header takes the first 2 slots
+        fp.seek(32)
+        num_slots = num_slot_pages * _NDB_SLOTS_PER_PAGE - 2
+        slots = fp.read(num_slots * 16)
+        for index in xrange(len(slots) / 16):
+            (magic, package, block, _) = struct.unpack_from('<IIII', slots,
+                                                            index * 16)
+            if magic != _NDB_SLOT_MAGIC:
+                raise ValueError('Bad slot in ndb file %s' % path)
+            if not package:
+                # Free
+                continue
+            fp.seek(block * _NDB_BLOCK_SIZE)
+            (magic, blob_package, _, length) = struct.unpack(
+                '<IIII', fp.read(16))
+            if magic != _NDB_BLOB_MAGIC or blob_package != package:
+                raise ValueError('Bad blob %d in ndb file %s'
+                                 % (package, path))
+            yield fp.read(length)
+
+
+# The files of the rpm database backends, in the order rpm looks for them,
+# and how to read them
+_BACKENDS = [('rpmdb.sqlite', read_sqlite_blobs),
+             ('Packages.db', read_ndb_blobs),
+             ('Packages', read_bdb_blobs)]
+
+
+def find_packages_file(dbpath):
+    """
+    Returns the path of the Packages file of the rpm database at `dbpath`,
+    or None if there is none.
+    """
+    for (name, _) in _BACKENDS:
+        path = os.path.join(dbpath, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def read_packages(path):
+    """
+    Yields (installtime, name, version-release, arch, size) for every package
+    in the Packages file at `path`, as strings printed by rpm -qa.
+    """
+    read_blobs = dict(_BACKENDS)[os.path.basename(path)]
+    for blob in read_blobs(path):
+        try:
+            tags = read_header(blob)
+        except (ValueError, struct.error) as e:
+            logger.warning('Skipping a bad header in %s: %s' % (path, e))
+            continue
+        if RPMTAG_NAME not in tags:
+            continue
+        size = tags.get(RPMTAG_SIZE, tags.get(RPMTAG_LONGSIZE, _NONE))
+        yield (str(tags.get(RPMTAG_INSTALLTIME, _NONE)),
+               tags[RPMTAG_NAME],
+               '%s-%s' % (tags.get(RPMTAG_VERSION, _NONE),
+                          tags.get(RPMTAG_RELEASE, _NONE)),
+               tags.get(RPMTAG_ARCH, _NONE),
+               str(size))
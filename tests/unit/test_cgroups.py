@@ -0,0 +1,97 @@
+import mock
+import unittest
+import os
+import shutil
+import tempfile
+
+from crawler import cgroups
+from crawler.cgroups import CgroupMounts, ContainerCgroup
+
+MOUNTINFO = '''18 24 0:17 / /sys rw,nosuid shared:6 - sysfs sysfs rw
+25 18 0:21 / /sys/fs/cgroup ro,nosuid shared:9 - tmpfs tmpfs ro,mode=755
+26 25 0:22 / /sys/fs/cgroup/unified rw,nosuid shared:10 - cgroup2 cgroup2 rw,nsdelegate
+27 25 0:23 / /sys/fs/cgroup/systemd rw,nosuid shared:11 - cgroup cgroup rw,xattr,name=systemd
+30 25 0:26 / /sys/fs/cgroup/cpu,cpuacct rw,nosuid shared:14 - cgroup cgroup rw,cpu,cpuacct
+31 25 0:27 /docker /sys/fs/cgroup/memory rw,nosuid shared:15 - cgroup cgroup rw,memory
+32 25 0:28 / /sys/fs/cgroup/blkio rw,nosuid shared:16 - cgroup cgroup rw,blkio
+'''
+
+CGROUP_V1 = '''12:blkio:/docker/abc
+5:memory:/docker/abc
+4:cpu,cpuacct:/docker/abc
+1:name=systemd:/docker/abc
+0::/system.slice/docker.service
+'''
+
+CGROUP_V2 = '0::/system.slice/docker-abc.scope\n'
+
+
+class CgroupsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='crawlertest.')
+        self._write('mountinfo', MOUNTINFO)
+        self._write('proc/10/cgroup', CGROUP_V1)
+        self._write('proc/20/cgroup', CGROUP_V2)
+        self.mounts = CgroupMounts(os.path.join(self.tmp_dir, 'mountinfo'))
+        cgroups._container_cgroups.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        cgroups._container_cgroups.clear()
+
+    def _write(self, path, content):
+        path = os.path.join(self.tmp_dir, path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fp:
+            fp.write(content)
+
+    def _cgroup(self, pid):
+        return ContainerCgroup(pid, self.mounts,
+                               os.path.join(self.tmp_dir, 'proc'))
+
+    def test_mounts(self):
+        assert sorted(self.mounts.v1) == ['blkio', 'cpu', 'cpuacct', 'memory',
+                                          'name=systemd']
+        assert self.mounts.v1['cpuacct'] == ('/sys/fs/cgroup/cpu,cpuacct',
+                                             '/')
+        assert self.mounts.v2 == ('/sys/fs/cgroup/unified', '/')
+
+    def test_v1_paths(self):
+        cgroup = self._cgroup(10)
+        assert cgroup.version('memory') == 1
+        # The memory hierarchy is mounted from /docker
+        assert cgroup.get_path('memory', 'memory.stat') == \
+            '/sys/fs/cgroup/memory/abc/memory.stat'
+        assert cgroup.get_path('cpuacct', 'cpuacct.usage') == \
+            '/sys/fs/cgroup/cpu,cpuacct/docker/abc/cpuacct.usage'
+        # Not in a v1 hierarchy, so in the unified one
+        assert cgroup.version('pids') == 2
+        assert cgroup.get_path('pids') == \
+            '/sys/fs/cgroup/unified/system.slice/docker.service'
+
+    def test_v2_paths(self):
+        cgroup = self._cgroup(20)
+        assert cgroup.version('memory') == 2
+        assert cgroup.get_path('memory', 'memory.current') == \
+            '/sys/fs/cgroup/unified/system.slice/docker-abc.scope/' \
+            'memory.current'
+
+    def test_not_mounted(self):
+        self._write('mountinfo', MOUNTINFO.splitlines()[0] + '\n')
+        self.mounts = CgroupMounts(os.path.join(self.tmp_dir, 'mountinfo'))
+        cgroup = self._cgroup(10)
+        assert cgroup.version('memory') is None
+        with self.assertRaises(IOError):
+            cgroup.get_path('memory', 'memory.stat')
+
+    @mock.patch('crawler.cgroups.get_cgroup_mounts')
+    @mock.patch('crawler.cgroups.ContainerCgroup')
+    def test_get_container_cgroup(self, mocked_cgroup, mocked_mounts):
+        cgroup = cgroups.get_container_cgroup(10)
+        assert cgroups.get_container_cgroup('10') is cgroup
+        assert mocked_cgroup.call_count == 1
+        cgroups.forget_container_cgroup(10)
+        cgroups.get_container_cgroup(10)
+        assert mocked_cgroup.call_count == 2
@@ -0,0 +1,68 @@
+import unittest
+import os
+import hashlib
+import shutil
+import tempfile
+
+from crawler import config_cache
+from crawler.config_cache import ConfigCache
+
+
+class ConfigCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='crawlertest.')
+        self.path = os.path.join(self.tempdir, 'file')
+        self._write('content')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _write(self, content, mtime=1000):
+        with open(self.path, 'w') as fp:
+            fp.write(content)
+        os.utime(self.path, (mtime, mtime))
+
+    def test_read(self):
+        cache = ConfigCache()
+        sha256 = hashlib.sha256('content').hexdigest()
+        assert cache.read(self.path) == (u'content', sha256, True)
+        assert cache.read(self.path) == (u'content', sha256, False)
+
+        # Same metadata, so not read again
+        self._write('CONTENT')
+        assert cache.read(self.path) == (u'content', sha256, False)
+
+        self._write('CONTENT', mtime=2000)
+        assert cache.read(self.path) == (
+            u'CONTENT', hashlib.sha256('CONTENT').hexdigest(), True)
+
+        # Read again, but with the same content
+        self._write('CONTENT', mtime=3000)
+        assert cache.read(self.path)[2] is False
+
+    def test_read_empty(self):
+        cache = ConfigCache()
+        self._write('')
+        assert cache.read(self.path)[2] is True
+        assert cache.read(self.path)[2] is False
+        self._write('new', mtime=1000)
+        assert cache.read(self.path)[0] == u'new'
+
+    def test_read_missing(self):
+        cache = ConfigCache()
+        with self.assertRaises(OSError):
+            cache.read(os.path.join(self.tempdir, 'missing'))
+
+    def test_retain(self):
+        cache = ConfigCache()
+        cache.read(self.path)
+        cache.retain([])
+        assert cache.files == {}
+
+    def test_get_config_cache(self):
+        cache = config_cache.get_config_cache('abc')
+        assert config_cache.get_config_cache('abc') is cache
+        config_cache.delete_config_cache('abc')
+        assert config_cache.get_config_cache('abc') is not cache
+        config_cache.delete_config_cache('abc')
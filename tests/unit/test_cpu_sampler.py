@@ -0,0 +1,52 @@
+import mock
+import unittest
+
+from crawler.cpu_sampler import sample_containers, CPU_KEY
+from crawler.delta_store import DeltaStore, container_owner
+
+
+class DummyContainer(object):
+
+    def __init__(self, long_id, pid):
+        self.long_id = long_id
+        self.pid = pid
+
+
+class CpuSamplerTests(unittest.TestCase):
+
+    @mock.patch('crawler.cpu_sampler.time.sleep')
+    def test_sample_containers(self, mock_sleep):
+        store = DeltaStore()
+        containers = [DummyContainer(str(i), i) for i in range(3)]
+        store.put(container_owner(containers[0]), CPU_KEY, ['1'])
+
+        def read_usage(container, per_cpu):
+            if container.pid == 2:
+                raise IOError('gone')
+            return ['%d' % container.pid]
+
+        assert sample_containers(containers, read_usage, 0.5, store) == 1
+        assert store.get(container_owner(containers[1]), CPU_KEY)[0] == ['1']
+        assert store.get(container_owner(containers[2]), CPU_KEY) == \
+            (None, None)
+        mock_sleep.assert_called_once_with(0.5)
+
+        # Nothing new to sample, so no sleeping
+        mock_sleep.reset_mock()
+        assert sample_containers(containers[:2], read_usage,
+                                 store=store) == 0
+        assert not mock_sleep.called
+
+    @mock.patch('crawler.cpu_sampler.time.sleep')
+    def test_sample_containers_per_cpu(self, mock_sleep):
+        store = DeltaStore()
+        containers = [DummyContainer('0', 0)]
+
+        def read_usage(container, per_cpu):
+            return ['1', '2'] if per_cpu else ['3']
+
+        assert sample_containers(containers, read_usage, store=store,
+                                 per_cpu=True) == 1
+        # Diffed by the crawl against a reading of every CPU
+        assert store.get(container_owner(containers[0]), CPU_KEY)[0] == \
+            ['1', '2']
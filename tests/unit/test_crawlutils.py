@@ -0,0 +1,189 @@
+import mock
+import unittest
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import crawler.crawlutils
+from crawler.container import Container
+from crawler.crawlmodes import Modes
+from crawler.defaults import DEFAULT_CRAWL_OPTIONS
+
+
+class MockedSnapshotContainer(object):
+
+    def __init__(self, sleep_secs=0):
+        self.sleep_secs = sleep_secs
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.crawled = []
+        self.deadlines = []
+
+    def __call__(self, container=None, deadline=None, **kwargs):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.sleep_secs)
+        with self.lock:
+            self.running -= 1
+            self.crawled.append(container.pid)
+            self.deadlines.append(deadline)
+
+
+class CrawlutilsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ThreadPool(4)
+        self.options = dict(DEFAULT_CRAWL_OPTIONS)
+
+    def tearDown(self):
+        self.pool.terminate()
+
+    def test_crawl_container(self):
+        snapshot = MockedSnapshotContainer()
+        with mock.patch('crawler.crawlutils.snapshot_container', snapshot):
+            crawler.crawlutils._crawl_container(Container(1), 'os',
+                                                self.options)
+            self.options['container_crawl_deadline'] = 10
+            crawler.crawlutils._crawl_container(Container(2), 'os',
+                                                self.options)
+            crawler.crawlutils._crawl_container(Container(3), 'nofeatures',
+                                                self.options)
+        assert snapshot.crawled == ['1', '2']
+        assert snapshot.deadlines[0] is None
+        assert snapshot.deadlines[1] > time.time()
+
+    def test_crawl_containers_in_pool(self):
+        snapshot = MockedSnapshotContainer(0.2)
+        running = {}
+        containers = [Container(pid) for pid in range(8)]
+        with mock.patch('crawler.crawlutils.snapshot_container', snapshot):
+            crawler.crawlutils._crawl_containers_in_pool(
+                self.pool, running, containers, 'os', self.options)
+        assert sorted(snapshot.crawled) == sorted(c.pid for c in containers)
+        assert snapshot.max_running > 1
+        assert running == {}
+
+    def test_crawl_containers_in_pool_deadline(self):
+        snapshot = MockedSnapshotContainer(1)
+        running = {}
+        self.options['container_crawl_deadline'] = 0.2
+        with mock.patch('crawler.crawlutils.snapshot_container', snapshot):
+            start = time.time()
+            crawler.crawlutils._crawl_containers_in_pool(
+                self.pool, running, [Container(1)], 'os', self.options)
+            assert time.time() - start < 1
+            assert running.keys() == [Container(1).long_id]
+
+            # the container is not crawled again while still running
+            crawler.crawlutils._crawl_containers_in_pool(
+                self.pool, running, [Container(1)], 'os', self.options)
+            assert snapshot.running == 1
+            time.sleep(1)
+            crawler.crawlutils._crawl_containers_in_pool(
+                self.pool, running, [], 'os', self.options)
+        assert running == {}
+        assert snapshot.crawled == ['1']
+
+    def test_crawl_containers_in_pool_exception(self):
+        snapshot = mock.Mock(side_effect=OSError())
+        running = {}
+        with mock.patch('crawler.crawlutils.snapshot_container', snapshot):
+            with self.assertRaises(OSError):
+                crawler.crawlutils._crawl_containers_in_pool(
+                    self.pool, running, [Container(1)], 'os', self.options)
+
+    @mock.patch('crawler.crawlutils.delete_file_indexes')
+    @mock.patch('crawler.crawlutils.stop_namespace_workers')
+    @mock.patch('crawler.crawlutils.dockerutils.invalidate_docker_container')
+    def test_forget_container(self, mock_invalidate, mock_stop, *args):
+        crawler.crawlutils._forget_container(Container(1), self.options)
+        mock_stop.assert_called_once_with(Container(1).pid)
+        # Its cached inspect is dropped too
+        mock_invalidate.assert_called_once_with(Container(1).long_id)
+
+    @mock.patch('crawler.crawlutils.get_emit_queue_stats',
+                return_value={'http://a': {'depth': 2},
+                              'http://b': {'depth': 0}})
+    @mock.patch('crawler.crawlutils.drain_emit_queues', return_value=False)
+    def test_drain_emit_queues_timeout(self, mock_drain, *args):
+        self.options['emit_queue_drain_timeout'] = 5
+        with mock.patch('crawler.crawlutils.logger') as mock_logger:
+            crawler.crawlutils._drain_emit_queues(self.options)
+        mock_drain.assert_called_once_with(5)
+        # Only for the queues with frames left
+        assert mock_logger.warning.call_count == 1
+        assert 'http://a' in mock_logger.warning.call_args[0][0]
+
+    def test_forget_containers_still_running(self):
+        snapshot = MockedSnapshotContainer(1)
+        running = {}
+        self.options['container_crawl_deadline'] = 0.2
+        with mock.patch('crawler.crawlutils.snapshot_container', snapshot), \
+                mock.patch('crawler.crawlutils._forget_container') as forget:
+            crawler.crawlutils._crawl_containers_in_pool(
+                self.pool, running, [Container(1)], 'os', self.options)
+            # Gone while its crawl is past its deadline
+            forget_later = crawler.crawlutils._forget_containers(
+                [Container(1), Container(2)], running, self.options)
+            assert forget_later == [Container(1)]
+            assert [call[0][0] for call in forget.call_args_list] == \
+                [Container(2)]
+            time.sleep(1)
+            assert crawler.crawlutils._forget_containers(
+                forget_later, running, self.options) == []
+            assert [call[0][0] for call in forget.call_args_list] == \
+                [Container(2), Container(1)]
+        assert running == {}
+
+
+@mock.patch('crawler.crawlutils.plugins_manager.reload_env_plugin')
+@mock.patch('crawler.crawlutils.libc')
+@mock.patch('crawler.crawlutils.signal.signal')
+@mock.patch('crawler.crawlutils.get_filtered_list_of_containers',
+            return_value=[])
+@mock.patch('crawler.crawlutils.snapshot_mesos')
+@mock.patch('crawler.crawlutils.snapshot_generic')
+class SnapshotTests(unittest.TestCase):
+
+    def _snapshot(self, crawlmode, **options):
+        crawl_options = dict(DEFAULT_CRAWL_OPTIONS)
+        crawl_options.update(options)
+        crawler.crawlutils.snapshot(options=crawl_options, crawlmode=crawlmode,
+                                    frequency=-1)
+
+    def _test_modes(self, mock_generic, mock_mesos, mock_containers,
+                    **options):
+        for crawlmode in (Modes.INVM, Modes.MOUNTPOINT, Modes.DEVICE,
+                          Modes.FILE, Modes.ISCSI):
+            mock_generic.reset_mock()
+            self._snapshot(crawlmode, **options)
+            assert mock_generic.call_count == 1
+            assert mock_generic.call_args[1]['crawlmode'] == crawlmode
+        mock_generic.reset_mock()
+
+        self._snapshot(Modes.MESOS, **options)
+        assert mock_mesos.call_count == 1
+
+        self._snapshot(Modes.OUTCONTAINER, **options)
+        assert mock_containers.called
+        assert not mock_generic.called
+
+        with self.assertRaises(RuntimeError):
+            self._snapshot(Modes.OUTVM, **options)
+
+    def test_snapshot_modes(self, mock_generic, mock_mesos, mock_containers,
+                            *args):
+        self._test_modes(mock_generic, mock_mesos, mock_containers)
+
+    @mock.patch('crawler.crawlutils.get_frame_spool_stats', return_value={})
+    @mock.patch('crawler.crawlutils.get_emit_queue_stats', return_value={})
+    def test_snapshot_modes_stats(self, mock_queue_stats, mock_spool_stats,
+                                  mock_generic, mock_mesos, mock_containers,
+                                  *args):
+        self._test_modes(mock_generic, mock_mesos, mock_containers,
+                         emit_queue_size=10, spool_dir='/tmp/spool')
+        # Logged after every crawl, whatever the mode
+        assert mock_queue_stats.call_count == 7
+        assert mock_spool_stats.call_count == 7
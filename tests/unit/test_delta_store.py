@@ -0,0 +1,82 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from crawler import delta_store
+from crawler.delta_store import DeltaStore, container_owner
+
+
+class DummyContainer(object):
+
+    def __init__(self, long_id, pid):
+        self.long_id = long_id
+        self.pid = pid
+
+
+class DeltaStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='crawlertest.')
+        self.path = os.path.join(self.tmp_dir, 'delta', 'delta.0')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        delta_store._delta_store = None
+
+    def test_get_put(self):
+        store = DeltaStore()
+        owner = container_owner(DummyContainer('abc', 10))
+        assert owner == ('abc', '10')
+        assert store.get(owner, 'cpu') == (None, None)
+        store.put(owner, 'cpu', ['100'], 5.0)
+        assert store.get(owner, 'cpu') == (['100'], 5.0)
+        # Restarted, so the counters started again from 0
+        assert store.get(container_owner(DummyContainer('abc', 11)),
+                         'cpu') == (None, None)
+
+    def test_max_entries(self):
+        store = DeltaStore(max_entries=2)
+        store.put('a', 'k1', 1)
+        store.put('a', 'k2', 2)
+        # Updating k1 makes k2 the least recently put
+        store.put('a', 'k1', 3)
+        store.put('b', 'k1', 4)
+        assert len(store) == 2
+        assert store.get('a', 'k2') == (None, None)
+        assert store.get('a', 'k1')[0] == 3
+
+    def test_retain(self):
+        store = DeltaStore()
+        store.put('a', 'cpu', 1)
+        store.put('a', 'interface-eth0', 2)
+        store.put('b', 'cpu', 3)
+        store.retain(['b', 'c'])
+        assert store.get('a', 'cpu') == (None, None)
+        assert store.get('a', 'interface-eth0') == (None, None)
+        assert store.get('b', 'cpu')[0] == 3
+
+    def test_save_load(self):
+        store = DeltaStore(self.path)
+        store.put('a', 'k1', 1, 5.0)
+        store.put('a', 'k2', 2, 6.0)
+        store.save()
+        assert os.listdir(os.path.dirname(self.path)) == ['delta.0']
+        loaded = DeltaStore.load(self.path)
+        assert loaded.entries.items() == store.entries.items()
+        # Fewer entries allowed than saved
+        loaded = DeltaStore.load(self.path, max_entries=1)
+        assert loaded.entries.keys() == [('a', 'k2')]
+
+    def test_load_corrupt(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as fp:
+            fp.write('garbage')
+        assert len(DeltaStore.load(self.path)) == 0
+
+    def test_get_load_delta_store(self):
+        store = delta_store.get_delta_store()
+        assert delta_store.get_delta_store() is store
+        loaded = delta_store.load_delta_store(self.path)
+        assert loaded.path == self.path
+        assert delta_store.get_delta_store() is loaded
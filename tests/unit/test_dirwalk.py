@@ -0,0 +1,62 @@
+import mock
+import unittest
+import os
+import shutil
+import tempfile
+
+from crawler import dirwalk
+from crawler.path_matcher import PathMatcher
+
+
+class DirwalkTests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='crawlertest.')
+        for d in ['a/b/c', 'a/d', 'e', 'excluded/f']:
+            os.makedirs(os.path.join(self.root, d))
+        for f in ['file1', 'a/file2', 'a/b/c/file3', 'e/file4',
+                  'excluded/f/file5', 'a/excluded']:
+            open(os.path.join(self.root, f), 'w').close()
+        os.symlink(os.path.join(self.root, 'a'),
+                   os.path.join(self.root, 'e', 'link'))
+        self.matcher = PathMatcher(['**/excluded'])
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _walk(self, num_threads):
+        return list(dirwalk.walk(self.root, self.matcher, num_threads,
+                                 sort=True))
+
+    def test_walk_serial(self):
+        walk = self._walk(1)
+        assert [os.path.relpath(dirpath, self.root)
+                for (dirpath, _, _) in walk] == ['.', 'a', 'a/b', 'a/b/c',
+                                                 'a/d', 'e']
+        (dirpath, dirs, files) = walk[0]
+        assert dirs == [os.path.join(self.root, d) for d in ['a', 'e']]
+        assert files == [os.path.join(self.root, 'file1')]
+        (dirpath, dirs, files) = walk[-1]
+        assert dirs == [os.path.join(self.root, 'e', 'link')]
+        assert files == [os.path.join(self.root, 'e', 'file4')]
+
+    def test_walk_parallel(self):
+        assert self._walk(4) == self._walk(1)
+
+    @mock.patch('crawler.dirwalk.scandir', None)
+    def test_walk_parallel_no_scandir(self):
+        assert self._walk(4) == self._walk(1)
+
+    def test_walk_parallel_unsorted(self):
+        walk = list(dirwalk.walk(self.root, self.matcher, 4))
+        assert sorted(walk) == sorted(
+            list(dirwalk.walk(self.root, self.matcher, 1)))
+
+    def test_walk_parallel_missing_dir(self):
+        assert list(dirwalk.walk(os.path.join(self.root, 'missing'),
+                                 num_threads=4)) == []
+
+    def test_walk_parallel_abandoned(self):
+        walk = dirwalk.walk(self.root, num_threads=4)
+        next(walk)
+        walk.close()
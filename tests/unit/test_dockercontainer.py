@@ -6,7 +6,8 @@ import copy
 import shutil
 
 from crawler import crawler_exceptions
-from crawler.dockercontainer import DockerContainer, list_docker_containers
+from crawler.dockercontainer import (DockerContainer, list_docker_containers,
+                                     DockerContainerRegistry)
 
 def mocked_exists(pid):
     return True
@@ -294,16 +295,36 @@ class DockerDockerContainerTests(unittest.TestCase):
         assert c.is_docker_container()
         print(c)
 
+    @mock.patch('crawler.dockercontainer.get_container_cgroup', side_effect=IOError)
     @mock.patch('crawler.dockercontainer.os.path.ismount', side_effect=lambda x: True if x == '/cgroup/memory' else False)
-    def test_memory_cgroup(self, mocked_ismount, mock_get_rootfs, mock_inspect, mocked_get_runtime_env, mocked_dockerps):
+    def test_memory_cgroup(self, mocked_ismount, mocked_cgroup, mock_get_rootfs, mock_inspect, mocked_get_runtime_env, mocked_dockerps):
         c = DockerContainer("good_id")
         assert c.get_memory_cgroup_path('abc') == '/cgroup/memory/docker/good_id/abc'
 
+    @mock.patch('crawler.dockercontainer.get_container_cgroup', side_effect=IOError)
     @mock.patch('crawler.dockercontainer.os.path.ismount', side_effect=lambda x: True if x == '/cgroup/cpuacct' else False)
-    def test_cpu_cgroup(self, mocked_ismount, mock_get_rootfs, mock_inspect, mocked_get_runtime_env, mocked_dockerps):
+    def test_cpu_cgroup(self, mocked_ismount, mocked_cgroup, mock_get_rootfs, mock_inspect, mocked_get_runtime_env, mocked_dockerps):
         c = DockerContainer("good_id")
         assert c.get_cpu_cgroup_path('abc') == '/cgroup/cpuacct/docker/good_id/abc'
 
+    @mock.patch('crawler.dockercontainer.get_container_cgroup')
+    def test_resolved_cgroup(self, mocked_cgroup, mock_get_rootfs, mock_inspect, mocked_get_runtime_env, mocked_dockerps):
+        mocked_cgroup.return_value.version.return_value = 2
+        mocked_cgroup.return_value.get_path.side_effect = lambda controller, node: '/sys/fs/cgroup/system.slice/docker-good_id.scope/' + node
+        c = DockerContainer("good_id")
+        assert c.get_memory_cgroup_path('memory.current') == '/sys/fs/cgroup/system.slice/docker-good_id.scope/memory.current'
+        assert c.get_cgroup_version('memory') == 2
+        mocked_cgroup.assert_called_with(c.pid)
+
+    @mock.patch('crawler.dockercontainer.get_container_cgroup', side_effect=IOError)
+    @mock.patch('crawler.dockercontainer.get_cgroup_mounts')
+    @mock.patch('crawler.dockercontainer.os.path.ismount', side_effect=lambda x: False)
+    def test_cgroup_from_mounts(self, mocked_ismount, mocked_mounts, mocked_cgroup, mock_get_rootfs, mock_inspect, mocked_get_runtime_env, mocked_dockerps):
+        mocked_mounts.return_value.v1 = {'cpuacct': ('/mnt/cpu', '/')}
+        c = DockerContainer("good_id")
+        assert c.get_cpu_cgroup_path('abc') == '/mnt/cpu/docker/good_id/abc'
+        assert c.get_cgroup_version('cpuacct') == 1
+
     @mock.patch('crawler.dockercontainer.os.makedirs')
     @mock.patch('crawler.dockercontainer.os.symlink')
     def test_link_logfiles(self, mock_symlink, mock_makedirs, mock_get_rootfs, mock_inspect, mocked_get_runtime_env, mocked_dockerps):
@@ -441,8 +462,6 @@ class DockerDockerContainerTests(unittest.TestCase):
         c.unlink_logfiles()
         assert mock_symlink.call_count == 4
 
-    # TODO test _get_cgroup_dir when ismount fails
-
     def _test_non_implemented_methods(self):
         with self.assertRaises(NotImplementedError):
             c.get_memory_cgroup_path()
@@ -468,3 +487,116 @@ class DockerDockerContainerTests(unittest.TestCase):
     def _test_to_str(self):
         c = DockerContainer("good_id")
         print(c)
+
+
+@mock.patch('crawler.dockercontainer.plugins_manager.get_runtime_env_plugin',
+            side_effect=mocked_get_runtime_env)
+@mock.patch('crawler.dockercontainer.exec_dockerinspect',
+            side_effect=mocked_docker_inspect)
+@mock.patch('crawler.dockercontainer.get_docker_container_rootfs_path',
+            side_effect=mocked_get_rootfs)
+@mock.patch('crawler.dockercontainer.Container.is_running',
+            return_value=True)
+class DockerContainerRegistryTests(unittest.TestCase):
+
+    @mock.patch('crawler.dockercontainer.exec_docker_container_ids',
+                return_value=['good_id', 'no_namespace', 'other_id'])
+    def test_reconcile(self, mock_ids, *args):
+        registry = DockerContainerRegistry()
+        containers = registry.get_containers()
+        assert sorted(c.long_id for c in containers) == ['good_id',
+                                                         'other_id']
+        assert args[2].call_count == 3
+
+        # Only new containers are inspected
+        mock_ids.return_value = ['good_id', 'new_id']
+        registry.reconcile()
+        containers = registry.get_containers()
+        assert sorted(c.long_id for c in containers) == ['good_id', 'new_id']
+        assert args[2].call_count == 4
+        assert mock_ids.call_count == 2
+
+    @mock.patch('crawler.dockercontainer.exec_docker_container_ids',
+                return_value=['good_id'])
+    def test_reconcile_restarted(self, mock_ids, mock_is_running, *args):
+        registry = DockerContainerRegistry()
+        registry.get_containers()
+        mock_is_running.return_value = False
+        registry.reconcile()
+        assert args[1].call_count == 2
+
+    @mock.patch('crawler.dockercontainer.exec_docker_container_ids')
+    def test_reconcile_event_while_listing(self, mock_ids, *args):
+        registry = DockerContainerRegistry()
+        mock_ids.return_value = ['good_id']
+        registry.get_containers()
+
+        def mocked_ids():
+            # Started while the containers are listed
+            registry._handle_event({'status': 'start', 'id': 'new_id',
+                                    'time': 10})
+            return ['good_id']
+
+        mock_ids.side_effect = mocked_ids
+        registry.reconcile()
+        containers = registry.get_containers()
+        assert sorted(c.long_id for c in containers) == ['good_id', 'new_id']
+
+        # Gone at the next reconcile
+        mock_ids.side_effect = None
+        registry.reconcile()
+        containers = registry.get_containers()
+        assert [c.long_id for c in containers] == ['good_id']
+
+    @mock.patch('crawler.dockercontainer.exec_docker_container_ids',
+                return_value=['good_id'])
+    def test_events(self, mock_ids, *args):
+        registry = DockerContainerRegistry()
+        registry.get_containers()
+        registry._handle_event({'status': 'start', 'id': 'new_id',
+                                'time': 10})
+        registry._handle_event({'status': 'die', 'id': 'good_id',
+                                'time': 11})
+        registry._handle_event({'Type': 'image', 'status': 'start',
+                                'id': 'image_id', 'time': 12})
+        containers = registry.get_containers()
+        assert [c.long_id for c in containers] == ['new_id']
+        assert registry.last_event_time == 12
+        assert mock_ids.call_count == 1
+
+    @mock.patch('crawler.dockercontainer.invalidate_docker_image')
+    @mock.patch('crawler.dockercontainer.invalidate_docker_container')
+    def test_events_invalidate_cache(self, mock_invalidate_container,
+                                     mock_invalidate_image, *args):
+        registry = DockerContainerRegistry()
+        registry._handle_event({'status': 'exec_start', 'id': 'good_id',
+                                'time': 10})
+        registry._handle_event({'status': 'untag', 'id': 'image_id',
+                                'time': 11})
+        registry._handle_event({'Type': 'image', 'Action': 'delete',
+                                'id': 'image_id2', 'time': 12})
+        mock_invalidate_container.assert_called_once_with('good_id')
+        assert mock_invalidate_image.call_args_list == [
+            mock.call('image_id'), mock.call('image_id2')]
+
+    @mock.patch('crawler.dockercontainer.exec_docker_container_ids',
+                return_value=['good_id'])
+    @mock.patch('crawler.dockercontainer.time.sleep')
+    def test_listen(self, mock_sleep, mock_ids, *args):
+        registry = DockerContainerRegistry()
+        registry.get_containers()
+        events = [{'status': 'start', 'id': 'new_id', 'time': 10}]
+
+        def mocked_events(since=None):
+            for event in events:
+                yield event
+            raise crawler_exceptions.DockerutilsException()
+
+        mock_sleep.side_effect = lambda secs: registry.stop()
+        with mock.patch('crawler.dockercontainer.exec_docker_events',
+                        side_effect=mocked_events):
+            registry._listen()
+        assert registry.needs_reconcile
+        containers = registry.get_containers()
+        assert mock_ids.call_count == 2
+        assert [c.long_id for c in containers] == ['good_id']
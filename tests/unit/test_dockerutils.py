@@ -1,8 +1,10 @@
 import mock
+import threading
 import unittest
 import os
 
 import docker
+import requests
 import StringIO
 import dateutil.parser as dp
 
@@ -79,13 +81,150 @@ def throw_io_error(*args, **kwargs):
 def throw_docker_exception(*args, **kwargs):
     raise docker.errors.DockerException()
 
+class MockedClientNoConnection(MockedClient):
+
+    def containers(self):
+        raise requests.exceptions.ConnectionError()
+
 class DockerUtilsTests(unittest.TestCase):
 
     def setUp(self):
-        pass
+        dockerutils._client = None
+        dockerutils.inspect_cache = dockerutils.DockerCache(ttl=10)
+        dockerutils.image_cache = dockerutils.DockerCache()
 
     def tearDown(self):
-        pass
+        dockerutils._client = None
+
+    @mock.patch('crawler.dockerutils.docker.Client',
+                side_effect=lambda base_url, version: MockedClient())
+    def test_shared_client(self, mock_client):
+        dockerutils.exec_dockerinspect('ididid')
+        dockerutils.exec_docker_history('ididid')
+        dockerutils.exec_dockerps()
+        assert mock_client.call_count == 1
+
+    @mock.patch('crawler.dockerutils.docker.Client',
+                side_effect=lambda base_url, version: MockedClient())
+    def test_cache(self, mock_client):
+        client = MockedClient()
+        client.inspect_container = mock.Mock(
+            side_effect=MockedClient().inspect_container)
+        client.history = mock.Mock(side_effect=MockedClient().history)
+        mock_client.side_effect = lambda base_url, version: client
+
+        i = dockerutils.exec_dockerinspect('good_id')
+        i['Name'] = 'modified'
+        assert dockerutils.exec_dockerinspect('good_id')['Name'] == \
+            '/pensive_rosalind'
+        assert client.inspect_container.call_count == 1
+        assert dockerutils.inspect_cache.hits == 1
+
+        dockerutils.exec_docker_history('good_id')
+        dockerutils.exec_docker_history('good_id')
+        assert client.history.call_count == 1
+        assert client.inspect_container.call_count == 1
+
+        dockerutils.invalidate_docker_container('good_id')
+        dockerutils.exec_docker_history('good_id')
+        assert client.inspect_container.call_count == 2
+        assert client.history.call_count == 1
+
+        dockerutils.invalidate_docker_image(
+            'sha256:07c86167cdc4264926fa5d2894e34a339ad27')
+        dockerutils.exec_docker_history('good_id')
+        assert client.history.call_count == 2
+
+        stats = dockerutils.get_docker_cache_stats()
+        assert stats['inspect']['misses'] == 2
+        assert stats['image']['hits'] == 3
+
+    @mock.patch('crawler.dockerutils.docker.Client',
+                side_effect=lambda base_url, version: MockedClient())
+    @mock.patch('crawler.dockerutils.time.time')
+    def test_cache_ttl(self, mock_time, mock_client):
+        mock_time.return_value = 1000
+        dockerutils.exec_dockerinspect('good_id')
+        mock_time.return_value = 1000 + dockerutils.inspect_cache.ttl + 1
+        dockerutils.exec_dockerinspect('good_id')
+        assert dockerutils.inspect_cache.misses == 2
+        assert dockerutils.image_cache.misses == 1
+
+    @mock.patch('crawler.dockerutils.time.time')
+    def test_cache_eviction(self, mock_time):
+        cache = dockerutils.DockerCache(ttl=10)
+        mock_time.return_value = 1000
+        cache.get('a', lambda: 1)
+        mock_time.return_value = 1011
+        # The expired one is dropped when the next one is stored
+        cache.get('b', lambda: 2)
+        assert cache.entries.keys() == ['b']
+
+        cache = dockerutils.DockerCache(max_entries=2)
+        cache.get('a', lambda: 1)
+        cache.get('b', lambda: 2)
+        cache.get('a', lambda: 1)
+        cache.get('c', lambda: 3)
+        # The least recently used one is dropped
+        assert sorted(cache.entries.keys()) == ['a', 'c']
+        assert cache.get_stats() == {'hits': 1, 'misses': 3, 'entries': 2}
+
+    def test_cache_concurrent_fetch(self):
+        cache = dockerutils.DockerCache()
+        fetching = threading.Event()
+        unblocked = threading.Event()
+        fetches = []
+
+        def fetch():
+            fetches.append(1)
+            fetching.set()
+            unblocked.wait()
+            return 'value'
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(cache.get('a', fetch)))
+            for _ in xrange(4)]
+        threads[0].start()
+        fetching.wait()
+        for thread in threads[1:]:
+            thread.start()
+        unblocked.set()
+        for thread in threads:
+            thread.join(5)
+        # Fetched once, for all the threads
+        assert results == ['value'] * 4
+        assert len(fetches) == 1
+        stats = cache.get_stats()
+        assert stats['hits'] + stats['misses'] == 4
+        assert stats['misses'] == 1
+
+    def test_cache_fetch_error(self):
+        cache = dockerutils.DockerCache()
+
+        def fetch():
+            raise DockerutilsException()
+
+        with self.assertRaises(DockerutilsException):
+            cache.get('a', fetch)
+        # Not cached, and fetched again
+        assert cache.get('a', lambda: 1) == 1
+        assert cache.fetching == {}
+
+    @mock.patch('crawler.dockerutils.docker.Client')
+    def test_shared_client_reconnect(self, mock_client):
+        clients = [MockedClientNoConnection(), MockedClient()]
+        mock_client.side_effect = lambda base_url, version: clients.pop(0)
+        assert dockerutils.exec_docker_container_ids() == ['good_id']
+        assert mock_client.call_count == 2
+
+    @mock.patch('crawler.dockerutils.docker.Client',
+                side_effect=lambda base_url, version:
+                MockedClientNoConnection())
+    def test_shared_client_reconnect_failure(self, mock_client):
+        with self.assertRaises(DockerutilsException):
+            dockerutils.exec_docker_container_ids()
+        assert mock_client.call_count == 2
 
     @mock.patch('crawler.dockerutils.docker.Client',
                 side_effect=lambda base_url, version: MockedClient())
@@ -327,3 +466,47 @@ class DockerUtilsTests(unittest.TestCase):
         dockerutils.server_version = '1.10.0'
         with self.assertRaises(DockerutilsException):
             dockerutils.get_docker_container_rootfs_path('abcde')
+
+    @mock.patch('crawler.dockerutils.docker.Client',
+                side_effect=lambda base_url, version: MockedClient())
+    @mock.patch('crawler.dockerutils.os.path.isdir',
+                side_effect=lambda d: True)
+    def test_get_layers_overlay2(self, *args):
+        dockerutils.driver = 'overlay2'
+        dockerutils.server_version = '1.13.0'
+        inspect = MockedClient().inspect_container('id')
+        inspect['GraphDriver'] = {
+            'Name': 'overlay2',
+            'Data': {'MergedDir': '/var/lib/docker/overlay2/abc/merged',
+                     'UpperDir': '/var/lib/docker/overlay2/abc/diff'}}
+        assert dockerutils.get_docker_container_layers('id', inspect) == (
+            'sha256:07c86167cdc4264926fa5d2894e34a339ad27',
+            '/var/lib/docker/overlay2/abc/merged',
+            '/var/lib/docker/overlay2/abc/diff')
+        del inspect['GraphDriver']
+        with self.assertRaises(DockerutilsException):
+            dockerutils.get_docker_container_layers('id', inspect)
+
+    @mock.patch('crawler.dockerutils.docker.Client',
+                side_effect=lambda base_url, version: MockedClient())
+    @mock.patch('crawler.dockerutils.open',
+                side_effect=[open('tests/unit/aufs_mount_init-id')])
+    @mock.patch('crawler.dockerutils.os.path.isdir',
+                side_effect=lambda d: True)
+    def test_get_layers_aufs(self, *args):
+        dockerutils.driver = 'aufs'
+        dockerutils.server_version = '1.10.0'
+        assert dockerutils.get_docker_container_layers('abcde') == (
+            'sha256:07c86167cdc4264926fa5d2894e34a339ad27',
+            '/var/lib/docker/aufs/mnt/vol1/id/rootfs-a-b-c',
+            '/var/lib/docker/aufs/diff/vol1/id/rootfs-a-b-c')
+
+    @mock.patch('crawler.dockerutils.docker.Client',
+                side_effect=lambda base_url, version: MockedClient())
+    @mock.patch('crawler.dockerutils.open',
+                side_effect=[open('tests/unit/vfs_mount_init-id')])
+    def test_get_layers_not_supported_driver_failure(self, *args):
+        dockerutils.driver = 'vfs'
+        dockerutils.server_version = '1.10.0'
+        with self.assertRaises(DockerutilsException):
+            dockerutils.get_docker_container_layers('abcde')
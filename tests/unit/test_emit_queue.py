@@ -0,0 +1,169 @@
+import mock
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+
+from crawler import emit_queue
+from crawler.emit_queue import QueuedFrame, SinkQueue, get_emit_queue
+from crawler.emitter import Emitter
+
+
+class BlockedSink(object):
+    """
+    A sink that only publishes the frames once it is unblocked.
+    """
+
+    def __init__(self):
+        self.frames = []
+        self.unblocked = threading.Event()
+
+    def publish(self, url, frame):
+        self.unblocked.wait()
+        fp = frame.open()
+        self.frames.append(fp.read())
+        fp.close()
+
+
+def make_frame(data, num_sinks=1):
+    framefile = tempfile.SpooledTemporaryFile(max_size=1024)
+    framefile.write(data)
+    frame = QueuedFrame(framefile, num_sinks, len(data) > 1024)
+    framefile.close()
+    return frame
+
+
+class EmitQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='crawlertest.')
+        emit_queue._queues.clear()
+
+    def tearDown(self):
+        emit_queue._queues.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_queued_frame(self):
+        frame = make_frame('abc', num_sinks=2)
+        assert frame.open().read() == 'abc'
+        frame.spill()
+        path = frame.path
+        assert frame.data is None
+        assert frame.open().read() == 'abc'
+        frame.release()
+        assert os.path.exists(path)
+        frame.release()
+        assert not os.path.exists(path)
+
+        # Over max_size, already on disk
+        frame = make_frame('x' * 2048)
+        assert frame.path and frame.open().read() == 'x' * 2048
+        frame.release()
+
+    def _fill(self, policy, max_spilled=1):
+        sink = BlockedSink()
+        queue = SinkQueue('file://x', max_frames=2, policy=policy,
+                          max_spilled=max_spilled)
+        # The first one is taken by the thread right away
+        queue.put(sink.publish, make_frame('0'))
+        while queue.get_stats()['depth']:
+            pass
+        results = [queue.put(sink.publish, make_frame(str(index)))
+                   for index in xrange(1, 5)]
+        sink.unblocked.set()
+        assert queue.drain(5)
+        return (sink, queue, results)
+
+    def test_drop_newest(self):
+        (sink, queue, results) = self._fill('drop_newest')
+        assert results == [True, True, False, False]
+        assert sink.frames == ['0', '1', '2']
+        stats = queue.get_stats()
+        assert stats['dropped'] == 2
+        assert stats['published'] == 3
+        assert stats['max_depth'] == 2
+        assert stats['depth'] == 0
+
+    def test_drop_oldest(self):
+        (sink, queue, results) = self._fill('drop_oldest')
+        assert results == [True] * 4
+        assert sink.frames == ['0', '3', '4']
+        assert queue.get_stats()['dropped'] == 2
+
+    def test_spill(self):
+        (sink, queue, results) = self._fill('spill')
+        # 1 and 2 in memory, 3 spilled, and 4 spilled with 1 dropped
+        assert sink.frames == ['0', '2', '3', '4']
+        stats = queue.get_stats()
+        assert stats['spilled'] == 2
+        assert stats['dropped'] == 1
+
+    def test_block(self):
+        sink = BlockedSink()
+        queue = SinkQueue('file://x', max_frames=1, policy='block')
+        queue.put(sink.publish, make_frame('0'))
+        while queue.get_stats()['depth']:
+            pass
+        queue.put(sink.publish, make_frame('1'))
+        thread = threading.Thread(target=queue.put,
+                                  args=(sink.publish, make_frame('2')))
+        thread.start()
+        thread.join(0.1)
+        assert thread.is_alive()
+        sink.unblocked.set()
+        thread.join(5)
+        assert queue.drain(5)
+        assert sink.frames == ['0', '1', '2']
+
+    def test_failed(self):
+        def publish(url, frame):
+            raise IOError('unreachable')
+
+        queue = get_emit_queue('http://x', 10, 'drop_oldest')
+        assert get_emit_queue('http://x') is queue
+        queue.put(publish, make_frame('0'))
+        assert emit_queue.drain_emit_queues(5)
+        stats = emit_queue.get_emit_queue_stats()['http://x']
+        assert stats['failed'] == 1
+        assert stats['published'] == 0
+
+    def test_emitter_queued(self):
+        paths = [os.path.join(self.tmp_dir, 'frame%d' % index)
+                 for index in xrange(2)]
+        unblocked = threading.Event()
+        write_to_file = Emitter._write_to_file
+
+        def slow_write_to_file(emitter, url):
+            unblocked.wait()
+            write_to_file(emitter, url)
+
+        with mock.patch.object(Emitter, '_write_to_file',
+                               slow_write_to_file):
+            with Emitter(urls=['file://' + path for path in paths],
+                         emit_queue_size=2) as emitter:
+                emitter.emit('dummy', {'test': 'bla'}, 'dummy')
+            # Returns before the frame is written
+            assert not emit_queue.drain_emit_queues(0.05)
+            unblocked.set()
+            assert emit_queue.drain_emit_queues(5)
+        for path in paths:
+            with open(path) as fp:
+                assert fp.read().splitlines()[1] == \
+                    'dummy\t"dummy"\t{"test":"bla"}'
+        assert sorted(emit_queue.get_emit_queue_stats()) == \
+            ['file://' + path for path in paths]
+
+    def test_emitter_queued_on_disk(self):
+        path = os.path.join(self.tmp_dir, 'frame')
+        for (spill_size, on_disk) in [(10, True), (1024 * 1024, False)]:
+            with mock.patch('crawler.emitter.QueuedFrame',
+                            wraps=QueuedFrame) as mock_frame:
+                with Emitter(urls=['file://' + path], emit_queue_size=2,
+                             spill_size=spill_size) as emitter:
+                    emitter.emit('dummy', {'test': 'bla'}, 'dummy')
+                assert emit_queue.drain_emit_queues(5)
+            assert mock_frame.call_args[0][2] == on_disk
+            with open(path) as fp:
+                assert fp.read().splitlines()[1] == \
+                    'dummy\t"dummy"\t{"test":"bla"}'
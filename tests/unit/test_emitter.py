@@ -9,9 +9,14 @@ import shutil
 import subprocess
 import gzip
 import zlib
+import threading
+import json
+import cStringIO
 
 import crawler.crawler_exceptions
 from crawler.emitter import Emitter
+from crawler import http_sink
+from crawler.kafka_producer import get_kafka_producer, close_kafka_producers
 
 
 def mocked_requests_post(*args, **kwargs):
@@ -33,19 +38,21 @@ def mocked_requests_post(*args, **kwargs):
         raise requests.exceptions.ChunkedEncodingError('bla')
 
 
-def mocked_multiprocessing_process(name='', target='', args=''):
-    raise OSError
-
-
 class MockedKafkaClient1:
 
-    def __init__(self, kurl):
+    def __init__(self, kurl, timeout=120):
         print 'kafka_python init'
         pass
 
-    def ensure_topic_exists(self, topic):
+    def ensure_topic_exists(self, topic, timeout=30):
         return True
 
+    def close(self):
+        pass
+
+
+unblock_producers = threading.Event()
+
 
 class RandomKafkaException(Exception):
     pass
@@ -64,8 +71,8 @@ class MockProducer:
         else:
             raise RandomKafkaException('random kafka exception')
         if self.timeout:
-            while True:
-                a = 1
+            # Until the test is over
+            unblock_producers.wait()
 
 
 class MockTopic:
@@ -81,7 +88,7 @@ class MockTopic:
 
 class MockedKafkaClient2:
 
-    def __init__(self, hosts=[]):
+    def __init__(self, hosts=[], socket_timeout_ms=30000):
         print 'pykafka init'
         self.topics = {'topic1': MockTopic(good=True),
                        'badtopic': MockTopic(good=False),
@@ -105,10 +112,12 @@ class EmitterTests(unittest.TestCase):
     image_name = 'alpine:latest'
 
     def setUp(self):
-        pass
+        unblock_producers.clear()
+        close_kafka_producers()
 
     def tearDown(self):
-        pass
+        unblock_producers.set()
+        close_kafka_producers()
 
     def _test_emitter_csv_simple_stdout(self):
         with Emitter(urls=['stdout://']) as emitter:
@@ -151,6 +160,31 @@ class EmitterTests(unittest.TestCase):
             assert "dummy_feature" in output
             assert "metadata" in output
 
+    @mock.patch('crawler.emitter.tempfile.mkstemp',
+                side_effect=tempfile.mkstemp)
+    def test_emitter_frame_in_memory(self, mock_mkstemp):
+        tmp_dir = tempfile.mkdtemp(prefix='crawlertest.')
+        try:
+            url = 'file://%s/frame' % tmp_dir
+            with Emitter(urls=[url]) as emitter:
+                emitter.emit("dummy", {'test': 'bla'}, 'dummy')
+                assert not emitter.framefile._rolled
+            # Only the output file itself
+            assert os.listdir(tmp_dir) == ['frame']
+            assert mock_mkstemp.call_count == 1
+
+            with Capturing() as _output:
+                with Emitter(urls=[url, 'stdout://'],
+                             spill_size=100) as emitter:
+                    for i in range(10):
+                        emitter.emit("dummy", {'test': i}, 'dummy')
+                    assert emitter.framefile._rolled
+            assert len(_output) == 11
+            with open('%s/frame' % tmp_dir) as f:
+                assert f.read().splitlines() == _output
+        finally:
+            shutil.rmtree(tmp_dir)
+
     def test_emitter_all_features_compressed_csv(self):
         with Emitter(urls=['file:///tmp/test_emitter'],
                      emitter_args={'extra': '{"a":"1", "b":2}',
@@ -416,7 +450,7 @@ class EmitterTests(unittest.TestCase):
             assert float(_output[1].split(' ')[1]) == 12345.0
             assert float(_output[2].split(' ')[1]) == 12345.0
 
-    @mock.patch('crawler.emitter.requests.post',
+    @mock.patch('crawler.http_sink.requests.Session.post',
                 side_effect=mocked_requests_post)
     @mock.patch('crawler.emitter.time.sleep')
     def test_emitter_graphite_broker(self, mock_sleep, mock_post):
@@ -441,7 +475,7 @@ class EmitterTests(unittest.TestCase):
                          'dummy_feature')
         self.assertEqual(mock_post.call_count, 1)
 
-    @mock.patch('crawler.emitter.requests.post',
+    @mock.patch('crawler.http_sink.requests.Session.post',
                 side_effect=mocked_requests_post)
     @mock.patch('crawler.emitter.time.sleep')
     def test_emitter_graphite_broker_compress(self, mock_sleep, mock_post):
@@ -467,7 +501,7 @@ class EmitterTests(unittest.TestCase):
                          'dummy_feature')
         self.assertEqual(mock_post.call_count, 1)
 
-    @mock.patch('crawler.emitter.requests.post',
+    @mock.patch('crawler.http_sink.requests.Session.post',
                 side_effect=mocked_requests_post)
     @mock.patch('crawler.emitter.time.sleep')
     def test_emitter_graphite_broker_server_error(self, mock_sleep, mock_post):
@@ -492,7 +526,7 @@ class EmitterTests(unittest.TestCase):
                          'dummy_feature')
         self.assertEqual(mock_post.call_count, retries)
 
-    @mock.patch('crawler.emitter.requests.post',
+    @mock.patch('crawler.http_sink.requests.Session.post',
                 side_effect=mocked_requests_post)
     @mock.patch('crawler.emitter.time.sleep')
     def test_emitter_graphite_broker_request_exception(
@@ -518,7 +552,7 @@ class EmitterTests(unittest.TestCase):
                          'dummy_feature')
         self.assertEqual(mock_post.call_count, retries)
 
-    @mock.patch('crawler.emitter.requests.post',
+    @mock.patch('crawler.http_sink.requests.Session.post',
                 side_effect=mocked_requests_post)
     def test_emitter_graphite_broker_encoding_error(self, mock_post):
         metadata = {}
@@ -543,9 +577,9 @@ class EmitterTests(unittest.TestCase):
         # there are no retries for encoding errors
         self.assertEqual(mock_post.call_count, 1)
 
-    @mock.patch('crawler.emitter.pykafka.KafkaClient',
+    @mock.patch('crawler.kafka_producer.pykafka.KafkaClient',
                 side_effect=MockedKafkaClient2, autospec=True)
-    @mock.patch('crawler.emitter.kafka_python.KafkaClient',
+    @mock.patch('crawler.kafka_producer.kafka_python.KafkaClient',
                 side_effect=MockedKafkaClient1, autospec=True)
     def test_emitter_csv_kafka_invalid_url(
             self, MockKafkaClient1, MockKafkaClient2):
@@ -555,9 +589,9 @@ class EmitterTests(unittest.TestCase):
             with Emitter(urls=['kafka://abc'], max_emit_retries=1) as emitter:
                 emitter.emit("dummy_feature", {'test': 'bla'}, 'dummy_feature')
 
-    @mock.patch('crawler.emitter.pykafka.KafkaClient',
+    @mock.patch('crawler.kafka_producer.pykafka.KafkaClient',
                 side_effect=MockedKafkaClient2, autospec=True)
-    @mock.patch('crawler.emitter.kafka_python.KafkaClient',
+    @mock.patch('crawler.kafka_producer.kafka_python.KafkaClient',
                 side_effect=MockedKafkaClient1, autospec=True)
     @mock.patch('crawler.emitter.time.sleep')
     def test_emitter_csv_kafka(
@@ -578,9 +612,9 @@ class EmitterTests(unittest.TestCase):
         # will be 0 because it is called from another process. So, let's just
         # call the function and make sure no exception is thrown.
 
-    @mock.patch('crawler.emitter.pykafka.KafkaClient',
+    @mock.patch('crawler.kafka_producer.pykafka.KafkaClient',
                 side_effect=MockedKafkaClient2, autospec=True)
-    @mock.patch('crawler.emitter.kafka_python.KafkaClient',
+    @mock.patch('crawler.kafka_producer.kafka_python.KafkaClient',
                 side_effect=MockedKafkaClient1, autospec=True)
     @mock.patch('crawler.emitter.time.sleep')
     def test_emitter_graphite_kafka(
@@ -602,9 +636,9 @@ class EmitterTests(unittest.TestCase):
         # will be 0 because it is called from another process. So, let's just
         # call the function and make sure no exception is thrown.
 
-    @mock.patch('crawler.emitter.pykafka.KafkaClient',
+    @mock.patch('crawler.kafka_producer.pykafka.KafkaClient',
                 side_effect=MockedKafkaClient2, autospec=True)
-    @mock.patch('crawler.emitter.kafka_python.KafkaClient',
+    @mock.patch('crawler.kafka_producer.kafka_python.KafkaClient',
                 side_effect=MockedKafkaClient1, autospec=True)
     @mock.patch('crawler.emitter.time.sleep')
     def test_emitter_csv_kafka_failed_emit(self, mock_sleep, MockC1, MockC2):
@@ -622,9 +656,9 @@ class EmitterTests(unittest.TestCase):
                               'test4': 12345.00000},
                              'dummy_feature')
 
-    @mock.patch('crawler.emitter.pykafka.KafkaClient',
+    @mock.patch('crawler.kafka_producer.pykafka.KafkaClient',
                 side_effect=MockedKafkaClient2, autospec=True)
-    @mock.patch('crawler.emitter.kafka_python.KafkaClient',
+    @mock.patch('crawler.kafka_producer.kafka_python.KafkaClient',
                 side_effect=MockedKafkaClient1, autospec=True)
     @mock.patch('crawler.emitter.time.sleep')
     def test_emitter_csv_kafka_unsupported_format(
@@ -644,9 +678,9 @@ class EmitterTests(unittest.TestCase):
                               'test4': 12345.00000},
                              'dummy_feature')
 
-    @mock.patch('crawler.emitter.pykafka.KafkaClient',
+    @mock.patch('crawler.kafka_producer.pykafka.KafkaClient',
                 side_effect=MockedKafkaClient2, autospec=True)
-    @mock.patch('crawler.emitter.kafka_python.KafkaClient',
+    @mock.patch('crawler.kafka_producer.kafka_python.KafkaClient',
                 side_effect=MockedKafkaClient1, autospec=True)
     def test_emitter_csv_kafka_failed_emit_no_retries(self, MockC1, MockC2):
         metadata = {}
@@ -663,9 +697,9 @@ class EmitterTests(unittest.TestCase):
                               'test4': 12345.00000},
                              'dummy_feature')
 
-    @mock.patch('crawler.emitter.pykafka.KafkaClient',
+    @mock.patch('crawler.kafka_producer.pykafka.KafkaClient',
                 side_effect=MockedKafkaClient2, autospec=True)
-    @mock.patch('crawler.emitter.kafka_python.KafkaClient',
+    @mock.patch('crawler.kafka_producer.kafka_python.KafkaClient',
                 side_effect=MockedKafkaClient1, autospec=True)
     @mock.patch('crawler.emitter.time.sleep')
     def test_emitter_csv_kafka_emit_timeout(self, mock_sleep, MockC1, MockC2):
@@ -679,48 +713,76 @@ class EmitterTests(unittest.TestCase):
                          kafka_timeout_secs=0.1) as emitter:
                 emitter.emit("dummy", {'test': 'bla'}, 'dummy')
 
-    @mock.patch(
-        'crawler.emitter.multiprocessing.Process',
-        side_effect=mocked_multiprocessing_process,
-        autospec=True)
-    def test_emitter_csv_kafka_failed_new_process(self, mock_process):
-        metadata = {}
-        metadata['namespace'] = 'namespace777'
-        retries = 2
-        with self.assertRaises(OSError):
-            with Emitter(urls=['kafka://1.1.1.1:123/timeouttopic'],
-                         emitter_args=metadata,
-                         max_emit_retries=retries,
-                         kafka_timeout_secs=0.1) as emitter:
+    @mock.patch('crawler.kafka_producer.pykafka.KafkaClient',
+                side_effect=MockedKafkaClient2, autospec=True)
+    @mock.patch('crawler.kafka_producer.kafka_python.KafkaClient',
+                side_effect=MockedKafkaClient1, autospec=True)
+    def test_emitter_kafka_reuses_producer(self, MockC1, MockC2):
+        for format in ['csv', 'graphite', 'csv']:
+            with Emitter(urls=['kafka://1.1.1.1:123/topic1'],
+                         format=format) as emitter:
                 emitter.emit("dummy", {'test': 'bla'}, 'dummy')
+        self.assertEqual(MockC1.call_count, 1)
+        self.assertEqual(MockC2.call_count, 1)
+
+        # Connects again after a failure
+        for _ in xrange(2):
+            with self.assertRaises(RandomKafkaException):
+                with Emitter(urls=['kafka://1.1.1.1:123/badtopic'],
+                             max_emit_retries=0) as emitter:
+                    emitter.emit("dummy", {'test': 'bla'}, 'dummy')
+        self.assertEqual(MockC2.call_count, 3)
 
-    @mock.patch('crawler.emitter.pykafka.KafkaClient',
+    @mock.patch('crawler.kafka_producer.pykafka.KafkaClient',
                 side_effect=MockedKafkaClient2, autospec=True)
-    @mock.patch('crawler.emitter.kafka_python.KafkaClient',
+    @mock.patch('crawler.kafka_producer.kafka_python.KafkaClient',
                 side_effect=MockedKafkaClient1, autospec=True)
-    def test_emitter_kafka_send(self, MockC1, MockC2):
-        (temp_fd, path) = tempfile.mkstemp(prefix='emit.')
-        os.close(temp_fd)  # close temporary file descriptor
-        emitfile = open(path, 'wb')
-        tmp_message = 'a.b.c 1 1\r\n'
-        emitfile.write(tmp_message)
-        emitfile.write(tmp_message)
-        emitfile.close()
+    def test_emitter_kafka_timeout_new_producer(self, MockC1, MockC2):
+        producer = get_kafka_producer('1.1.1.1:123', 'timeouttopic')
+        with self.assertRaises(crawler.crawler_exceptions.EmitterEmitTimeout):
+            with Emitter(urls=['kafka://1.1.1.1:123/timeouttopic'],
+                         max_emit_retries=0,
+                         kafka_timeout_secs=0.1) as emitter:
+                emitter.emit("dummy", {'test': 'bla'}, 'dummy')
+        # The stuck producer is not used for the next frames
+        assert get_kafka_producer('1.1.1.1:123', 'timeouttopic') is not \
+            producer
 
-        try:
-            crawler.emitter.kafka_send('1.1.1.1', path, 'csv', 'topic1')
-            crawler.emitter.kafka_send('1.1.1.1', path, 'graphite', 'topic1')
-            with self.assertRaises(RandomKafkaException):
-                crawler.emitter.kafka_send('1.1.1.1', path, 'csv', 'badtopic')
-            with self.assertRaises(RandomKafkaException):
-                crawler.emitter.kafka_send(
-                    '1.1.1.1', path, 'graphite', 'badtopic')
-            with self.assertRaises(crawler.crawler_exceptions.EmitterUnsupportedFormat):
-                crawler.emitter.kafka_send('1.1.1.1', path, 'xxx', 'badtopic')
-        finally:
-            os.remove(path)
-        self.assertEqual(MockC1.call_count, 5)
-        self.assertEqual(MockC1.call_count, 5)
+    @mock.patch('crawler.http_sink.requests.Session.post',
+                side_effect=mocked_requests_post)
+    def test_emitter_http_batch(self, mock_post):
+        http_sink._batches.clear()
+        for format in ['json', 'csv']:
+            for namespace in ['namespace1', 'namespace2']:
+                with Emitter(urls=['http://1.1.1.1/good'],
+                             emitter_args={'namespace': namespace,
+                                           'compress': format == 'csv'},
+                             format=format,
+                             http_batch_bytes=1024 * 1024,
+                             http_batch_secs=60) as emitter:
+                    emitter.emit("dummy", {'test': 'bla'}, 'dummy')
+        self.assertEqual(mock_post.call_count, 0)
+        http_sink.flush_http_batches()
+        http_sink._batches.clear()
+        self.assertEqual(mock_post.call_count, 2)
+
+        # One request per format, for both frames
+        (csv_call, json_call) = sorted(
+            mock_post.call_args_list,
+            key=lambda call: call[1]['headers']['content-type'])
+        assert json_call[1]['headers'] == {
+            'content-type': 'application/x-ndjson'}
+        features = [json.loads(line) for line
+                    in json_call[1]['data'].splitlines()]
+        assert [f['namespace'] for f in features] == [
+            'namespace1', 'namespace1', 'namespace2', 'namespace2']
+        assert features[1]['test'] == 'bla'
+
+        assert csv_call[1]['headers']['content-encoding'] == 'gzip'
+        lines = gzip.GzipFile(
+            fileobj=cStringIO.StringIO(csv_call[1]['data'])).readlines()
+        assert [line.split('\t')[0] for line in lines] == [
+            'metadata', 'dummy', 'metadata', 'dummy']
 
     @mock.patch('crawler.emitter.MTGraphiteClient',
                 side_effect=MockedMTGraphiteClient, autospec=True)
@@ -775,7 +837,7 @@ class EmitterTests(unittest.TestCase):
     for 'json' format, the conversion happens for 'http' targets
     at send time. It still uses 'csv' format for temporary storage.
     '''
-    @mock.patch('crawler.emitter.requests.post',
+    @mock.patch('crawler.http_sink.requests.Session.post',
                 side_effect=mocked_requests_post)
     @mock.patch('crawler.emitter.time.sleep')
     def test_emitter_json_http_simple(self, mock_sleep, mock_post):
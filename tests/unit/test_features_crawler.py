@@ -5,13 +5,23 @@ import requests
 import copy
 import shutil
 import types
+import cPickle as pickle
+import tempfile
+import hashlib
 from collections import namedtuple
 
-from crawler.features_crawler import FeaturesCrawler
+from crawler.features_crawler import FeaturesCrawler, read_container_cpu_usage
+from crawler.cpu_sampler import sample_containers
+from crawler.file_index import FileIndex
+from crawler.path_matcher import get_path_matcher
+from crawler.config_cache import ConfigCache
+from crawler.process_table import ProcessInfo
+from crawler.net_connections import Connection as NetConnection
 from crawler.crawlmodes import Modes
 from crawler.features import (
     OSFeature,
     ConfigFeature,
+    ConfigHashFeature,
     DiskFeature,
     MetricFeature,
     PackageFeature,
@@ -22,6 +32,8 @@ from crawler.features import (
     DockerPSFeature)
 from crawler.container import Container
 from crawler.crawler_exceptions import CrawlError
+from crawler import image_layers
+from test_image_layers import make_container, IMAGE_FILES
 
 
 class DummyContainer(Container):
@@ -36,6 +48,22 @@ class DummyContainer(Container):
     def get_cpu_cgroup_path(self, node):
         return '/cgroup/%s' % node
 
+
+class DummyCgroupV2Container(DummyContainer):
+
+    def __init__(self, long_id, cgroup_dir):
+        DummyContainer.__init__(self, long_id)
+        self.cgroup_dir = cgroup_dir
+
+    def get_memory_cgroup_path(self, node):
+        return os.path.join(self.cgroup_dir, node)
+
+    def get_cpu_cgroup_path(self, node):
+        return os.path.join(self.cgroup_dir, node)
+
+    def get_cgroup_version(self, controller='memory'):
+        return 2
+
 # for OUTVM psvmi
 psvmi_sysinfo = namedtuple('psvmi_sysinfo',
                            '''boottime ipaddr osdistro osname osplatform osrelease
@@ -221,6 +249,27 @@ class Process():
     def get_memory_percent(self):
         return 30
 
+def mocked_process_table(key=None, fields=[]):
+    proc = ProcessInfo(123)
+    proc.name = 'init'
+    proc.cmdline = ['cmd']
+    proc.status = 'Running'
+    proc.create_time = 1000
+    proc.ppid = 1
+    proc.num_threads = 1
+    proc.username = 'don quijote'
+    proc.cpu_percent = 30.0
+    proc.memory_percent = 30.0
+    proc.rss = 10
+    proc.vms = 20
+    if 'cwd' in fields:
+        proc.cwd = '/bin'
+    if 'open_files' in fields:
+        proc.open_files = ['/a']
+    if 'io' in fields:
+        (proc.read_bytes, proc.write_bytes) = (10, 20)
+    return [proc]
+
 STAT_DIR_MODE = 16749
 
 
@@ -248,6 +297,24 @@ def mocked_run_as_another_namespace(pid, ns, function, *args, **kwargs):
     return result
 
 
+def crawl_layers(containers, long_id, crawl, **kwargs):
+    """
+    Runs `crawl` (the name of a crawl method) for the container `long_id`
+    of the `containers` written by `make_container()`, by long_id.
+    """
+    (upper_dir, rootfs_dir) = containers[long_id]
+    fc = FeaturesCrawler(crawl_mode=Modes.OUTCONTAINER,
+                         container=DummyContainer(long_id))
+    with mock.patch('crawler.features_crawler.dockerutils.'
+                    'get_docker_container_rootfs_path',
+                    side_effect=lambda long_id: rootfs_dir), \
+            mock.patch('crawler.features_crawler.dockerutils.'
+                       'get_docker_container_layers',
+                       side_effect=lambda long_id: ('image', rootfs_dir,
+                                                    upper_dir)):
+        return dict(getattr(fc, crawl)(avoid_setns=True, **kwargs))
+
+
 def throw_os_error(*args, **kvargs):
     raise OSError()
 
@@ -263,6 +330,13 @@ class FeaturesCrawlerTests(unittest.TestCase):
     def test_init(self, *args):
         fc = FeaturesCrawler()
 
+    def test_pickle(self, *args):
+        fc = FeaturesCrawler(crawl_mode=Modes.OUTCONTAINER,
+                             container=DummyContainer(123))
+        _crawl_files = pickle.loads(pickle.dumps(fc._crawl_files, 2))
+        assert _crawl_files.im_self.container.long_id == 123
+        assert _crawl_files.im_self.is_config_file == fc.is_config_file
+
     @mock.patch('crawler.features_crawler.time.time',
                 side_effect=lambda: 123)
     def test_cache(self, mocked_time, *args):
@@ -774,6 +848,138 @@ class FeaturesCrawlerTests(unittest.TestCase):
         assert args[2].call_count == 1  # isdir
         args[2].assert_called_with('/1/2/3')
 
+    def test_crawl_files_incremental_invm_mode(self, *args):
+        tempdir = tempfile.mkdtemp(prefix='crawlertest.')
+        try:
+            os.makedirs(os.path.join(tempdir, 'dir'))
+            open(os.path.join(tempdir, 'dir', 'file1'), 'w').close()
+            open(os.path.join(tempdir, 'file2'), 'w').close()
+            fc = FeaturesCrawler(crawl_mode=Modes.INVM)
+            index = FileIndex()
+            with mock.patch('crawler.features_crawler.get_file_index',
+                            side_effect=lambda path: index):
+                files = dict(fc.crawl_files(root_dir=tempdir,
+                                            root_dir_alias='/',
+                                            incremental=True))
+                assert sorted(files.keys()) == ['/', '/dir', '/dir/file1',
+                                                '/file2']
+                assert files['/dir/file1'].type == 'file'
+                assert list(fc.crawl_files(root_dir=tempdir,
+                                           root_dir_alias='/',
+                                           incremental=True)) == []
+                os.remove(os.path.join(tempdir, 'file2'))
+                files = dict(fc.crawl_files(root_dir=tempdir,
+                                            root_dir_alias='/',
+                                            incremental=True))
+                assert files['/file2'].type == 'deleted'
+                assert files['/file2'].name == 'file2'
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_crawl_files_layer_dedup(self):
+        tmp_dir = tempfile.mkdtemp(prefix='crawlertest.')
+        image_layers.forget_image_crawls()
+        try:
+            containers = {
+                'c1': make_container(tmp_dir, 'c1', {'etc/hosts': 'changed',
+                                                     'usr/lib/x': None}),
+                'c2': make_container(tmp_dir, 'c2', {
+                    'usr/bin/a': None, 'opt/d/.wh..wh..opq': '',
+                    'opt/d/f': 'f', 'app/g': 'g'})}
+            c1_files = crawl_layers(containers, 'c1', 'crawl_files',
+                                    exclude_dirs=['/var'], layer_dedup=True)
+            files = crawl_layers(containers, 'c2', 'crawl_files',
+                                 exclude_dirs=['/var'], layer_dedup=True)
+            expected = crawl_layers(containers, 'c2', 'crawl_files',
+                                    exclude_dirs=['/var'])
+            assert (sorted((k, f.type, f.size) for (k, f) in
+                           files.iteritems()) ==
+                    sorted((k, f.type, f.size) for (k, f) in
+                           expected.iteritems()))
+            assert '/usr/lib/x/y' in files and '/opt/d/f' in files
+            assert '/usr/bin/a' not in files and '/opt/d/e' not in files
+            # Not crawled again
+            assert files['/usr/lib/z'] is c1_files['/usr/lib/z']
+        finally:
+            shutil.rmtree(tmp_dir)
+            image_layers.forget_image_crawls()
+
+    def test_crawl_config_layer_dedup(self):
+        tmp_dir = tempfile.mkdtemp(prefix='crawlertest.')
+        image_layers.forget_image_crawls()
+        try:
+            containers = {
+                'c1': make_container(tmp_dir, 'c1', {'etc/hosts': 'changed'}),
+                'c2': make_container(tmp_dir, 'c2', {
+                    'etc/app.conf': None, 'opt/d/new.conf': 'b=2'})}
+            kwargs = {'known_config_files': ['etc/passwd', 'etc/hosts'],
+                      'discover_config_files': True}
+            crawl_layers(containers, 'c1', 'crawl_config_files',
+                         layer_dedup=True, **kwargs)
+            configs = crawl_layers(containers, 'c2', 'crawl_config_files',
+                                   layer_dedup=True, **kwargs)
+            assert configs == crawl_layers(containers, 'c2',
+                                           'crawl_config_files', **kwargs)
+            path = os.path.join(containers['c2'][1], 'etc/hosts')
+            assert configs[path] == ConfigFeature('hosts', 'localhost', path)
+        finally:
+            shutil.rmtree(tmp_dir)
+            image_layers.forget_image_crawls()
+
+    @mock.patch('crawler.features_crawler.get_dpkg_packages',
+                side_effect=lambda a, b, c: [('pkg1',
+                                              PackageFeature(None, 'pkg1',
+                                                             123, 'v1',
+                                                             'x86'))])
+    def test_crawl_packages_layer_dedup(self, mock_packages):
+        tmp_dir = tempfile.mkdtemp(prefix='crawlertest.')
+        image_layers.forget_image_crawls()
+        try:
+            image_files = dict(IMAGE_FILES)
+            image_files['var/lib/dpkg/status'] = ''
+            containers = dict(
+                (name, make_container(tmp_dir, name, changes, image_files))
+                for (name, changes) in [
+                    ('c1', {'etc/hosts': 'changed'}),
+                    ('c2', {'app/g': 'g'}),
+                    ('c3', {'var/lib/dpkg/status': 'installed'})])
+            for name in ['c1', 'c2']:
+                packages = crawl_layers(containers, name, 'crawl_packages',
+                                        layer_dedup=True)
+                assert packages.keys() == ['pkg1']
+                assert mock_packages.call_count == 1
+            crawl_layers(containers, 'c3', 'crawl_packages',
+                         layer_dedup=True)
+            assert mock_packages.call_count == 2
+            mock_packages.assert_called_with(containers['c3'][1],
+                                             'var/lib/dpkg', 0)
+        finally:
+            shutil.rmtree(tmp_dir)
+            image_layers.forget_image_crawls()
+
+    @mock.patch('crawler.features_crawler.run_as_another_namespace',
+                side_effect=mocked_run_as_another_namespace)
+    @mock.patch('crawler.features_crawler.os.path.isdir',
+                side_effect=lambda p: True)
+    @mock.patch('crawler.features_crawler.os.lstat',
+                side_effect=mocked_os_lstat)
+    @mock.patch('crawler.features_crawler.get_file_index')
+    def test_crawl_files_incremental_outcontainer_mode(self, mock_index,
+                                                       *args):
+        mock_index.return_value.walk.return_value = [
+            ('/proc/1234/root/a/file1', mocked_os_lstat('file1')),
+            ('/proc/1234/root/a/file2', None)]
+        fc = FeaturesCrawler(crawl_mode=Modes.OUTCONTAINER,
+                             container=DummyContainer(123))
+        files = list(fc.crawl_files(root_dir='/a', exclude_dirs=['/dir'],
+                                    incremental=True, index_dir='/index'))
+        assert [(k, f.type) for (k, f) in files] == [('/a/file1', 'file'),
+                                                     ('/a/file2', 'deleted')]
+        mock_index.return_value.walk.assert_called_with(
+            '/proc/1234/root/a', get_path_matcher(['/dir']))
+        assert mock_index.call_args[0][0].startswith('/index/123.')
+        assert args[2].call_count == 0
+
     @mock.patch('crawler.features_crawler.os.path.isdir',
                 side_effect=lambda p: True)
     @mock.patch('crawler.features_crawler.os.path.exists',
@@ -789,6 +995,45 @@ class FeaturesCrawlerTests(unittest.TestCase):
                                       path='/etc/file1')
         assert args[0].call_count == 1  # lstat
 
+    def test_crawl_config_invm_mode_cache(self):
+        tempdir = tempfile.mkdtemp(prefix='crawlertest.')
+        try:
+            os.makedirs(os.path.join(tempdir, 'etc'))
+            for name in ['file1', 'file2']:
+                with open(os.path.join(tempdir, 'etc', name), 'w') as fp:
+                    fp.write('content')
+            fc = FeaturesCrawler(crawl_mode=Modes.INVM)
+            cache = ConfigCache()
+
+            def crawl(mode):
+                return sorted(fc.crawl_config_files(
+                    root_dir=tempdir, root_dir_alias='',
+                    known_config_files=['etc/file1', 'etc/file2'],
+                    cache=mode))
+
+            with mock.patch('crawler.features_crawler.get_config_cache',
+                            side_effect=lambda owner: cache):
+                assert crawl('hash') == [
+                    ('/etc/file1', ConfigFeature('file1', 'content',
+                                                 '/etc/file1')),
+                    ('/etc/file2', ConfigFeature('file2', 'content',
+                                                 '/etc/file2'))]
+                with open(os.path.join(tempdir, 'etc', 'file2'), 'a') as fp:
+                    fp.write('2')
+                sha256 = hashlib.sha256('content').hexdigest()
+                assert crawl('hash') == [
+                    ('/etc/file1', ConfigHashFeature('file1', sha256,
+                                                     '/etc/file1')),
+                    ('/etc/file2', ConfigFeature('file2', 'content2',
+                                                 '/etc/file2'))]
+                assert crawl('content')[0] == (
+                    '/etc/file1', ConfigFeature('file1', 'content',
+                                                '/etc/file1'))
+                with self.assertRaises(ValueError):
+                    crawl('everything')
+        finally:
+            shutil.rmtree(tempdir)
+
     @mock.patch('crawler.features_crawler.os.path.isdir',
                 side_effect=lambda p: True)
     @mock.patch('crawler.features_crawler.os.walk', side_effect=lambda p: [
@@ -1055,6 +1300,90 @@ class FeaturesCrawlerTests(unittest.TestCase):
             assert f.write == 20
         assert args[0].call_count == 1
 
+    @mock.patch('crawler.features_crawler.get_process_table',
+                side_effect=mocked_process_table)
+    @mock.patch('crawler.features_crawler.run_as_another_namespace',
+                side_effect=mocked_run_as_another_namespace)
+    def test_crawl_processes_outcontainer_mode_process_table(self, *args):
+        fc = FeaturesCrawler(crawl_mode=Modes.OUTCONTAINER,
+                             container=DummyContainer(123),
+                             process_table=True)
+        [(k, f)] = list(fc.crawl_processes())
+        assert k == 'init/123'
+        assert f.cmd == 'cmd'
+        assert f.cwd == '/bin'
+        assert f.openfiles == ['/a']
+        assert f.user == 'don quijote'
+        [(k, f)] = list(fc.crawl_processes(skip_fields=['open_files',
+                                                        'cwd']))
+        assert (f.cwd, f.openfiles) == ('unknown', [])
+        args[1].assert_called_with(fc.frame_id, [])
+
+    @mock.patch('crawler.features_crawler.read_cgroup_pids',
+                side_effect=lambda cgroup_dir: [1234, 1240])
+    @mock.patch('crawler.features_crawler.get_container_process_table')
+    @mock.patch('crawler.features_crawler.run_as_another_namespace')
+    def test_crawl_processes_outcontainer_mode_avoidsetns(self, *args):
+        args[1].side_effect = (
+            lambda pid, key, list_pids, fields:
+            mocked_process_table(key, fields) if list_pids() else [])
+        fc = FeaturesCrawler(crawl_mode=Modes.OUTCONTAINER,
+                             container=DummyContainer(123))
+        [(k, f)] = list(fc.crawl_processes(avoid_setns=True))
+        assert k == 'init/123'
+        assert f.cwd == '/bin'
+        [(k, f)] = list(fc.crawl_metrics(avoid_setns=True))
+        assert f.read == 10
+        assert args[0].call_count == 0  # no setns
+        assert args[1].call_args[0][0] == '1234'
+        args[2].assert_called_with('/cgroup')
+
+    @mock.patch('crawler.features_crawler.get_process_table',
+                side_effect=mocked_process_table)
+    def test_crawl_metrics_invm_mode_process_table(self, *args):
+        fc = FeaturesCrawler(crawl_mode=Modes.INVM, process_table=True)
+        [(k, f)] = list(fc.crawl_metrics())
+        assert k == 'init/123'
+        assert f.cpupct == 30.0
+        assert f.mempct == 30.0
+        assert f.rss == 10
+        assert f.vms == 20
+        assert f.read == 10
+        assert f.write == 20
+        args[0].assert_called_with(fc.frame_id, ['io'])
+
+    @mock.patch('crawler.features_crawler.get_process_table',
+                side_effect=mocked_process_table)
+    @mock.patch('crawler.features_crawler.get_connections',
+                side_effect=lambda pids: [
+                    (123, NetConnection(1, ('1.1.1.1', 22), ('2.2.2.2', 22),
+                                        'ESTABLISHED')),
+                    (123, NetConnection(2, ('0.0.0.0', 80), (), 'LISTEN'))])
+    def test_crawl_connections_invm_mode_process_table(self, *args):
+        fc = FeaturesCrawler(crawl_mode=Modes.INVM, process_table=True)
+        [(k1, f1), (k2, f2)] = list(fc.crawl_connections())
+        assert k1 == '123/1.1.1.1/22'
+        assert f1.pname == 'init'
+        assert f1.remoteipaddr == '2.2.2.2'
+        assert f1.connstatus == 'ESTABLISHED'
+        assert (f2.remoteipaddr, f2.remoteport) == (None, None)
+        args[0].assert_called_with([123])
+
+    @mock.patch('crawler.features_crawler.get_container_process_table',
+                side_effect=lambda pid, key, list_pids, fields:
+                mocked_process_table(key, fields))
+    @mock.patch('crawler.features_crawler.get_connections',
+                side_effect=lambda pids: [
+                    (123, NetConnection(1, ('1.1.1.1', 22), ('2.2.2.2', 22),
+                                        'ESTABLISHED'))])
+    @mock.patch('crawler.features_crawler.run_as_another_namespace')
+    def test_crawl_connections_outcontainer_mode_avoidsetns(self, *args):
+        fc = FeaturesCrawler(crawl_mode=Modes.OUTCONTAINER,
+                             container=DummyContainer(123))
+        [(k, f)] = list(fc.crawl_connections(avoid_setns=True))
+        assert k == '123/1.1.1.1/22'
+        assert args[0].call_count == 0  # no setns
+
     @mock.patch('crawler.features_crawler.platform.system',
                 side_effect=lambda: 'linux')
     @mock.patch('crawler.features_crawler.platform.linux_distribution',
@@ -1371,6 +1700,98 @@ class FeaturesCrawlerTests(unittest.TestCase):
                 cpu_util=10.0)
         assert args[0].call_count == 3
 
+    @mock.patch('crawler.features_crawler.psutil.virtual_memory',
+                side_effect=lambda: psutils_memory(10, 10, 3, 10))
+    def test_crawl_memory_outcontainer_mode_cgroup_v2(self, *args):
+        tmp_dir = tempfile.mkdtemp(prefix='crawlertest.')
+        try:
+            for (node, content) in [
+                    ('memory.stat', 'anon 10\nfile 100\nactive_file 200\n'),
+                    ('memory.max', 'max\n'),
+                    ('memory.current', '2\n')]:
+                with open(os.path.join(tmp_dir, node), 'w') as fp:
+                    fp.write(content)
+            fc = FeaturesCrawler(
+                crawl_mode=Modes.OUTCONTAINER,
+                container=DummyCgroupV2Container("v2", tmp_dir))
+            assert list(fc.crawl_memory()) == [('memory', MemoryFeature(
+                memory_used=2,
+                memory_buffered=200,
+                memory_cached=100,
+                memory_free=10,
+                memory_util_percentage=2.0 / 12 * 100.0))]
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    @mock.patch(
+        'crawler.features_crawler.psutil.cpu_times_percent',
+        side_effect=lambda percpu: [
+            psutils_cpu(
+                10,
+                20,
+                30,
+                40,
+                50,
+                60,
+                70)])
+    def test_crawl_cpu_outcontainer_mode_cgroup_v2(self, *args):
+        tmp_dir = tempfile.mkdtemp(prefix='crawlertest.')
+        cpu_stat = os.path.join(tmp_dir, 'cpu.stat')
+
+        def write_cpu_stat(usage_usec):
+            with open(cpu_stat, 'w') as fp:
+                fp.write('usage_usec %d\nuser_usec 600\nsystem_usec 400\n'
+                         % usage_usec)
+
+        try:
+            write_cpu_stat(1000)
+            fc = FeaturesCrawler(
+                crawl_mode=Modes.OUTCONTAINER,
+                container=DummyCgroupV2Container("v2", tmp_dir))
+            # 10ms of CPU time used in the 100ms of sleep
+            with mock.patch('crawler.features_crawler.time.sleep',
+                            side_effect=lambda _: write_cpu_stat(11000)):
+                features = list(fc.crawl_cpu())
+            assert features == [('cpu-0', CpuFeature(
+                cpu_idle=90.0,
+                cpu_nice=20,
+                cpu_user=6.0,
+                cpu_wait=40,
+                cpu_system=4.0,
+                cpu_interrupt=60,
+                cpu_steal=70,
+                cpu_util=10.0))]
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    @mock.patch(
+        'crawler.features_crawler.psutil.cpu_times_percent',
+        side_effect=lambda percpu: [
+            psutils_cpu(
+                10,
+                20,
+                30,
+                40,
+                50,
+                60,
+                70)])
+    @mock.patch('crawler.features_crawler.time.sleep')
+    def test_crawl_cpu_outcontainer_mode_sampled(self, mock_sleep, *args):
+        tmp_dir = tempfile.mkdtemp(prefix='crawlertest.')
+        try:
+            with open(os.path.join(tmp_dir, 'cpu.stat'), 'w') as fp:
+                fp.write('usage_usec 1000\nuser_usec 1\nsystem_usec 1\n')
+            container = DummyCgroupV2Container('sampled', tmp_dir)
+            with mock.patch('crawler.cpu_sampler.time.sleep') as mock_sampler_sleep:
+                sample_containers([container], read_container_cpu_usage)
+            assert mock_sampler_sleep.call_count == 1
+            fc = FeaturesCrawler(crawl_mode=Modes.OUTCONTAINER,
+                                 container=container)
+            assert [k for (k, f) in fc.crawl_cpu()] == ['cpu-0']
+            assert not mock_sleep.called
+        finally:
+            shutil.rmtree(tmp_dir)
+
     @mock.patch(
         'crawler.features_crawler.psutil.cpu_times_percent',
         side_effect=lambda percpu: [
@@ -1459,6 +1880,23 @@ class FeaturesCrawlerTests(unittest.TestCase):
         assert args[0].call_count == 2
         assert args[1].call_count == 2
 
+    @mock.patch('crawler.features_crawler.run_as_another_namespace')
+    @mock.patch('crawler.features_crawler.get_interface_counters',
+                side_effect=[({'eth0': [10, 20, 30, 40, 50, 60]}, 100.0),
+                             ({'eth0': [20, 40, 60, 80, 100, 120]}, 110.0)])
+    def test_crawl_interface_outcontainer_mode_avoid_setns(self, *args):
+        container = DummyContainer('interfaces')
+        fc = FeaturesCrawler(crawl_mode=Modes.OUTCONTAINER,
+                             container=container)
+        assert list(fc.crawl_interface(avoid_setns=True)) == [
+            ('interface-eth0', InterfaceFeature(0, 0, 0, 0, 0, 0))]
+        fc = FeaturesCrawler(crawl_mode=Modes.OUTCONTAINER,
+                             container=container)
+        assert list(fc.crawl_interface(avoid_setns=True)) == [
+            ('interface-eth0', InterfaceFeature(1, 2, 3, 4, 5, 6))]
+        args[0].assert_called_with(container.pid)
+        assert not args[1].called
+
     @mock.patch('crawler.features_crawler.os.getloadavg',
                 side_effect=lambda : [1,2,3])
     def test_crawl_load_invm_mode(self, *args):
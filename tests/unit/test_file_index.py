@@ -0,0 +1,97 @@
+import mock
+import unittest
+import os
+import shutil
+import tempfile
+
+from crawler import file_index
+from crawler.file_index import FileIndex
+from crawler.path_matcher import PathMatcher
+
+
+class FileIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='crawlertest.')
+        self.root = os.path.join(self.tempdir, 'root')
+        self.index_dir = os.path.join(self.tempdir, 'index')
+        os.makedirs(os.path.join(self.root, 'etc', 'skipme'))
+        os.makedirs(os.path.join(self.root, 'usr', 'bin'))
+        for f in ['etc/passwd', 'etc/skipme/file', 'usr/bin/ls']:
+            with open(os.path.join(self.root, f), 'w') as fp:
+                fp.write('a')
+        file_index._file_indexes.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        file_index._file_indexes.clear()
+
+    def _walk(self, index):
+        matcher = PathMatcher(['etc/skipme'])
+        return sorted((os.path.relpath(path, self.root),
+                       lstat is not None)
+                      for (path, lstat) in index.walk(self.root, matcher))
+
+    def test_walk(self):
+        index = FileIndex()
+        assert self._walk(index) == [('.', True), ('etc', True),
+                                     ('etc/passwd', True), ('usr', True),
+                                     ('usr/bin', True),
+                                     ('usr/bin/ls', True)]
+        assert self._walk(index) == []
+
+    def test_walk_changes(self):
+        index = FileIndex()
+        self._walk(index)
+        with open(os.path.join(self.root, 'etc/passwd'), 'a') as fp:
+            fp.write('b')
+        os.remove(os.path.join(self.root, 'usr/bin/ls'))
+        os.mkdir(os.path.join(self.root, 'var'))
+        changes = self._walk(index)
+        assert ('etc/passwd', True) in changes
+        assert ('usr/bin/ls', False) in changes
+        assert ('var', True) in changes
+        assert ('etc/skipme/file', True) not in changes
+
+    @mock.patch('crawler.file_index.os.listdir', side_effect=os.listdir)
+    def test_walk_reuses_unchanged_dirs(self, mock_listdir):
+        index = FileIndex()
+        self._walk(index)
+        assert mock_listdir.call_count == 4
+
+        # Directories modified right before the walk are listed again
+        self._walk(index)
+        assert mock_listdir.call_count == 8
+
+        index.last_walk_time += 10
+        self._walk(index)
+        assert mock_listdir.call_count == 8
+
+    def test_walk_incomplete(self):
+        index = FileIndex()
+        walk = index.walk(self.root)
+        next(walk)
+        walk.close()
+        assert index.files == {}
+
+    def test_save_and_load(self):
+        path = file_index.get_file_index_path(self.index_dir, 'host',
+                                              self.root)
+        index = file_index.get_file_index(path)
+        self._walk(index)
+        assert os.path.exists(path)
+
+        file_index._file_indexes.clear()
+        index = file_index.get_file_index(path)
+        assert self._walk(index) == []
+
+        file_index.delete_file_indexes(self.index_dir, 'host')
+        assert not os.path.exists(path)
+        assert len(self._walk(file_index.get_file_index(path))) == 6
+
+    def test_load_corrupted(self):
+        path = os.path.join(self.tempdir, 'bad.idx')
+        with open(path, 'w') as fp:
+            fp.write('garbage')
+        index = FileIndex.load(path)
+        assert index.files == {}
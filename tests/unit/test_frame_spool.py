@@ -0,0 +1,180 @@
+import mock
+import unittest
+import os
+import shutil
+import tempfile
+import time
+
+from crawler import frame_spool
+from crawler.frame_spool import FrameSpool, get_frame_spool, spool_path
+from crawler.emitter import Emitter
+
+
+class Sink(object):
+
+    def __init__(self, up=True):
+        self.up = up
+        self.records = []
+
+    def send(self, header, body):
+        if not self.up:
+            raise IOError('sink is down')
+        self.records.append((header, body))
+
+
+class MockResponse(object):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = ''
+
+
+class FrameSpoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='crawlertest.')
+        self.path = os.path.join(self.tmp_dir, 'spool')
+        frame_spool._spools.clear()
+
+    def tearDown(self):
+        frame_spool._spools.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def _segments(self):
+        return sorted(name for name in os.listdir(self.path)
+                      if name.endswith('.seg'))
+
+    def test_submit_and_replay(self):
+        sink = Sink()
+        spool = FrameSpool(self.path, sink.send)
+        assert spool.submit({'n': 0}, 'frame 0')
+        assert not spool.pending()
+
+        sink.up = False
+        assert not spool.submit({'n': 1}, 'frame 1')
+        # Spooled behind the first one, even if the sink is back
+        sink.up = True
+        assert not spool.submit({'n': 2}, 'frame 2')
+        assert spool.pending()
+        assert sink.records == [({'n': 0}, 'frame 0')]
+
+        assert spool.replay() == 2
+        assert sink.records[1:] == [({'n': 1}, 'frame 1'),
+                                    ({'n': 2}, 'frame 2')]
+        assert not spool.pending()
+        assert self._segments() == []
+        assert spool.get_stats()['replayed'] == 2
+
+    def test_replay_stops_at_failure(self):
+        sink = Sink(up=False)
+        spool = FrameSpool(self.path, sink.send, segment_bytes=1)
+        for index in xrange(3):
+            spool.append({}, 'frame %d' % index)
+        assert len(self._segments()) == 3
+        assert spool.replay() == 0
+
+        sends = []
+
+        def send_one(header, body):
+            # Takes the first one only
+            if sends:
+                return False
+            sends.append(body)
+
+        # A new spool on the same directory, like after a restart
+        spool = FrameSpool(self.path, send_one)
+        assert spool.replay() == 1
+        assert sends == ['frame 0']
+        spool = FrameSpool(self.path, sink.send)
+        sink.up = True
+        assert spool.replay() == 2
+        assert [body for (_, body) in sink.records] == ['frame 1', 'frame 2']
+
+    def test_partial_record(self):
+        spool = FrameSpool(self.path, None, compress=False)
+        spool.append({}, 'frame 0')
+        spool.append({}, 'frame 1')
+        segment = os.path.join(self.path, self._segments()[0])
+        with open(segment, 'r+b') as fp:
+            fp.truncate(os.path.getsize(segment) - 3)
+        sink = Sink()
+        spool = FrameSpool(self.path, sink.send)
+        assert spool.replay() == 1
+        assert sink.records == [({}, 'frame 0')]
+
+    def test_corrupted_record(self):
+        spool = FrameSpool(self.path, None, compress=False)
+        for index in xrange(3):
+            spool.append({}, 'frame %d' % index)
+        spool.segment_bytes = 1
+        spool.append({}, 'frame 3')
+        assert len(self._segments()) == 2
+        # The body of the second record of the first segment
+        segment = os.path.join(self.path, self._segments()[0])
+        record_size = os.path.getsize(segment) / 3
+        with open(segment, 'r+b') as fp:
+            fp.seek(2 * record_size - 1)
+            fp.write('X')
+        sink = Sink()
+        spool.send = sink.send
+        assert spool.replay() == 3
+        assert [body for (_, body) in sink.records] == \
+            ['frame 0', 'frame 2', 'frame 3']
+        assert spool.get_stats()['dropped'] == 1
+        assert not spool.pending()
+
+    def test_caps(self):
+        spool = FrameSpool(self.path, None, segment_bytes=1,
+                           max_bytes=1024 * 1024, max_age_secs=60)
+        spool.append({}, 'frame 0')
+        old = os.path.join(self.path, self._segments()[0])
+        os.utime(old, (time.time() - 120, time.time() - 120))
+        spool.append({}, 'frame 1')
+        # The first one is too old
+        assert len(self._segments()) == 1
+
+        spool.max_bytes = 1
+        spool.append({}, 'x' * 100)
+        spool.append({}, 'y' * 100)
+        # The last segment is always kept
+        assert len(self._segments()) == 1
+        assert spool.get_stats()['dropped'] == 3
+        sink = Sink()
+        spool.send = sink.send
+        spool.replay()
+        assert sink.records == [({}, 'y' * 100)]
+
+    def test_replayer(self):
+        sink = Sink(up=False)
+        spool = get_frame_spool(self.tmp_dir, 'http://1.1.1.1/good',
+                                sink.send, replay_interval=0.01)
+        assert spool.path == spool_path(self.tmp_dir, 'http://1.1.1.1/good')
+        assert spool.path == os.path.join(self.tmp_dir, 'http___1.1.1.1_good')
+        spool.submit({}, 'frame 0')
+        sink.up = True
+        start = time.time()
+        while spool.pending() and time.time() - start < 5:
+            time.sleep(0.01)
+        assert sink.records == [({}, 'frame 0')]
+
+    @mock.patch('crawler.http_sink.requests.Session.post')
+    def test_emitter_spool(self, mock_post):
+        mock_post.return_value = MockResponse(500)
+        for index in xrange(2):
+            with Emitter(urls=['http://1.1.1.1/good'],
+                         emitter_args={'namespace': 'ns%d' % index},
+                         spool_dir=self.tmp_dir) as emitter:
+                emitter.emit('dummy', {'test': 'bla'}, 'dummy')
+        # Tried once, and then spooled behind the first one
+        self.assertEqual(mock_post.call_count, 1)
+
+        mock_post.return_value = MockResponse(200)
+        spool = get_frame_spool(self.tmp_dir, 'http://1.1.1.1/good', None)
+        assert spool.replay() == 2
+        self.assertEqual(mock_post.call_count, 3)
+        assert [call[1]['params'] for call
+                in mock_post.call_args_list[1:]] == [{'namespace': 'ns0'},
+                                                     {'namespace': 'ns1'}]
+        assert mock_post.call_args[1]['headers'] == {
+            'content-type': 'application/csv'}
+        assert 'metadata' in mock_post.call_args[1]['data']
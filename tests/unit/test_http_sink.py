@@ -0,0 +1,110 @@
+import mock
+import unittest
+import BaseHTTPServer
+import SocketServer
+import gzip
+import cStringIO
+import threading
+import time
+
+from crawler import http_sink
+from crawler.http_sink import HttpBatch, get_http_batch, http_post
+
+
+class RecordingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keeps the connections open
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['content-length']))
+        with self.server.lock:
+            self.server.requests.append((dict(self.headers), body))
+        self.send_response(200)
+        self.send_header('content-length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class RecordingServer(SocketServer.ThreadingMixIn,
+                      BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           RecordingHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/frames' % self.server_address[1]
+
+
+def gunzip(data):
+    return gzip.GzipFile(fileobj=cStringIO.StringIO(data)).read()
+
+
+class HttpSinkTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = RecordingServer()
+        http_sink._batches.clear()
+
+    def tearDown(self):
+        http_sink._batches.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_http_post_keeps_connection(self):
+        for index in xrange(3):
+            assert http_post(self.server.url, {}, 'frame %d' % index, 1)
+        assert [body for (_, body) in self.server.requests] == [
+            'frame 0', 'frame 1', 'frame 2']
+        assert self.server.connections == 1
+
+    def test_batch_size(self):
+        batch = HttpBatch(self.server.url, 'application/csv', compress=True,
+                          batch_bytes=10, batch_secs=60)
+        batch.add(['a\n', 'b\n'])
+        assert self.server.requests == []
+        batch.add(['cdef\n', 'g\n'])
+        batch.add(['h\n'])
+        assert len(self.server.requests) == 1
+        (headers, body) = self.server.requests[0]
+        assert headers['content-type'] == 'application/csv'
+        assert headers['content-encoding'] == 'gzip'
+        # Compressed once for all of them
+        assert gunzip(body) == 'a\nb\ncdef\ng\n'
+        assert batch.flush()
+        assert gunzip(self.server.requests[1][1]) == 'h\n'
+        # Nothing left to post
+        assert batch.flush()
+        assert len(self.server.requests) == 2
+
+    def test_batch_time(self):
+        batch = get_http_batch(self.server.url, 'application/x-ndjson',
+                               False, 1024, 0.1, 1)
+        assert get_http_batch(self.server.url, 'application/x-ndjson',
+                              False, 1024, 0.1, 1) is batch
+        batch.add(['{"a": 1}\n'])
+        start = time.time()
+        while not self.server.requests and time.time() - start < 5:
+            time.sleep(0.01)
+        assert self.server.requests[0][1] == '{"a": 1}\n'
+        assert batch.due_time() is None
+
+    @mock.patch('crawler.http_sink.time.sleep')
+    def test_batch_failed(self, mock_sleep):
+        batch = HttpBatch('http://127.0.0.1:1/frames', 'application/csv',
+                          batch_bytes=1024, max_retries=2)
+        batch.add(['a\n'])
+        assert not batch.flush()
+        assert mock_sleep.call_count == 2
@@ -0,0 +1,132 @@
+import mock
+import unittest
+import os
+import shutil
+import tempfile
+
+from crawler import image_layers
+from crawler.image_layers import (LayerChanges, read_layer_changes,
+                                  crawl_layered)
+
+IMAGE_FILES = {'etc/passwd': 'root', 'etc/hosts': 'localhost',
+               'etc/app.conf': 'a=1', 'usr/bin/a': 'a', 'usr/bin/b': 'b',
+               'usr/lib/x/y': 'y', 'usr/lib/z': 'z', 'usr/share/doc': 'doc',
+               'opt/d/e': 'e', 'opt/h': 'h', 'var/log/messages': ''}
+
+
+def _write(path, content):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as fp:
+        fp.write(content)
+
+
+def make_container(root_dir, name, changes, image_files=IMAGE_FILES):
+    """
+    Writes the writable layer of a container of the image with `image_files`
+    (path to content), with the aufs whiteouts of the `changes` (path to
+    content, or None to delete), and the union of both. Returns
+    (upper_dir, rootfs_dir).
+    """
+    upper_dir = os.path.join(root_dir, name, 'upper')
+    rootfs_dir = os.path.join(root_dir, name, 'rootfs')
+    os.makedirs(upper_dir)
+    files = dict(image_files)
+    for (path, content) in sorted(changes.iteritems()):
+        (dirname, basename) = os.path.split(path)
+        if basename == '.wh..wh..opq':
+            files = dict((p, c) for (p, c) in files.iteritems()
+                         if not image_layers.is_under(p, dirname))
+            _write(os.path.join(upper_dir, path), '')
+        elif content is None:
+            files = dict((p, c) for (p, c) in files.iteritems()
+                         if not image_layers.is_under(p, path))
+            _write(os.path.join(upper_dir, dirname, '.wh.' + basename), '')
+        else:
+            files[path] = content
+            _write(os.path.join(upper_dir, path), content)
+    for (path, content) in files.iteritems():
+        _write(os.path.join(rootfs_dir, path), content)
+    return (upper_dir, rootfs_dir)
+
+
+class ImageLayersTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='crawlertest.')
+        image_layers.forget_image_crawls()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        image_layers.forget_image_crawls()
+
+    def test_read_layer_changes(self):
+        (upper_dir, rootfs_dir) = make_container(
+            self.tmp_dir, 'c1',
+            {'etc/hosts': 'changed', 'usr/bin/a': None, 'usr/lib/x': None,
+             'opt/d/.wh..wh..opq': '', 'opt/d/f': 'f', 'app/g': 'g'})
+        # aufs' own
+        os.makedirs(os.path.join(upper_dir, '.wh..wh.plnk', 'a'))
+        changes = read_layer_changes(upper_dir, rootfs_dir)
+        assert changes.paths == set(['', 'etc', 'etc/hosts', 'usr',
+                                     'usr/bin', 'usr/lib', 'opt', 'opt/d',
+                                     'opt/d/f', 'app', 'app/g'])
+        # app is all of the layer
+        assert changes.subtrees == set(['usr/bin/a', 'usr/lib/x', 'opt/d',
+                                        'app'])
+        assert changes.covers('etc/hosts')
+        assert changes.covers('usr/lib/x/y')
+        assert not changes.covers('etc/passwd')
+        assert not changes.covers('usr/lib/z')
+
+    def test_top_subtrees(self):
+        changes = LayerChanges(subtrees=['a/b', 'a', 'c/d', 'ab'])
+        assert changes.top_subtrees() == ['a', 'ab', 'c/d']
+        assert changes.in_subtrees('a/b/c')
+        assert not changes.in_subtrees('c')
+        assert LayerChanges(subtrees=['']).in_subtrees('c')
+
+    def test_crawl_layered(self):
+        crawl_all = mock.Mock(return_value=[('a', 1), ('b', 2), ('c', 3)])
+        crawl_changed = mock.Mock(return_value=[('b', 20)])
+        changes = LayerChanges(['a', 'x', 'y'])
+        assert list(crawl_layered('image', changes, crawl_all,
+                                  crawl_changed)) == [('a', 1), ('b', 2),
+                                                      ('c', 3)]
+        assert crawl_changed.call_count == 0
+
+        # Another container, with fewer changes
+        changes = LayerChanges(['b'])
+        assert list(crawl_layered('image', changes, crawl_all,
+                                  crawl_changed)) == [('c', 3), ('b', 20)]
+        assert crawl_all.call_count == 1
+        assert crawl_changed.call_args[0][0].paths == set(['a', 'b', 'x',
+                                                           'y'])
+        # Its crawl is the one kept now
+        assert image_layers.get_image_crawl('image') == ([('c', 3),
+                                                          ('b', 20)],
+                                                         changes)
+
+    def test_max_image_crawls(self):
+        crawl_all = mock.Mock(return_value=[('a', 1)])
+        for index in xrange(image_layers._MAX_IMAGE_CRAWLS + 1):
+            list(crawl_layered(index, LayerChanges(), crawl_all, None))
+        assert image_layers.get_image_crawl(0) is None
+        assert image_layers.get_image_crawl(1) is not None
+
+    @mock.patch('crawler.image_layers._MAX_IMAGE_CRAWL_BYTES', 1000)
+    def test_max_image_crawl_bytes(self):
+        for index in xrange(3):
+            crawl_all = mock.Mock(return_value=[('a', 'x' * 400)])
+            list(crawl_layered(index, LayerChanges(), crawl_all, None))
+        # Only the last two fit
+        assert image_layers.get_image_crawl(0) is None
+        assert image_layers.get_image_crawl(1) is not None
+        assert image_layers.get_image_crawl(2) is not None
+        assert image_layers._image_crawls_bytes < 1000
+
+        # Too big to be kept at all
+        crawl_all = mock.Mock(return_value=[('a', 'x' * 2000)])
+        list(crawl_layered(3, LayerChanges(), crawl_all, None))
+        assert image_layers.get_image_crawl(3) is None
+        assert image_layers.get_image_crawl(2) is not None
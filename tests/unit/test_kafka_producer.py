@@ -0,0 +1,241 @@
+import unittest
+import SocketServer
+import struct
+import threading
+import time
+
+from crawler import kafka_producer
+from crawler.crawler_exceptions import EmitterEmitTimeout
+from crawler.kafka_producer import KafkaProducer
+
+
+def _string(value):
+    return struct.pack('>h', len(value)) + value
+
+
+def _read_string(data, offset):
+    (length,) = struct.unpack_from('>h', data, offset)
+    offset += 2
+    return (data[offset:offset + length], offset + length)
+
+
+class StandInBroker(SocketServer.ThreadingTCPServer):
+    """
+    A kafka broker on localhost that answers the metadata and produce
+    requests (version 0) of a single node cluster, with one partition per
+    topic, and keeps the values of the messages produced to it.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(
+            self, ('127.0.0.1', 0), StandInBrokerHandler)
+        self.port = self.server_address[1]
+        self.lock = threading.Lock()
+        self.connections = 0
+        # Created when they are first asked for
+        self.topics = set()
+        # (connection number, topic, [values]) of every produce request
+        self.produced = []
+        self.fail_produce = False
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def values(self):
+        with self.lock:
+            return [value for (_, _, values) in self.produced
+                    for value in values]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StandInBrokerHandler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+            self.connection = self.server.connections
+        while True:
+            size = self._read(4)
+            if not size:
+                return
+            request = self._read(struct.unpack('>i', size)[0])
+            (api_key, _, correlation_id) = struct.unpack_from('>hhi',
+                                                              request)
+            (_, offset) = _read_string(request, 8)
+            if api_key == 3:
+                body = self._metadata(request, offset)
+            elif api_key == 0:
+                body = self._produce(request, offset)
+                if body is None:
+                    continue
+            else:
+                return
+            response = struct.pack('>i', correlation_id) + body
+            self.request.sendall(struct.pack('>i', len(response)) + response)
+
+    def _read(self, size):
+        data = ''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def _metadata(self, request, offset):
+        (num_topics,) = struct.unpack_from('>i', request, offset)
+        offset += 4
+        topics = []
+        for _ in xrange(num_topics):
+            (topic, offset) = _read_string(request, offset)
+            topics.append(topic)
+        with self.server.lock:
+            self.server.topics.update(topics)
+            # All of them if none is asked for
+            topics = topics or sorted(self.server.topics)
+        body = struct.pack('>i', 1) + struct.pack('>i', 0) + \
+            _string('127.0.0.1') + struct.pack('>i', self.server.port)
+        body += struct.pack('>i', len(topics))
+        for topic in topics:
+            body += struct.pack('>h', 0) + _string(topic)
+            # Partition 0, led by the node 0
+            body += struct.pack('>ihiiiiii', 1, 0, 0, 0, 1, 0, 1, 0)
+        return body
+
+    def _produce(self, request, offset):
+        (required_acks, _, num_topics) = struct.unpack_from('>hii', request,
+                                                            offset)
+        offset += 10
+        body = struct.pack('>i', num_topics)
+        error = 1 if self.server.fail_produce else 0
+        for _ in xrange(num_topics):
+            (topic, offset) = _read_string(request, offset)
+            (num_partitions,) = struct.unpack_from('>i', request, offset)
+            offset += 4
+            body += _string(topic) + struct.pack('>i', num_partitions)
+            for _ in xrange(num_partitions):
+                (partition, size) = struct.unpack_from('>ii', request, offset)
+                offset += 8
+                values = self._read_message_set(request[offset:offset + size])
+                offset += size
+                if not error:
+                    with self.server.lock:
+                        self.server.produced.append((self.connection, topic,
+                                                     values))
+                body += struct.pack('>ihq', partition, error, 0)
+        if required_acks == 0:
+            return None
+        return body
+
+    def _read_message_set(self, message_set):
+        values = []
+        offset = 0
+        while offset < len(message_set):
+            (_, size) = struct.unpack_from('>qi', message_set, offset)
+            offset += 12
+            # crc, magic and attributes
+            message_offset = offset + 6
+            (key_size,) = struct.unpack_from('>i', message_set,
+                                             message_offset)
+            message_offset += 4 + max(key_size, 0)
+            (value_size,) = struct.unpack_from('>i', message_set,
+                                               message_offset)
+            message_offset += 4
+            values.append(message_set[message_offset:
+                                      message_offset + value_size])
+            offset += size
+        return values
+
+
+class KafkaProducerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StandInBroker()
+        self.kurl = '127.0.0.1:%d' % self.broker.port
+        kafka_producer.close_kafka_producers()
+
+    def tearDown(self):
+        kafka_producer.close_kafka_producers()
+        self.broker.stop()
+
+    def test_produce(self):
+        producer = kafka_producer.get_kafka_producer(self.kurl, 'frames', 5)
+        producer.send(['frame 1']).wait(5)
+        connections = self.broker.connections
+        for index in xrange(2, 5):
+            producer.send(['frame %d' % index]).wait(5)
+        assert self.broker.values() == ['frame %d' % index
+                                        for index in xrange(1, 5)]
+        # All of them over the same connection
+        assert self.broker.connections == connections
+        assert len(set(connection for (connection, _, _)
+                       in self.broker.produced)) == 1
+        assert kafka_producer.get_kafka_producer(self.kurl, 'frames') is \
+            producer
+
+    def test_batches(self):
+        producer = KafkaProducer(self.kurl, 'frames', 5, linger_ms=200,
+                                 batch_size=4)
+        results = []
+        deliveries = [producer.send(['a%d' % index, 'b%d' % index],
+                                    callback=results.append)
+                      for index in xrange(3)]
+        for delivery in deliveries:
+            delivery.wait(5)
+        producer.close()
+        assert results == [None] * 3
+        # The messages of a send() are not split across batches
+        assert [values for (_, _, values) in self.broker.produced] == [
+            ['a0', 'b0', 'a1', 'b1'], ['a2', 'b2']]
+
+    def test_linger(self):
+        producer = KafkaProducer(self.kurl, 'frames', 5, linger_ms=50)
+        producer.send(['a']).wait(5)
+        start = time.time()
+        producer.send(['b']).wait(5)
+        assert 0.04 < time.time() - start < 2
+        producer.close()
+
+    def test_failed_delivery(self):
+        producer = KafkaProducer(self.kurl, 'frames', 1, linger_ms=0)
+        producer.send(['a']).wait(5)
+        connections = self.broker.connections
+        self.broker.fail_produce = True
+        results = []
+        delivery = producer.send(['b'], callback=results.append)
+        with self.assertRaises(Exception):
+            delivery.wait(30)
+        assert results == [delivery.exception]
+
+        # Connects again for the next ones
+        self.broker.fail_produce = False
+        producer.send(['c']).wait(5)
+        assert self.broker.values() == ['a', 'c']
+        assert self.broker.connections > connections
+        producer.close()
+
+    def test_max_pending(self):
+        producer = KafkaProducer('127.0.0.1:1', 'frames', 1, max_pending=2)
+        with producer._condition:
+            # The thread can not take them while this holds the lock
+            producer.send(['a', 'b'])
+            delivery = producer.send(['c'])
+            with self.assertRaises(EmitterEmitTimeout):
+                delivery.wait(0)
+        producer.close()
+        with self.assertRaises(EmitterEmitTimeout):
+            producer.send(['d']).wait(0)
+
+    def test_timeout(self):
+        producer = KafkaProducer(self.kurl, 'frames', 5, linger_ms=1000,
+                                 batch_size=10)
+        with self.assertRaises(EmitterEmitTimeout):
+            producer.send(['a']).wait(0.05)
+        producer.close()
+        # Produced anyway on close
+        assert self.broker.values() == ['a']
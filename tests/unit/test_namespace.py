@@ -2,7 +2,6 @@ import mock
 import unittest
 import os
 from collections import namedtuple
-import Queue
 import time
 
 import crawler.namespace
@@ -28,6 +27,22 @@ def fun_not_exiting(x=0):
 def fun_failed(x=0):
     assert False
 
+def fun_pid(x=0):
+    return os.getpid()
+
+def fun_exit(x=0):
+    os._exit(1)
+
+def fun_stream(x=0):
+    for i in range(x):
+        yield ('/file%d' % i, os_stat(i, 0, 0, 0, 0, 0, 'a' * i, i))
+    yield 'not a feature'
+
+def fun_stream_failed(x=0):
+    for i in range(x):
+        yield ('/file%d' % i, None)
+    assert False
+
 class MockedLibc:
     def __init__(self):
         pass
@@ -90,36 +105,12 @@ class MockedLibcFailedClose:
         print args
 
 
-class MockedQueue:
-    def __init__(self, *args):
-        pass
-    def get(self, timeout=None):
-        return (123, None)
-    def put(self, item):
-        pass
-    def close(self):
-        pass
-
-
-
-class MockedQueueGetTimeout:
-    def __init__(self, *args):
-        pass
-    def get(self, timeout=None):
-        if timeout:
-            raise Queue.Empty()
-    def put(self, item):
-        pass
-    def close(self):
-        pass
-
-
 class NamespaceTests(unittest.TestCase):
     def setUp(self):
         pass
 
     def tearDown(self):
-        pass
+        crawler.namespace.stop_namespace_workers()
 
     @mock.patch('crawler.namespace.os.stat',
                 side_effect=lambda p : os_stat(1, 2, 3, 4, 5, 6, 7, 8))
@@ -153,7 +144,7 @@ class NamespaceTests(unittest.TestCase):
     @mock.patch('crawler.namespace.get_libc',
                 side_effect=lambda : MockedLibcFailedSetns())
     def test_run_as_another_namespace_failed_setns(self, *args):
-        with self.assertRaises(SystemExit):
+        with self.assertRaises(crawler.crawler_exceptions.NamespaceFailedMntSetns):
             crawler.namespace.run_as_another_namespace(
                '1', crawler.namespace.ALL_NAMESPACES, fun_add, 1)
 
@@ -184,29 +175,114 @@ class NamespaceTests(unittest.TestCase):
 
     @mock.patch('crawler.namespace.get_libc',
                 side_effect=lambda : MockedLibc())
-    @mock.patch('crawler.namespace.multiprocessing.Queue',
-                side_effect=MockedQueue)
-    def test_run_as_another_namespace_with_mocked_queue(self, *args):
+    def test_run_as_another_namespace_reuses_worker(self, *args):
         assert crawler.namespace.run_as_another_namespace(
-               '1', crawler.namespace.ALL_NAMESPACES, fun_failed, 1) == 123
+               '1', crawler.namespace.ALL_NAMESPACES, fun_add, 1) == 2
+        worker = crawler.namespace.get_namespace_worker(
+               '1', crawler.namespace.ALL_NAMESPACES)
+        assert crawler.namespace.run_as_another_namespace(
+               '1', crawler.namespace.ALL_NAMESPACES, fun_add, 2) == 3
+        assert crawler.namespace.get_namespace_worker(
+               '1', crawler.namespace.ALL_NAMESPACES) is worker
+        assert fun_pid(0) != crawler.namespace.run_as_another_namespace(
+               '1', crawler.namespace.ALL_NAMESPACES, fun_pid)
 
     @mock.patch('crawler.namespace.get_libc',
                 side_effect=lambda : MockedLibc())
-    @mock.patch('crawler.namespace.multiprocessing.Queue',
-                side_effect=MockedQueueGetTimeout)
-    def test_run_as_another_namespace_get_timeout(self, *args):
-        with self.assertRaises(crawler.crawler_exceptions.CrawlTimeoutError):
-            crawler.namespace.run_as_another_namespace(
+    def test_run_as_another_namespace_worker_per_namespaces(self, *args):
+        crawler.namespace.run_as_another_namespace(
                '1', crawler.namespace.ALL_NAMESPACES, fun_add, 1)
+        crawler.namespace.run_as_another_namespace('1', ['mnt'], fun_add, 1)
+        crawler.namespace.run_as_another_namespace('2', ['mnt'], fun_add, 1)
+        assert len(crawler.namespace._namespace_workers) == 3
+
+        crawler.namespace.stop_namespace_workers('1')
+        assert crawler.namespace._namespace_workers.keys() == [('2', ('mnt',))]
+
+    @mock.patch('crawler.namespace.get_libc',
+                side_effect=lambda : MockedLibc())
+    def test_run_as_another_namespace_dead_worker(self, *args):
+        worker = crawler.namespace.get_namespace_worker(
+               '1', crawler.namespace.ALL_NAMESPACES)
+        with self.assertRaises(crawler.crawler_exceptions.CrawlError):
+            crawler.namespace.run_as_another_namespace(
+               '1', crawler.namespace.ALL_NAMESPACES, fun_exit)
+        assert not worker.is_alive()
+
+        # a new worker is started for the next call
+        assert crawler.namespace.run_as_another_namespace(
+               '1', crawler.namespace.ALL_NAMESPACES, fun_add, 1) == 2
 
     @mock.patch('crawler.namespace.get_libc',
                 side_effect=lambda : MockedLibc())
-    @mock.patch('crawler.namespace.multiprocessing.Queue',
-                side_effect=MockedQueue)
     def test_run_as_another_namespace_fun_not_exiting_failure(self, *args):
         _old_timeout = crawler.namespace.IN_CONTAINER_TIMEOUT
-        crawler.namespace.IN_CONTAINER_TIMEOUT = 0
-        with self.assertRaises(crawler.crawler_exceptions.CrawlTimeoutError):
-            crawler.namespace.run_as_another_namespace(
-               '1', crawler.namespace.ALL_NAMESPACES, fun_not_exiting, 1)
-        crawler.namespace.IN_CONTAINER_TIMEOUT = _old_timeout
+        crawler.namespace.IN_CONTAINER_TIMEOUT = 0.5
+        try:
+            worker = crawler.namespace.get_namespace_worker(
+                   '1', crawler.namespace.ALL_NAMESPACES)
+            with self.assertRaises(crawler.crawler_exceptions.CrawlTimeoutError):
+                crawler.namespace.run_as_another_namespace(
+                   '1', crawler.namespace.ALL_NAMESPACES, fun_not_exiting, 1)
+            assert not worker.is_alive()
+        finally:
+            crawler.namespace.IN_CONTAINER_TIMEOUT = _old_timeout
+
+    @mock.patch('crawler.namespace.get_libc',
+                side_effect=lambda : MockedLibc())
+    def test_run_as_another_namespace_stream(self, *args):
+        count = 2 * crawler.namespace.STREAM_CHUNK_ITEMS + 1
+        res = crawler.namespace.run_as_another_namespace(
+               '1', crawler.namespace.ALL_NAMESPACES, fun_stream, count)
+        assert not isinstance(res, list)
+        res = list(res)
+        assert res == list(fun_stream(count))
+        assert type(res[1][1]) == os_stat
+
+    def test_encode_chunks_bounded(self, *args):
+        items = list(fun_stream(100))
+        _old_bytes = crawler.namespace.STREAM_CHUNK_BYTES
+        crawler.namespace.STREAM_CHUNK_BYTES = 1000
+        try:
+            chunks = list(crawler.namespace._encode_chunks(iter(items)))
+        finally:
+            crawler.namespace.STREAM_CHUNK_BYTES = _old_bytes
+        assert len(chunks) > 1
+        for (classes, rows) in chunks[:-1]:
+            assert classes == [os_stat]
+        decoded = [item for chunk in chunks
+                   for item in crawler.namespace._decode_chunk(chunk)]
+        assert decoded == items
+
+    @mock.patch('crawler.namespace.get_libc',
+                side_effect=lambda : MockedLibc())
+    def test_run_as_another_namespace_stream_failed(self, *args):
+        count = crawler.namespace.STREAM_CHUNK_ITEMS + 1
+        res = crawler.namespace.run_as_another_namespace(
+               '1', crawler.namespace.ALL_NAMESPACES, fun_stream_failed, count)
+        with self.assertRaises(AssertionError):
+            for item in res:
+                pass
+
+        # the worker is still usable
+        worker = crawler.namespace.get_namespace_worker(
+               '1', crawler.namespace.ALL_NAMESPACES)
+        assert crawler.namespace.run_as_another_namespace(
+               '1', crawler.namespace.ALL_NAMESPACES, fun_add, 1) == 2
+        assert worker is crawler.namespace.get_namespace_worker(
+               '1', crawler.namespace.ALL_NAMESPACES)
+
+    @mock.patch('crawler.namespace.get_libc',
+                side_effect=lambda : MockedLibc())
+    def test_run_as_another_namespace_stream_abandoned(self, *args):
+        count = 3 * crawler.namespace.STREAM_CHUNK_ITEMS
+        res = crawler.namespace.run_as_another_namespace(
+               '1', crawler.namespace.ALL_NAMESPACES, fun_stream, count)
+        next(res)
+
+        # the rest of the stream is dropped along with the worker
+        assert crawler.namespace.run_as_another_namespace(
+               '1', crawler.namespace.ALL_NAMESPACES, fun_add, 1) == 2
+        res.close()
+        assert crawler.namespace.run_as_another_namespace(
+               '1', crawler.namespace.ALL_NAMESPACES, fun_add, 2) == 3
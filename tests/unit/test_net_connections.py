@@ -0,0 +1,75 @@
+import mock
+import unittest
+import os
+import shutil
+import tempfile
+
+from crawler import net_connections
+from crawler.net_connections import Connection
+
+TCP = '''  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+   0: 0100007F:1F90 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 100 1 0 100 0 0 10 0
+   1: 0100007F:1F90 0200007F:D431 01 00000000:00000000 00:00000000 00000000     0        0 101 1 0 20 4 30 10 -1
+   2: 0100007F:1F90 0200007F:D432 06 00000000:00000000 03:00000000 00000000     0        0 0 3 0
+'''
+
+TCP6 = '''  sl  local_address                         remote_address                        st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+   0: 00000000000000000000000001000000:0016 00000000000000000000000000000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 102 1 0 100 0 0 10 0
+'''
+
+UDP = '''  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode ref pointer drops
+  10: 00000000:0044 00000000:0000 07 00000000:00000000 00:00000000 00000000     0        0 103 2 0 0
+'''
+
+
+class NetConnectionsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.proc_dir = tempfile.mkdtemp(prefix='crawlertest.')
+        self.net_dir = os.path.join(self.proc_dir, 'net')
+        os.makedirs(self.net_dir)
+        for (name, content) in [('tcp', TCP), ('tcp6', TCP6), ('udp', UDP)]:
+            with open(os.path.join(self.net_dir, name), 'w') as fp:
+                fp.write(content)
+        open(os.path.join(self.proc_dir, 'netns'), 'w').close()
+        self._add_process(1, [100, 101])
+        self._add_process(2, [102, 103, 101])
+
+    def tearDown(self):
+        shutil.rmtree(self.proc_dir)
+
+    def _add_process(self, pid, inodes):
+        pid_dir = os.path.join(self.proc_dir, str(pid))
+        os.makedirs(os.path.join(pid_dir, 'fd'))
+        os.makedirs(os.path.join(pid_dir, 'ns'))
+        os.symlink(self.net_dir, os.path.join(pid_dir, 'net'))
+        os.symlink(os.path.join(self.proc_dir, 'netns'),
+                   os.path.join(pid_dir, 'ns', 'net'))
+        os.symlink('/dev/null', os.path.join(pid_dir, 'fd', '0'))
+        for (fd, inode) in enumerate(inodes, 3):
+            os.symlink('socket:[%d]' % inode,
+                       os.path.join(pid_dir, 'fd', str(fd)))
+
+    def test_read_sockets(self):
+        sockets = net_connections.read_sockets(1, self.proc_dir)
+        assert sorted(sockets) == [100, 101, 102, 103]
+        assert sockets[100] == Connection(100, ('127.0.0.1', 8080), (),
+                                          'LISTEN')
+        assert sockets[101] == Connection(101, ('127.0.0.1', 8080),
+                                          ('127.0.0.2', 54321),
+                                          'ESTABLISHED')
+        assert sockets[102] == Connection(102, ('::1', 22), (), 'LISTEN')
+        assert sockets[103] == Connection(103, ('0.0.0.0', 68), (), 'NONE')
+
+    def test_get_connections(self):
+        connections = sorted((pid, c.inode) for (pid, c) in
+                             net_connections.get_connections(
+                                 [1, 2, 3], self.proc_dir))
+        assert connections == [(1, 100), (1, 101), (2, 101), (2, 102),
+                               (2, 103)]
+
+    @mock.patch('crawler.net_connections.read_sockets',
+                side_effect=net_connections.read_sockets)
+    def test_get_connections_once_per_namespace(self, mock_read):
+        list(net_connections.get_connections([1, 2], self.proc_dir))
+        assert mock_read.call_count == 1
@@ -0,0 +1,57 @@
+import mock
+import unittest
+import os
+import shutil
+import tempfile
+
+from crawler import net_interfaces
+
+NET_DEV = '''Inter-|   Receive                                                |  Transmit
+ face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+    lo:     100       1    0    0    0     0          0         0      100       1    0    0    0     0       0          0
+  eth0:    2000      20    2    0    0     0          0         0     3000      30    3    0    0     0       0          0
+'''
+
+
+class NetInterfacesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.proc_dir = tempfile.mkdtemp(prefix='crawlertest.')
+        self.net_dir = os.path.join(self.proc_dir, 'net')
+        os.makedirs(self.net_dir)
+        with open(os.path.join(self.net_dir, 'dev'), 'w') as fp:
+            fp.write(NET_DEV)
+        open(os.path.join(self.proc_dir, 'netns'), 'w').close()
+        for pid in [1, 2]:
+            pid_dir = os.path.join(self.proc_dir, str(pid))
+            os.makedirs(os.path.join(pid_dir, 'ns'))
+            os.symlink(self.net_dir, os.path.join(pid_dir, 'net'))
+            os.symlink(os.path.join(self.proc_dir, 'netns'),
+                       os.path.join(pid_dir, 'ns', 'net'))
+        net_interfaces._snapshot = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.proc_dir)
+        net_interfaces._snapshot = {}
+
+    def test_read_net_dev(self):
+        assert net_interfaces.read_net_dev(1, self.proc_dir) == {
+            'lo': [100, 100, 1, 1, 0, 0],
+            'eth0': [3000, 2000, 30, 20, 3, 2]}
+
+    @mock.patch('crawler.net_interfaces.read_net_dev',
+                side_effect=net_interfaces.read_net_dev)
+    def test_snapshot_once_per_namespace(self, mock_read):
+        net_interfaces.snapshot_interface_counters([1, 2, 3], self.proc_dir)
+        assert mock_read.call_count == 1
+        (counters, timestamp) = net_interfaces.get_interface_counters(
+            2, self.proc_dir)
+        assert counters['eth0'] == [3000, 2000, 30, 20, 3, 2]
+        assert mock_read.call_count == 1
+        # Used already, so read again
+        net_interfaces.get_interface_counters(2, self.proc_dir)
+        assert mock_read.call_count == 2
+
+    def test_get_interface_counters_gone(self):
+        with self.assertRaises(IOError):
+            net_interfaces.get_interface_counters(3, self.proc_dir)
@@ -1,9 +1,12 @@
 import mock
 import unittest
 import os
+import shutil
+import tempfile
 
 import crawler.package_utils
 from crawler.features import PackageFeature
+from test_rpmdb import make_header, make_ndb
 
 def mocked_subprocess_run(cmd, shell=False, ignore_failure=False):
     if 'dpkg-query' in cmd:
@@ -13,31 +16,114 @@ def mocked_subprocess_run(cmd, shell=False, ignore_failure=False):
         return ('123|pkg1|v1|x86|123\n'
                 '123|pkg1|v1|x86|123\n')
 
+DPKG_STATUS = """Package: pkg1
+Status: install ok installed
+Installed-Size: 123
+Architecture: x86
+Version: v1
+Description: the first package
+ with a description of
+ .
+ more than one line
+
+Package: pkg2
+Status: install ok installed
+Installed-Size: 123
+Architecture: x86
+Version: v2
+
+Package: purged
+Status: purge ok not-installed
+Architecture: x86
+
+"""
+
 class PackageUtilsTests(unittest.TestCase):
     def setUp(self):
-        pass
+        self.root_dir = tempfile.mkdtemp(prefix='crawlertest.')
+        crawler.package_utils._package_databases.clear()
 
     def tearDown(self):
-        pass
+        shutil.rmtree(self.root_dir)
+        crawler.package_utils._package_databases.clear()
 
-    @mock.patch('crawler.package_utils.subprocess_run',
-                side_effect=mocked_subprocess_run)
-    def test_get_dpkg_packages(self, mock_subprocess_run):
-        pkgs = list(crawler.package_utils.get_dpkg_packages())
+    def _write_dpkg_status(self, content):
+        dpkg_dir = os.path.join(self.root_dir, 'var/lib/dpkg')
+        if not os.path.exists(dpkg_dir):
+            os.makedirs(dpkg_dir)
+        with open(os.path.join(dpkg_dir, 'status'), 'w') as fp:
+            fp.write(content)
+
+    def test_get_dpkg_packages(self):
+        self._write_dpkg_status(DPKG_STATUS)
+        pkgs = list(crawler.package_utils.get_dpkg_packages(self.root_dir))
         print pkgs
         assert pkgs == [('pkg1', PackageFeature(installed=None, pkgname='pkg1', pkgsize='123', pkgversion='v1', pkgarchitecture='x86')), ('pkg2', PackageFeature(installed=None, pkgname='pkg2', pkgsize='123', pkgversion='v2', pkgarchitecture='x86'))]
 
+    def test_parse_dpkg_status(self):
+        pkgs = list(crawler.package_utils.parse_dpkg_status(
+            iter(DPKG_STATUS.splitlines(True))))
+        assert pkgs == [('pkg1', 'v1', 'x86', '123'),
+                        ('pkg2', 'v2', 'x86', '123')]
+        # No empty line at the end
+        pkgs = list(crawler.package_utils.parse_dpkg_status(
+            iter(['Package: pkg3\n', 'Status: install ok installed\n'])))
+        assert pkgs == [('pkg3', '', '', '')]
+
+    @mock.patch('crawler.package_utils.parse_dpkg_status',
+                side_effect=crawler.package_utils.parse_dpkg_status)
+    def test_get_dpkg_packages_cached(self, mock_parse):
+        self._write_dpkg_status(DPKG_STATUS)
+        first = list(crawler.package_utils.get_dpkg_packages(self.root_dir))
+        assert list(crawler.package_utils.get_dpkg_packages(
+            self.root_dir)) == first
+        assert mock_parse.call_count == 1
+
+        # Changed, so parsed again
+        self._write_dpkg_status(DPKG_STATUS + 'Package: pkg4\n')
+        pkgs = list(crawler.package_utils.get_dpkg_packages(self.root_dir))
+        assert [key for (key, _) in pkgs] == ['pkg1', 'pkg2', 'pkg4']
+        assert mock_parse.call_count == 2
+
+    def test_get_dpkg_packages_no_status(self):
+        with self.assertRaises(OSError):
+            list(crawler.package_utils.get_dpkg_packages(self.root_dir))
+
     @mock.patch('crawler.package_utils.subprocess_run',
                 side_effect=mocked_subprocess_run)
     def test_get_rpm_packages(self, mock_subprocess_run):
-        pkgs = list(crawler.package_utils.get_rpm_packages())
+        pkgs = list(crawler.package_utils.get_rpm_packages(self.root_dir))
         print pkgs
         assert pkgs == [('pkg1', PackageFeature(installed='123', pkgname='pkg1', pkgsize='123', pkgversion='v1', pkgarchitecture='x86')), ('pkg1', PackageFeature(installed='123', pkgname='pkg1', pkgsize='123', pkgversion='v1', pkgarchitecture='x86'))]
 
     @mock.patch('crawler.package_utils.subprocess_run',
                 side_effect=mocked_subprocess_run)
     def test_get_rpm_packages_with_db_reload(self, mock_subprocess_run):
-        pkgs = list(crawler.package_utils.get_rpm_packages(reload_needed=True))
+        pkgs = list(crawler.package_utils.get_rpm_packages(self.root_dir, reload_needed=True))
         print pkgs
         assert pkgs == [('pkg1', PackageFeature(installed='123', pkgname='pkg1', pkgsize='123', pkgversion='v1', pkgarchitecture='x86')), ('pkg1', PackageFeature(installed='123', pkgname='pkg1', pkgsize='123', pkgversion='v1', pkgarchitecture='x86'))]
 
+    @mock.patch('crawler.package_utils.subprocess_run')
+    def test_get_rpm_packages_native(self, mock_subprocess_run):
+        rpm_dir = os.path.join(self.root_dir, 'var/lib/rpm')
+        os.makedirs(rpm_dir)
+        make_ndb(os.path.join(rpm_dir, 'Packages.db'), [make_header('pkg1')])
+        pkgs = list(crawler.package_utils.get_rpm_packages(
+            self.root_dir, reload_needed=True))
+        assert pkgs == [('pkg1', PackageFeature(installed='123', pkgname='pkg1', pkgsize='456', pkgversion='1.0-2.el7', pkgarchitecture='x86_64'))]
+        assert not mock_subprocess_run.called
+
+        with mock.patch('crawler.rpmdb.read_packages') as mock_read:
+            assert list(crawler.package_utils.get_rpm_packages(
+                self.root_dir)) == pkgs
+        assert not mock_read.called
+
+    @mock.patch('crawler.package_utils.subprocess_run',
+                side_effect=mocked_subprocess_run)
+    def test_get_rpm_packages_unreadable(self, mock_subprocess_run):
+        rpm_dir = os.path.join(self.root_dir, 'usr/lib/sysimage/rpm')
+        os.makedirs(rpm_dir)
+        with open(os.path.join(rpm_dir, 'Packages'), 'w') as fp:
+            fp.write('not a database')
+        pkgs = list(crawler.package_utils.get_rpm_packages(self.root_dir))
+        assert [key for (key, _) in pkgs] == ['pkg1', 'pkg1']
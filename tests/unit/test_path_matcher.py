@@ -0,0 +1,57 @@
+import unittest
+
+from crawler import path_matcher
+from crawler.path_matcher import PathMatcher
+
+
+class PathMatcherTests(unittest.TestCase):
+
+    def test_literal(self):
+        matcher = PathMatcher(['/proc', 'var/cache'])
+        assert matcher.is_excluded('proc')
+        assert matcher.is_excluded('/proc/1/status')
+        assert matcher.is_excluded('var/cache/apt')
+        assert not matcher.is_excluded('var')
+        assert not matcher.is_excluded('var/lib')
+        assert not matcher.is_excluded('procfs')
+        assert not matcher.is_excluded('usr/proc')
+
+    def test_glob(self):
+        matcher = PathMatcher(['usr/*/doc', 'tmp?', 'opt/[ab]*'])
+        assert matcher.is_excluded('usr/share/doc')
+        assert not matcher.is_excluded('usr/share/man')
+        assert not matcher.is_excluded('usr/doc')
+        assert matcher.is_excluded('tmp2/file')
+        assert not matcher.is_excluded('tmp')
+        assert matcher.is_excluded('opt/app')
+        assert not matcher.is_excluded('opt/cpp')
+
+    def test_any_depth(self):
+        matcher = PathMatcher(['**/*.pyc', 'home/**/.cache', 'var/**'])
+        assert matcher.is_excluded('a.pyc')
+        assert matcher.is_excluded('usr/lib/python/a.pyc')
+        assert not matcher.is_excluded('usr/lib/python/a.py')
+        assert matcher.is_excluded('home/.cache')
+        assert matcher.is_excluded('home/user/a/.cache/file')
+        assert not matcher.is_excluded('.cache')
+        assert matcher.is_excluded('var')
+
+    def test_child_states(self):
+        matcher = PathMatcher(['usr/share/doc'])
+        state = matcher.root_state()
+        assert matcher.child(state, 'etc') == (False, None)
+        (excluded, usr_state) = matcher.child(state, 'usr')
+        assert not excluded and usr_state
+        (excluded, share_state) = matcher.child(usr_state, 'share')
+        assert matcher.child(share_state, 'doc') == (True, None)
+        assert matcher.child(None, 'doc') == (False, None)
+
+    def test_no_patterns(self):
+        matcher = PathMatcher([])
+        assert matcher.root_state() is None
+        assert not matcher.is_excluded('proc')
+
+    def test_get_path_matcher(self):
+        matcher = path_matcher.get_path_matcher(['proc', 'dev'])
+        assert path_matcher.get_path_matcher(['proc', 'dev']) is matcher
+        assert path_matcher.get_path_matcher(['proc']) is not matcher
@@ -0,0 +1,164 @@
+import mock
+import unittest
+import os
+import shutil
+import tempfile
+
+import psutil
+
+from crawler import process_table
+from crawler.process_table import ProcessTable
+
+
+class ProcessTableTests(unittest.TestCase):
+
+    def setUp(self):
+        self.proc_dir = tempfile.mkdtemp(prefix='crawlertest.')
+        self._write('stat', 'cpu  1 2 3\nbtime 1000\n')
+        self._write('meminfo', 'MemTotal:       1000 kB\n')
+        self.opened = os.path.join(self.proc_dir, 'opened')
+        self._write('opened', '')
+        self._add_process(1, 'init', 'S', ['/sbin/init'])
+        self._add_process(20, 'a (weird) name', 'R',
+                          ['/usr/bin/python', 'app.py'], utime=300)
+        self._add_process(30, 'zombie', 'Z', [])
+        process_table._process_table = None
+        process_table._process_table_key = None
+        process_table._container_tables.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.proc_dir)
+        process_table._process_table = None
+        process_table._process_table_key = None
+        process_table._container_tables.clear()
+
+    def _write(self, path, content):
+        path = os.path.join(self.proc_dir, path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fp:
+            fp.write(content)
+
+    def _add_process(self, pid, name, state, cmdline, utime=100, ppid=1,
+                     nspid=None, tgid=None, uid=0):
+        fields = [state, str(ppid)] + ['0'] * 9 + [str(utime), '100'] + \
+            ['0'] * 4 + ['2', '0', '500', '4096', '10']
+        self._write('%d/stat' % pid, '%d (%s) %s' % (pid, name,
+                                                     ' '.join(fields)))
+        self._write('%d/cmdline' % pid, '\0'.join(cmdline) + '\0')
+        self._write('%d/status' % pid,
+                    'Name:\t%s\nTgid:\t%d\nUid:\t%d\t0\t0\t0\n'
+                    'NSpid:\t%d\t%d\n' % (name, tgid or pid, uid, pid,
+                                          nspid or pid))
+        self._write('%d/io' % pid, 'rchar: 1\nread_bytes: 10\n'
+                                   'write_bytes: 20\n')
+        self._write('%d/ns/pid' % pid, '')
+        os.makedirs(os.path.join(self.proc_dir, str(pid), 'fd'))
+        os.symlink(self.opened,
+                   os.path.join(self.proc_dir, str(pid), 'fd', '3'))
+        os.symlink('socket:[123]',
+                   os.path.join(self.proc_dir, str(pid), 'fd', '4'))
+        os.symlink('/', os.path.join(self.proc_dir, str(pid), 'cwd'))
+        os.symlink('/', os.path.join(self.proc_dir, str(pid), 'root'))
+
+    def test_scan(self):
+        table = ProcessTable(self.proc_dir)
+        assert [p.pid for p in table] == [1, 20, 30]
+        proc = table.processes[20]
+        assert proc.name == 'a (weird) name'
+        assert proc.cmdline == ['/usr/bin/python', 'app.py']
+        assert proc.status == psutil.STATUS_RUNNING
+        assert proc.ppid == 1
+        assert proc.num_threads == 2
+        assert proc.username == 'root'
+        assert proc.vms == 4096
+        assert proc.rss == 10 * os.sysconf('SC_PAGE_SIZE')
+        assert proc.create_time == 1000 + 500.0 / os.sysconf('SC_CLK_TCK')
+        assert proc.cpu_percent == 0.0
+        assert proc.cwd is None and proc.open_files is None
+        assert table.processes[30].status == psutil.STATUS_ZOMBIE
+
+    def test_ensure(self):
+        table = ProcessTable(self.proc_dir)
+        table.ensure(process_table.OPTIONAL_FIELDS)
+        proc = table.processes[20]
+        assert proc.cwd == '/'
+        assert proc.open_files == [self.opened]
+        assert (proc.read_bytes, proc.write_bytes) == (10, 20)
+        assert proc.pid_namespace == os.stat(
+            os.path.join(self.proc_dir, '20/ns/pid')).st_ino
+        assert table.processes[30].cwd == 'unknown'
+
+    def test_ensure_once(self):
+        table = ProcessTable(self.proc_dir)
+        with mock.patch.object(table, '_read_io') as mock_read:
+            table.ensure(['io'])
+            table.ensure(['io'])
+        assert mock_read.call_count == 3
+
+    def test_cpu_percent(self):
+        first = ProcessTable(self.proc_dir)
+        stat = os.path.join(self.proc_dir, '20/stat')
+        with open(stat) as fp:
+            content = fp.read()
+        self._write('20/stat', content.replace(' 300 100 ', ' 400 100 '))
+        second = ProcessTable(self.proc_dir, dict(
+            (key, (cpu_time, first.timestamp - 10))
+            for (key, (cpu_time, _)) in first.cpu_times.items()))
+        cpu_percent = second.processes[20].cpu_percent
+        assert 0 < cpu_percent <= 100.0 / os.sysconf('SC_CLK_TCK') * 10
+
+    def test_get_process_table(self):
+        table = process_table.get_process_table('frame1',
+                                                proc_dir=self.proc_dir)
+        assert process_table.get_process_table(
+            'frame1', ['io'], proc_dir=self.proc_dir) is table
+        assert table.processes[1].read_bytes == 10
+        assert process_table.get_process_table(
+            'frame2', proc_dir=self.proc_dir) is not table
+        assert process_table.get_process_table(
+            None, proc_dir=self.proc_dir) is not table
+
+    def test_scan_pids(self):
+        self._add_process(40, 'sh', 'S', ['sh'], ppid=20, nspid=1, uid=1000)
+        self._add_process(41, 'app', 'S', ['app'], ppid=40, nspid=7)
+        # A thread of 41, as listed in the tasks of a cgroup
+        self._add_process(42, 'app', 'S', ['app'], ppid=40, nspid=8,
+                          tgid=41)
+        passwd = os.path.join(self.proc_dir, 'passwd')
+        self._write('passwd', 'root:x:0:0::/root:/bin/sh\n'
+                              'app:x:1000:1000::/:/bin/sh\n')
+        table = ProcessTable(self.proc_dir, pids=[40, 41, 42],
+                             passwd_path=passwd)
+        assert [(p.pid, p.host_pid, p.ppid, p.username)
+                for p in table] == [(1, 40, 0, 'app'), (7, 41, 1, 'root')]
+        table.ensure(['io'])
+        assert table.processes[7].read_bytes == 10
+
+    def test_read_cgroup_pids(self):
+        self._write('cgroup/tasks', '3\n2\n3\n')
+        assert process_table.read_cgroup_pids(
+            os.path.join(self.proc_dir, 'cgroup')) == [2, 3]
+        self._write('cgroup/cgroup.procs', '2\n')
+        assert process_table.read_cgroup_pids(
+            os.path.join(self.proc_dir, 'cgroup')) == [2]
+        with self.assertRaises(IOError):
+            process_table.read_cgroup_pids(self.proc_dir)
+
+    def test_list_namespace_pids(self):
+        ns = os.stat(os.path.join(self.proc_dir, '20/ns/pid')).st_ino
+        assert process_table.list_namespace_pids(ns, self.proc_dir) == [20]
+
+    def test_get_container_process_table(self):
+        list_pids = mock.Mock(return_value=[20, 30])
+        table = process_table.get_container_process_table(
+            '20', 'frame1', list_pids, proc_dir=self.proc_dir)
+        assert [p.pid for p in table] == [20, 30]
+        assert process_table.get_container_process_table(
+            '20', 'frame1', list_pids, ['cwd'],
+            proc_dir=self.proc_dir) is table
+        assert table.processes[20].cwd == '/'
+        assert list_pids.call_count == 1
+        process_table.forget_container_process_table('20')
+        assert process_table.get_container_process_table(
+            '20', 'frame1', list_pids, proc_dir=self.proc_dir) is not table
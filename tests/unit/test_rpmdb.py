@@ -0,0 +1,158 @@
+import unittest
+import os
+import shutil
+import sqlite3
+import struct
+import tempfile
+
+from crawler import rpmdb
+
+
+def make_header(name, installtime=123, size=456, arch='x86_64'):
+    entries = []
+    data = ''
+    for (tag, value) in [(rpmdb.RPMTAG_NAME, name),
+                         (rpmdb.RPMTAG_VERSION, '1.0'),
+                         (rpmdb.RPMTAG_RELEASE, '2.el7'),
+                         (rpmdb.RPMTAG_INSTALLTIME, installtime),
+                         (rpmdb.RPMTAG_SIZE, size),
+                         (rpmdb.RPMTAG_ARCH, arch),
+                         # Not one of ours
+                         (1004, 'the summary')]:
+        if value is None:
+            continue
+        if isinstance(value, int):
+            data += '\0' * (-len(data) % 4)
+            entries.append(struct.pack('>iIiI', tag, 4, len(data), 1))
+            data += struct.pack('>I', value)
+        else:
+            entries.append(struct.pack('>iIiI', tag, 6, len(data), 1))
+            data += value + '\0'
+    return struct.pack('>II', len(entries), len(data)) + \
+        ''.join(entries) + data
+
+
+def make_bdb(path, blobs, page_size=512):
+    """
+    Writes a Berkeley DB hash file with the header blobs `blobs`, the first
+    one on the hash page and the others in overflow pages.
+    """
+    pages = []
+    meta = bytearray(page_size)
+    struct.pack_into('<IIIBB', meta, 12, 0x061561, 9, page_size, 0, 8)
+    pages.append(meta)
+
+    # The record 0 and the first package on the page
+    items = [struct.pack('<BI', 1, 0), struct.pack('<BI', 1, 7),
+             struct.pack('<BI', 1, 1), chr(1) + blobs[0]]
+    overflow_page = 2
+    for (number, blob) in enumerate(blobs[1:], 2):
+        items.append(struct.pack('<BI', 1, number))
+        items.append(struct.pack('<B3xII', 3, overflow_page, len(blob)))
+        overflow_page += (len(blob) + page_size - 27) / (page_size - 26)
+    page = bytearray(page_size)
+    offset = page_size
+    offsets = []
+    for item in items:
+        offset -= len(item)
+        page[offset:offset + len(item)] = item
+        offsets.append(offset)
+    struct.pack_into('<IIIHHBB', page, 8, 1, 0, 0, len(items), offset, 0,
+                     13)
+    struct.pack_into('<%dH' % len(offsets), page, 26, *offsets)
+    pages.append(page)
+
+    for blob in blobs[1:]:
+        while blob:
+            chunk = blob[:page_size - 26]
+            blob = blob[page_size - 26:]
+            page = bytearray(page_size)
+            next_page = len(pages) + 1 if blob else 0
+            struct.pack_into('<IIIHHBB', page, 8, len(pages), 0, next_page,
+                             1, len(chunk), 0, 7)
+            page[26:26 + len(chunk)] = chunk
+            pages.append(page)
+
+    with open(path, 'wb') as fp:
+        for page in pages:
+            fp.write(page)
+
+
+def make_ndb(path, blobs):
+    slots = ''
+    data = ''
+    block = 4096 / 16
+    for (number, blob) in enumerate(blobs, 1):
+        slots += struct.pack('<4sIII', 'Slot', number, block, 0)
+        blob = struct.pack('<4sIII', 'BlbS', number, 0, len(blob)) + blob
+        blob += '\0' * (-len(blob) % 16)
+        data += blob
+        block += len(blob) / 16
+    slots += struct.pack('<4sIII', 'Slot', 0, 0, 0) * (254 - len(blobs))
+    with open(path, 'wb') as fp:
+        fp.write(struct.pack('<4sIII16x', 'RpmP', 0, 1, 1) + slots + data)
+
+
+def make_sqlite(path, blobs):
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE Packages '
+                       '(hnum INTEGER PRIMARY KEY AUTOINCREMENT, blob BLOB)')
+    for blob in blobs:
+        connection.execute('INSERT INTO Packages (blob) VALUES (?)',
+                           (buffer(blob),))
+    connection.commit()
+    connection.close()
+
+
+class RpmdbTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp(prefix='crawlertest.')
+        self.blobs = [make_header('small'),
+                      make_header('big' + 'g' * 600, size=2 ** 20),
+                      make_header('gpg-pubkey', arch=None)]
+        self.packages = [('123', 'small', '1.0-2.el7', 'x86_64', '456'),
+                         ('123', 'big' + 'g' * 600, '1.0-2.el7', 'x86_64',
+                          str(2 ** 20)),
+                         ('123', 'gpg-pubkey', '1.0-2.el7', '(none)', '456')]
+
+    def tearDown(self):
+        shutil.rmtree(self.db_dir)
+
+    def test_read_header(self):
+        assert rpmdb.read_header(self.blobs[0]) == {
+            rpmdb.RPMTAG_NAME: 'small',
+            rpmdb.RPMTAG_VERSION: '1.0',
+            rpmdb.RPMTAG_RELEASE: '2.el7',
+            rpmdb.RPMTAG_INSTALLTIME: 123,
+            rpmdb.RPMTAG_SIZE: 456,
+            rpmdb.RPMTAG_ARCH: 'x86_64'}
+        with self.assertRaises(ValueError):
+            rpmdb.read_header(self.blobs[0][:-10])
+
+    def test_bdb(self):
+        make_bdb(os.path.join(self.db_dir, 'Packages'), self.blobs)
+        path = rpmdb.find_packages_file(self.db_dir)
+        assert path == os.path.join(self.db_dir, 'Packages')
+        assert list(rpmdb.read_packages(path)) == self.packages
+
+    def test_ndb(self):
+        make_ndb(os.path.join(self.db_dir, 'Packages.db'), self.blobs)
+        path = rpmdb.find_packages_file(self.db_dir)
+        assert list(rpmdb.read_packages(path)) == self.packages
+
+    def test_sqlite(self):
+        make_sqlite(os.path.join(self.db_dir, 'rpmdb.sqlite'), self.blobs)
+        # Left behind by an old rpm, and not used anymore
+        open(os.path.join(self.db_dir, 'Packages'), 'w').close()
+        path = rpmdb.find_packages_file(self.db_dir)
+        assert path == os.path.join(self.db_dir, 'rpmdb.sqlite')
+        assert list(rpmdb.read_packages(path)) == self.packages
+
+    def test_not_a_database(self):
+        with open(os.path.join(self.db_dir, 'Packages'), 'w') as fp:
+            fp.write('\0' * 1024)
+        with self.assertRaises(ValueError):
+            list(rpmdb.read_packages(rpmdb.find_packages_file(self.db_dir)))
+        assert rpmdb.find_packages_file(
+            os.path.join(self.db_dir, 'nothing')) is None